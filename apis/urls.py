@@ -3,4 +3,5 @@ from .views import *
 
 urlpatterns = [
     path('/create-user', create_user, name='create-user'),
+    path('/create-users', create_users, name='create-users'),
 ]
\ No newline at end of file
@@ -1,15 +1,44 @@
-from django.shortcuts import render
+import logging
+
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from arda_app.serializers import UserSerializer
+from django.conf import settings
+from arda_app.serializers import UserSerializer, BulkUserSerializer
+from arda_app.models import bulk_create_users
+from arda_app import jobs
+
+logger = logging.getLogger(__name__)
 
 # Create your views here.
 @api_view(['POST'])
 def create_user(request):
-    print(request.data)
     serializer = UserSerializer(data=request.data)
     if serializer.is_valid():
-        serializer.save()
+        user = serializer.save()
+        try:
+            # Get the video going before the loading page asks for it
+            jobs.speculate(user.id, user.name)
+        except Exception:
+            logger.exception("Error starting speculative render", extra={'user': user.id})
         return Response({'id': serializer.data['id']}, status=status.HTTP_201_CREATED)
-    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+@api_view(['POST'])
+def create_users(request):
+    """
+    Bulk import: a JSON list of users (or {"users": [...]}), each with name,
+    mood and genre. Returns {"ids": [...]} in the same order.
+    """
+    rows = request.data.get('users') if isinstance(request.data, dict) else request.data
+    if not isinstance(rows, list):
+        return Response({'error': 'Expected a list of users'}, status=status.HTTP_400_BAD_REQUEST)
+    max_users = getattr(settings, 'USER_BULK_MAX', 50000)
+    if len(rows) > max_users:
+        return Response({'error': f'At most {max_users} users per request'}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = BulkUserSerializer(data=rows, many=True)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    ids = bulk_create_users(serializer.validated_data, batch_size=getattr(settings, 'USER_BULK_BATCH_SIZE', 500))
+    return Response({'ids': ids}, status=status.HTTP_201_CREATED)
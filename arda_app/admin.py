@@ -1,9 +1,175 @@
+from datetime import datetime
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
 from .models import UserList
 
-# Register your models here.
+# The user table has millions of rows, so the changelist avoids everything
+# that reads all of them:
+# - filter choices come from a cache instead of SELECT DISTINCT on every load
+# - counts are estimates past ADMIN_EXACT_COUNT_LIMIT rows
+# - search matches id and name prefixes (index range scans) instead of
+#   substrings in four columns
+# - in the default newest-first order, pages are fetched by keyset
+#   (?cursor=<created_at>|<id>) instead of OFFSET, so page 10000 costs the
+#   same as page 1
+
+# Query parameter holding the keyset cursor
+CURSOR_VAR = 'cursor'
+CURSOR_SEPARATOR = '|'
+
+
+def exact_count_limit():
+    return getattr(settings, 'ADMIN_EXACT_COUNT_LIMIT', 10000)
+
+
+class CachedChoicesFilter(admin.SimpleListFilter):
+    """Filter on a column's distinct values, looked up at most once per ADMIN_FILTER_CACHE_TTL."""
+    field_name = None
+
+    def lookups(self, request, model_admin):
+        key = f"admin_filter:{model_admin.model._meta.label_lower}:{self.field_name}"
+        values = cache.get(key)
+        if values is None:
+            values = list(
+                model_admin.model.objects.order_by(self.field_name)
+                .values_list(self.field_name, flat=True).distinct()[:getattr(settings, 'ADMIN_FILTER_MAX_CHOICES', 100)]
+            )
+            cache.set(key, values, getattr(settings, 'ADMIN_FILTER_CACHE_TTL', 3600))
+        return [(value, value) for value in values]
+
+    def queryset(self, request, queryset):
+        if self.value() is not None:
+            return queryset.filter(**{self.field_name: self.value()})
+        return queryset
+
+
+class MoodFilter(CachedChoicesFilter):
+    title = 'mood'
+    parameter_name = field_name = 'mood'
+
+
+class GenreFilter(CachedChoicesFilter):
+    title = 'genre'
+    parameter_name = field_name = 'genre'
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that counts exactly only up to ADMIN_EXACT_COUNT_LIMIT rows.
+    Past that it uses the planner's row estimate for the whole table
+    (PostgreSQL), or stops at the limit for filtered lists. count_kind
+    tells which one count is: 'exact', 'estimated' or 'at_least'.
+    """
+    count_kind = 'exact'
+
+    @cached_property
+    def count(self):
+        limit = exact_count_limit()
+        queryset = self.object_list
+        # COUNT over a LIMIT subquery stops after limit + 1 rows
+        count = queryset.order_by()[:limit + 1].count()
+        if count <= limit:
+            return count
+        if not queryset.query.has_filters():
+            estimate = estimated_table_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > limit:
+                self.count_kind = 'estimated'
+                return estimate
+        self.count_kind = 'at_least'
+        return limit
+
+
+def estimated_table_count(model, using):
+    """Row estimate from PostgreSQL's statistics, or None on other databases."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [model._meta.db_table])
+        row = cursor.fetchone()
+    # -1 means the table was never analyzed
+    if row is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList fetching pages by keyset on (created_at, id) while the list
+    is in the default order; any other order uses the normal page numbers.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    @property
+    def uses_keyset(self):
+        return not self.params.get(ORDER_VAR) and not self.show_all
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.next_cursor_url = None
+        self.first_page_url = None
+        if not self.uses_keyset:
+            return
+        # Page numbers mean nothing with a cursor, so there is no last page
+        # to link to
+        self.multi_page = False
+        cursor = request.GET.get(CURSOR_VAR)
+        queryset = self.queryset
+        if cursor:
+            created_at, user_id = parse_cursor(cursor)
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=user_id))
+            self.first_page_url = self.get_query_string(remove=[CURSOR_VAR])
+        # One extra row tells whether there is a next page
+        rows = list(queryset[:self.list_per_page + 1])
+        self.result_list = rows[:self.list_per_page]
+        if len(rows) > self.list_per_page:
+            last = self.result_list[-1]
+            self.next_cursor_url = self.get_query_string({
+                CURSOR_VAR: f"{last.created_at.isoformat()}{CURSOR_SEPARATOR}{last.id}",
+            })
+
+
+def parse_cursor(cursor):
+    created_at, _, user_id = cursor.partition(CURSOR_SEPARATOR)
+    try:
+        return datetime.fromisoformat(created_at), user_id
+    except ValueError as e:
+        raise IncorrectLookupParameters(e)
+
+
 @admin.register(UserList)
 class UserListAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'mood', 'genre', 'created_at')
-    search_fields = ('id', 'name', 'mood', 'genre')
-    list_filter = ('mood', 'genre')
+    list_filter = (MoodFilter, GenreFilter)
+    # Shows the search box; get_search_results narrows these to prefix matches
+    search_fields = ('id', 'name')
+    # Newest first; id makes the order total for the keyset cursor
+    ordering = ('-created_at', '-id')
+    paginator = EstimatedCountPaginator
+    # Skip the extra COUNT(*) of the unfiltered table on filtered pages
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        """An exact id, or a prefix of the id or the name (case sensitive, so the indexes are used)."""
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if len(term) == UserList._meta.get_field('id').max_length:
+            return queryset.filter(id=term), False
+        return queryset.filter(Q(id__startswith=term) | Q(name__startswith=term)), False
@@ -0,0 +1,141 @@
+"""
+Admission control for renders.
+
+- Encode slots: at most RENDER_MAX_ENCODES renders encode at once (default:
+  one per available CPU), however many worker threads there are. A worker
+  holds one slot for the whole encode; parallel segment renders (see
+  arda_app.segments) only borrow the slots that are idle at the time.
+- Bounded queue: once RENDER_MAX_QUEUE renders are waiting, requests that
+  would queue a new one are turned away with 429 and a Retry-After instead
+  of making every render slower. Cache hits and requests joining a render
+  already in flight are always let through.
+- Estimates: the average encode time is tracked so a waiting render can
+  report when it should start, and a turned away request when to retry.
+
+Limits are per process, like the render queue itself.
+
+Settings:
+    RENDER_MAX_ENCODES  concurrent encodes (default: available CPUs)
+    RENDER_MAX_QUEUE    renders allowed to wait for a slot (default: 4 x
+                        RENDER_MAX_ENCODES)
+    RENDER_RETRY_AFTER  Retry-After seconds before any encode time is
+                        known (default: 10)
+"""
+import math
+import os
+import threading
+
+from django.conf import settings
+
+from arda_app import metrics
+
+# Weight of the latest encode in the running average
+ESTIMATE_WEIGHT = 0.2
+# Retry-After is kept within these bounds (seconds)
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 120
+
+_condition = threading.Condition()
+_slots_in_use = 0
+# Running average of encode seconds, None until an encode finished
+_average_encode = None
+
+
+class QueueFull(Exception):
+    """No room in the render queue; try again in retry_after seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Render queue is full, retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on macOS and Windows
+        return os.cpu_count() or 1
+
+
+def max_encodes():
+    return max(1, getattr(settings, 'RENDER_MAX_ENCODES', None) or available_cpus())
+
+
+def max_queue():
+    limit = getattr(settings, 'RENDER_MAX_QUEUE', None)
+    return limit if limit is not None else 4 * max_encodes()
+
+
+def slots_in_use():
+    return _slots_in_use
+
+
+def acquire():
+    """Block until an encode slot is free and take it."""
+    global _slots_in_use
+    with _condition:
+        while _slots_in_use >= max_encodes():
+            _condition.wait()
+        _slots_in_use += 1
+
+
+def try_acquire(count):
+    """Take up to count encode slots without waiting; returns how many were taken."""
+    global _slots_in_use
+    with _condition:
+        taken = max(0, min(count, max_encodes() - _slots_in_use))
+        _slots_in_use += taken
+    return taken
+
+
+def release(count=1):
+    global _slots_in_use
+    with _condition:
+        _slots_in_use -= count
+        _condition.notify_all()
+
+
+def record_encode(seconds):
+    """Feed the running average encode time with a finished encode."""
+    global _average_encode
+    with _condition:
+        if _average_encode is None:
+            _average_encode = seconds
+        else:
+            _average_encode += ESTIMATE_WEIGHT * (seconds - _average_encode)
+
+
+def average_encode():
+    return _average_encode
+
+
+def start_estimate(ahead, running):
+    """
+    Seconds until a render with ahead renders waiting in front of it gets
+    a slot while running encodes hold theirs, or None before any encode
+    time is known. Slots are assumed to free up evenly.
+    """
+    if _average_encode is None:
+        return None
+    capacity = max_encodes()
+    waves = max(0, ahead + running - capacity + 1)
+    return round(waves * _average_encode / capacity, 1)
+
+
+def retry_after(waiting):
+    """Seconds a turned away request should wait before asking again."""
+    if _average_encode is None:
+        return getattr(settings, 'RENDER_RETRY_AFTER', 10)
+    # Time for the queue to drain back below its limit by one
+    seconds = (waiting - max_queue() + 1) * _average_encode / max_encodes()
+    return int(min(max(math.ceil(seconds), MIN_RETRY_AFTER), MAX_RETRY_AFTER))
+
+
+def admit(waiting):
+    """Raise QueueFull if a new render can not join waiting renders."""
+    if waiting >= max_queue():
+        metrics.ADMISSION_REJECTIONS.inc()
+        raise QueueFull(retry_after(waiting))
+
+
+metrics.ENCODE_SLOTS.set_function(slots_in_use)
@@ -0,0 +1,134 @@
+"""
+Storage tiers and the persistent index behind the render cache.
+
+Rendered videos live in a local directory (RENDER_CACHE_DIR, the tier
+requests are served from) and optionally a second, larger and slower tier
+(RENDER_CACHE_TIER2_DIR, standing in for object storage). Artifacts the
+local tier evicts move down to the second tier, and are copied back up the
+next time somebody asks for them.
+
+Every artifact has a row in an SQLite index next to the local files,
+recording its tier, size, last use and hit count, so eviction and warm
+restarts do not depend on in-memory state.
+"""
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+LOCAL = "local"
+TIER2 = "tier2"
+
+
+class DirectoryBackend:
+    """
+    Artifacts as <key>.mp4 files in a directory. Any other backend (e.g. an
+    object store) has to provide the same methods.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.mp4")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, source_path):
+        """Move source_path into the backend as key."""
+        path = self.path(key)
+        # Move next to the final name first so the rename itself is atomic
+        # even when the source is on another filesystem
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        shutil.move(source_path, partial_path)
+        os.replace(partial_path, path)
+        return path
+
+    def fetch(self, key, destination_path):
+        """Copy key out of the backend to destination_path."""
+        partial_path = f"{destination_path}.{uuid.uuid4().hex}.part"
+        shutil.copyfile(self.path(key), partial_path)
+        os.replace(partial_path, destination_path)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class ArtifactIndex:
+    """Tier, size and usage of every cached artifact, in an SQLite file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts ("
+                " key TEXT PRIMARY KEY, tier TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS artifacts_tier_last_used ON artifacts (tier, last_used)")
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        # Used as a context manager: commits, or rolls back on error
+        return conn
+
+    def get(self, key):
+        row = self.connection().execute("SELECT * FROM artifacts WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def add(self, key, tier, size, last_used=None):
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO artifacts (key, tier, size, created_at, last_used, hits) VALUES (?, ?, ?, ?, ?, 0)"
+                " ON CONFLICT (key) DO UPDATE SET tier = excluded.tier, size = excluded.size,"
+                " last_used = excluded.last_used",
+                (key, tier, size, now, last_used or now)
+            )
+
+    def used(self, key):
+        with self.connection() as conn:
+            conn.execute("UPDATE artifacts SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+
+    def set_tier(self, key, tier):
+        with self.connection() as conn:
+            conn.execute("UPDATE artifacts SET tier = ? WHERE key = ?", (tier, key))
+
+    def remove(self, key):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+
+    def keys(self, tier):
+        return {row['key'] for row in self.connection().execute("SELECT key FROM artifacts WHERE tier = ?", (tier,))}
+
+    def usage(self, tier):
+        """(file count, total bytes) in tier."""
+        row = self.connection().execute(
+            "SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM artifacts WHERE tier = ?", (tier,)
+        ).fetchone()
+        return row['files'], row['bytes']
+
+    def victims(self, tier, policy):
+        """Artifacts in tier in eviction order: least recently or least frequently used first."""
+        order = "hits ASC, last_used ASC" if policy == 'lfu' else "last_used ASC"
+        return [dict(row) for row in self.connection().execute(
+            f"SELECT key, size FROM artifacts WHERE tier = ? ORDER BY {order}", (tier,)
+        )]
+
+    def unused_since(self, cutoff):
+        return [dict(row) for row in self.connection().execute(
+            "SELECT key, tier FROM artifacts WHERE last_used < ?", (cutoff,)
+        )]
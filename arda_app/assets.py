@@ -0,0 +1,55 @@
+"""
+Registry of the render source assets.
+
+The source video and frame image never move while the site runs, so their
+locations are resolved once (at startup, see jobs.warm_up) instead of
+searching every static dir on each download, and only searched again if a
+resolved file disappears. The probed video metadata is kept in memory too,
+keyed by the file's size and mtime, so requests never spawn ffprobe unless
+the video was replaced.
+"""
+import logging
+import os
+import threading
+
+from arda_app import render
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# (video_path, frame_path) found by render.find_assets()
+_paths = None
+# (path, size, mtime_ns) -> (width, height, duration, fps)
+_probes = {}
+
+
+def resolve():
+    """(video_path, frame_path) of the source assets, or raises FileNotFoundError."""
+    global _paths
+    paths = _paths
+    if paths is not None and all(os.path.exists(path) for path in paths):
+        return paths
+    with _lock:
+        if _paths is paths:
+            _paths = render.find_assets()
+            logger.info("Resolved render assets", extra={'video': _paths[0], 'frame': _paths[1]})
+        return _paths
+
+
+def video_info(video_path):
+    """(width, height, duration, fps) of video_path, probed once per version of the file."""
+    st = os.stat(video_path)
+    probe_key = (video_path, st.st_size, st.st_mtime_ns)
+    info = _probes.get(probe_key)
+    if info is None:
+        with _lock:
+            # Checked again so the startup warm-up and a first request do
+            # not both run ffprobe
+            info = _probes.get(probe_key)
+            if info is None:
+                info = render.probe_video(video_path)
+                # Older versions of the file will not be asked for again
+                for stale_key in [k for k in _probes if k[0] == video_path]:
+                    del _probes[stale_key]
+                _probes[probe_key] = info
+    return info
@@ -0,0 +1,315 @@
+"""
+Content-addressed cache of rendered videos.
+
+A render is fully determined by the username text, the frame image, the
+source video and the encoder settings, so the sha256 of those inputs is used
+as the cache key. Two users with the same name share one encode, and since
+the artifacts live in a directory on disk they survive restarts.
+
+Artifacts are kept in tiers (see arda_app.artifacts): the local directory
+requests are served from, within a byte budget, and optionally a second
+tier that evicted artifacts move down to instead of being deleted. A
+persistent index tracks every artifact, so a restarted instance still
+serves the renders it made before.
+
+Settings:
+    RENDER_CACHE_DIR              where artifacts are stored
+                                  (default: <tmp>/arda_render_cache)
+    RENDER_CACHE_TTL              seconds an unused artifact is kept
+                                  (default: 1 day)
+    RENDER_CACHE_MAX_BYTES        byte budget of RENDER_CACHE_DIR
+                                  (default: 2 GiB, 0 for no limit)
+    RENDER_CACHE_EVICTION         'lru' (least recently used, default) or
+                                  'lfu' (least frequently used)
+    RENDER_CACHE_TIER2_DIR        second tier directory, e.g. a network or
+                                  object storage mount (default: none, evicted
+                                  artifacts are deleted)
+    RENDER_CACHE_TIER2_MAX_BYTES  byte budget of the second tier
+                                  (default: no limit)
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from arda_app import artifacts
+from arda_app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Hit/miss and tier movement counters, see stats()
+CACHE_STATS = {'hits': 0, 'misses': 0, 'promotions': 0, 'demotions': 0, 'evictions': 0}
+
+# Cached renders are named after their key; anything else in the cache dir
+# (precomposited base videos, the index) is not an artifact
+ARTIFACT_RE = re.compile(r'^([0-9a-f]{64})\.mp4$')
+# HLS packages of renders (see arda_app.hls), and interrupted ones
+HLS_DIR_RE = re.compile(r'^hls_[0-9a-f]{64}(\.part)?$')
+
+_lock = threading.Lock()
+# (path, size, mtime_ns) -> sha256 hex digest
+_digests = {}
+# root directory -> DirectoryBackend
+_backends = {}
+_index = None
+
+
+def cache_dir():
+    path = getattr(settings, 'RENDER_CACHE_DIR', None) or os.path.join(tempfile.gettempdir(), 'arda_render_cache')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_ttl():
+    return getattr(settings, 'RENDER_CACHE_TTL', 86400)
+
+
+def eviction_policy():
+    return getattr(settings, 'RENDER_CACHE_EVICTION', 'lru')
+
+
+def _backend(root):
+    backend = _backends.get(root)
+    if backend is None:
+        backend = _backends[root] = artifacts.DirectoryBackend(root)
+    return backend
+
+
+def tiers():
+    """{tier name: backend}; the second tier only if RENDER_CACHE_TIER2_DIR is set."""
+    result = {artifacts.LOCAL: _backend(cache_dir())}
+    tier2_dir = getattr(settings, 'RENDER_CACHE_TIER2_DIR', None)
+    if tier2_dir:
+        result[artifacts.TIER2] = _backend(tier2_dir)
+    return result
+
+
+def budget(tier):
+    if tier == artifacts.LOCAL:
+        return getattr(settings, 'RENDER_CACHE_MAX_BYTES', 2 * 1024 ** 3)
+    return getattr(settings, 'RENDER_CACHE_TIER2_MAX_BYTES', None)
+
+
+def index():
+    """The artifact index, opened (and reconciled with the files on disk) on first use."""
+    global _index
+    if _index is None:
+        with _lock:
+            if _index is None:
+                new_index = artifacts.ArtifactIndex(os.path.join(cache_dir(), 'index.sqlite3'))
+                _reconcile(new_index)
+                _index = new_index
+    return _index
+
+
+def _reconcile(artifact_index):
+    """
+    Index artifacts found on disk but not in the index (e.g. made before the
+    index existed) and forget index entries whose file is gone.
+    """
+    for tier, backend in tiers().items():
+        indexed = artifact_index.keys(tier)
+        for name in os.listdir(backend.root):
+            match = ARTIFACT_RE.match(name)
+            if match and match.group(1) not in indexed:
+                st = os.stat(os.path.join(backend.root, name))
+                artifact_index.add(match.group(1), tier, st.st_size, last_used=st.st_atime)
+        for key in indexed:
+            if not backend.exists(key):
+                artifact_index.remove(key)
+
+
+def file_digest(path):
+    """sha256 of a file, memoized until the file's size or mtime changes."""
+    st = os.stat(path)
+    cache_key = (path, st.st_size, st.st_mtime_ns)
+    digest = _digests.get(cache_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        _digests[cache_key] = digest
+    return digest
+
+
+def render_key(username, frame_path, video_path, encoder_settings, overlay_signature):
+    """Hash of everything that affects the rendered output."""
+    payload = json.dumps({
+        'username': username,
+        'frame': file_digest(frame_path),
+        'video': file_digest(video_path),
+        'encoder': encoder_settings,
+        'overlay': overlay_signature,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def artifact_path(key):
+    return tiers()[artifacts.LOCAL].path(key)
+
+
+def touch(path):
+    """
+    Mark a file in the cache dir that is not an indexed artifact (e.g. a
+    precomposited base video) as used so prune() keeps it around. Only the
+    access time changes; the modification time stays stable.
+    """
+    try:
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+    except OSError:
+        pass
+
+
+def _count(stat, n=1):
+    with _lock:
+        CACHE_STATS[stat] += n
+    metrics.CACHE_EVENTS.inc(n, event=stat)
+
+
+def lookup(key):
+    """
+    Return the local path of the cached artifact for key (counting a hit),
+    copying it up from the second tier if it was evicted there, or None
+    (counting a miss).
+    """
+    artifact_index = index()
+    backends = tiers()
+    local = backends[artifacts.LOCAL]
+    path = local.path(key)
+    if os.path.exists(path):
+        artifact_index.used(key)
+        _count('hits')
+        return path
+
+    tier2 = backends.get(artifacts.TIER2)
+    if tier2 is not None and tier2.exists(key):
+        try:
+            tier2.fetch(key, path)
+        except OSError as e:
+            logger.warning("Error promoting cached render", extra={'key': key[:12], 'error': str(e)})
+        else:
+            artifact_index.add(key, artifacts.LOCAL, os.path.getsize(path))
+            artifact_index.used(key)
+            tier2.delete(key)
+            _count('hits')
+            _count('promotions')
+            logger.info("Promoted cached render from the second tier", extra={'key': key[:12]})
+            enforce_budget(keep=(key,))
+            return path
+
+    if artifact_index.get(key) is not None:
+        # Indexed, but the file is gone
+        artifact_index.remove(key)
+    _count('misses')
+    return None
+
+
+def store(key, rendered_path):
+    """Move a finished render into the cache and return its new path."""
+    path = tiers()[artifacts.LOCAL].put(key, rendered_path)
+    index().add(key, artifacts.LOCAL, os.path.getsize(path))
+    logger.info("Cached render", extra={'key': key[:12], 'path': path})
+    # The new render itself is never the one evicted to make room
+    enforce_budget(keep=(key,))
+    return path
+
+
+def _evict(key, tier, backends):
+    """Move key down from tier to the next one, or delete it from the last one."""
+    artifact_index = index()
+    backend = backends[tier]
+    lower = backends.get(artifacts.TIER2) if tier == artifacts.LOCAL else None
+    try:
+        if lower is not None:
+            lower.put(key, backend.path(key))
+            artifact_index.set_tier(key, artifacts.TIER2)
+            _count('demotions')
+        else:
+            backend.delete(key)
+            artifact_index.remove(key)
+            _count('evictions')
+    except FileNotFoundError:
+        # Already moved or removed by another process
+        artifact_index.remove(key)
+
+
+def enforce_budget(keep=()):
+    """Evict artifacts (least recently or frequently used first) until every tier fits its budget."""
+    artifact_index = index()
+    backends = tiers()
+    for tier in (artifacts.LOCAL, artifacts.TIER2):
+        limit = budget(tier)
+        if tier not in backends or not limit:
+            continue
+        files, used = artifact_index.usage(tier)
+        if used <= limit:
+            continue
+        for victim in artifact_index.victims(tier, eviction_policy()):
+            if used <= limit:
+                break
+            if victim['key'] in keep:
+                continue
+            _evict(victim['key'], tier, backends)
+            used -= victim['size']
+        logger.info("Evicted cached renders", extra={'tier': tier, 'bytes': used, 'budget': limit})
+
+
+def prune():
+    """
+    Remove artifacts that have not been used for RENDER_CACHE_TTL seconds,
+    from every tier, then make sure the tiers fit their budgets.
+    """
+    cutoff = time.time() - cache_ttl()
+    removed = 0
+    backends = tiers()
+    artifact_index = index()
+    for entry in artifact_index.unused_since(cutoff):
+        backend = backends.get(entry['tier'])
+        if backend is not None:
+            backend.delete(entry['key'])
+        artifact_index.remove(entry['key'])
+        removed += 1
+
+    # Other files in the cache dir (precomposited base videos, source
+    # segments, HLS packages, leftovers of interrupted moves) go by access time
+    directory = cache_dir()
+    for name in os.listdir(directory):
+        is_package = HLS_DIR_RE.match(name)
+        if not is_package and (ARTIFACT_RE.match(name) or not name.endswith(('.mp4', '.part'))):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.stat(path).st_atime < cutoff:
+                if is_package:
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+        except OSError as e:
+            logger.warning("Error pruning cached render", extra={'path': path, 'error': str(e)})
+    if removed:
+        logger.info("Pruned cached renders", extra={'removed': removed})
+
+    enforce_budget()
+    return removed
+
+
+def stats():
+    with _lock:
+        counters = dict(CACHE_STATS)
+    total = counters['hits'] + counters['misses']
+    data = dict(counters, hit_rate=round(counters['hits'] / total, 4) if total else 0.0)
+    artifact_index = index()
+    for tier in tiers():
+        files, used = artifact_index.usage(tier)
+        data[tier] = {'files': files, 'bytes': used, 'budget': budget(tier)}
+    return data
@@ -0,0 +1,220 @@
+"""
+In-process compositing backend: the overlay is blended onto the decoded
+frames with NumPy instead of by ffmpeg's overlay filter.
+
+    decoder (imageio-ffmpeg) -> RGB frames -> alpha blend -> encoder stdin
+
+Frames are blended RENDER_COMPOSITE_BATCH_FRAMES at a time as one array, so
+the per-frame cost is a few vectorized operations on the part of the frame
+the overlay actually covers. The alpha masks are computed once per render.
+
+It needs no ffmpeg on the PATH (imageio-ffmpeg ships its own binary), so it
+is the fallback when the filter graph render in render.encode_video fails,
+or the main backend with RENDER_BACKEND = 'compositor'.
+"""
+import collections
+import logging
+import subprocess
+import threading
+import time
+
+import imageio_ffmpeg
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+from arda_app import metrics
+from arda_app import render
+
+logger = logging.getLogger(__name__)
+
+# Seconds between on_progress calls, about as often as ffmpeg -progress reports
+PROGRESS_INTERVAL = 0.5
+
+
+def batch_frames():
+    return max(1, getattr(settings, 'RENDER_COMPOSITE_BATCH_FRAMES', 16))
+
+
+def overlay_masks(overlay, frame_width, frame_height, position=None):
+    """
+    Precomputed blend of an RGBA overlay onto frame_width x frame_height
+    frames, as (rows, columns, inverse_alpha, premultiplied), or None if
+    the overlay covers nothing. rows and columns slice the frames to the
+    overlay's visible pixels (transparent borders are trimmed), and within
+    them
+
+        frame = (frame * inverse_alpha + premultiplied) // 255
+
+    with inverse_alpha = 255 - alpha and premultiplied = rgb * alpha + 127
+    (for rounding), both uint16 so the sum cannot overflow.
+    """
+    rgba = np.asarray(overlay.convert('RGBA'), dtype=np.uint16)
+    height, width = rgba.shape[:2]
+    if position is None:
+        # Centered, like (main_w-overlay_w)/2:(main_h-overlay_h)/2
+        x, y = (frame_width - width) // 2, (frame_height - height) // 2
+    else:
+        x, y = position
+    # Clip to the frame
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width, frame_width), min(y + height, frame_height)
+    if left >= right or top >= bottom:
+        return None
+    rgba = rgba[top - y:bottom - y, left - x:right - x]
+
+    alpha = rgba[..., 3]
+    visible_rows = np.flatnonzero(alpha.any(axis=1))
+    visible_columns = np.flatnonzero(alpha.any(axis=0))
+    if not visible_rows.size:
+        return None
+    row_start, row_end = visible_rows[0], visible_rows[-1] + 1
+    column_start, column_end = visible_columns[0], visible_columns[-1] + 1
+    rgba = rgba[row_start:row_end, column_start:column_end]
+
+    alpha = rgba[..., 3:]
+    return (
+        slice(top + row_start, top + row_end),
+        slice(left + column_start, left + column_end),
+        255 - alpha,
+        rgba[..., :3] * alpha + 127,
+    )
+
+
+def blend(frames, masks):
+    """Alpha blend the overlay onto a (count, height, width, 3) uint8 batch, in place."""
+    rows, columns, inverse_alpha, premultiplied = masks
+    region = frames[:, rows, columns] * inverse_alpha
+    region += premultiplied
+    region //= 255
+    frames[:, rows, columns] = region
+
+
+def composite_video(video_path, overlay, output_video_path, duration, on_progress,
+                    position=None, profile=None, height=None):
+    """
+    Same contract as render.encode_video: overlay (an image path or RGBA
+    PIL image) on video_path, encoded with the encoder profile to
+    output_video_path, scaled down to height if given. Progress is the
+    share of frames composited, reported through on_progress(percentage,
+    speed=..., fps=..., eta=...).
+    """
+    if profile is None:
+        profile = render.get_profile(render.default_profile_name())
+    if not isinstance(overlay, Image.Image):
+        with Image.open(overlay) as image:
+            overlay = image.convert('RGBA')
+
+    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    reader = imageio_ffmpeg.read_frames(video_path, pix_fmt='rgb24')
+    encoder = None
+    metrics.FFMPEG_PROCESSES.inc(2)
+    try:
+        meta = next(reader)
+        frame_width, frame_height = meta['size']
+        fps = meta['fps']
+        total_frames = max(1, round((duration or meta.get('duration') or 0) * fps))
+        masks = overlay_masks(overlay, frame_width, frame_height, position)
+
+        filters = f'scale=-2:{height},format=yuv420p' if height else 'format=yuv420p'
+        output_args = []
+        for option, value in render.encoder_options(profile).items():
+            output_args += [f'-{option}', value]
+        encoder_cmd = [
+            ffmpeg_exe,
+            '-y',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', f'{frame_width}x{frame_height}',
+            '-r', repr(fps),
+            '-i', 'pipe:0',  # Composited frames
+            '-i', video_path,  # Audio, copied as is
+            '-map', '0:v:0', '-map', '1:a:0?',
+            '-vf', filters,
+            *output_args,
+            '-loglevel', 'warning',
+            '-nostats',
+            output_video_path
+        ]
+        logger.info("Starting compositor", extra={
+            'input': video_path,
+            'frames': total_frames,
+            'batch': batch_frames(),
+            'profile': profile['name'],
+            'output': output_video_path,
+        })
+        encoder = subprocess.Popen(
+            encoder_cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        stderr_lines = collections.deque(maxlen=20)
+        stderr_thread = threading.Thread(target=render._drain_stderr, args=(encoder, stderr_lines))
+        stderr_thread.daemon = True
+        stderr_thread.start()
+
+        batch = np.empty((batch_frames(), frame_height, frame_width, 3), dtype=np.uint8)
+        started = last_report = time.monotonic()
+        done = count = 0
+        try:
+            for frame in reader:
+                batch[count] = np.frombuffer(frame, dtype=np.uint8).reshape(frame_height, frame_width, 3)
+                count += 1
+                if count < len(batch):
+                    continue
+                if masks is not None:
+                    blend(batch, masks)
+                encoder.stdin.write(batch)
+                done += count
+                count = 0
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    report_progress(on_progress, done, total_frames, fps, now - started)
+            if count:
+                if masks is not None:
+                    blend(batch[:count], masks)
+                encoder.stdin.write(batch[:count])
+                done += count
+        except BrokenPipeError:
+            # The encoder died; its log says why
+            pass
+        finally:
+            try:
+                encoder.stdin.close()
+            except BrokenPipeError:
+                pass
+        encoder.wait()
+        stderr_thread.join(timeout=5)
+    finally:
+        reader.close()
+        if encoder is not None:
+            if encoder.poll() is None:
+                encoder.kill()
+                encoder.wait()
+            encoder.stderr.close()
+        metrics.FFMPEG_PROCESSES.dec(2)
+
+    for line in stderr_lines:
+        logger.debug("Compositor encoder output", extra={'line': line})
+    if encoder.returncode != 0:
+        detail = f": {stderr_lines[-1]}" if stderr_lines else ""
+        raise Exception(f"Compositor encoder exited with error code {encoder.returncode}{detail}")
+
+    elapsed = time.monotonic() - started
+    on_progress(100, speed=round(done / fps / elapsed, 3) if elapsed else None,
+                fps=round(done / elapsed, 2) if elapsed else None, eta=0)
+    logger.info("Compositor finished", extra={'frames': done, 'seconds': round(elapsed, 3)})
+
+
+def report_progress(on_progress, done, total_frames, fps, elapsed):
+    """on_progress from the frames composited so far (see render.parse_progress)."""
+    rate = done / elapsed if elapsed > 0 else None
+    stats = {
+        'speed': round(rate / fps, 3) if rate else None,
+        'fps': round(rate, 2) if rate else None,
+        'eta': round(max(total_frames - done, 0) / rate, 1) if rate else None,
+    }
+    percentage = round(min(done / total_frames * 100, 100), 2)
+    on_progress(percentage, **stats)
+    logger.debug("Compositor progress", extra={'progress': percentage, **stats})
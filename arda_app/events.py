@@ -0,0 +1,78 @@
+"""
+Change notifications from the render workers to async listeners.
+
+Worker threads call publish(channel) whenever something a client may be
+waiting for changes (progress moved, a job finished or was submitted).
+Async views hold a Subscription on the channels they care about and
+await wait(), which wakes up on the next publish without polling.
+
+Channels are plain strings, see key_channel() and user_channel().
+"""
+import asyncio
+import threading
+
+_lock = threading.Lock()
+# channel -> set of Subscription
+_channels = {}
+
+
+def key_channel(key):
+    return f"key:{key}"
+
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+
+class Subscription:
+    """Wakes an asyncio task whenever one of its channels is published."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.channels = set()
+
+    def listen(self, channels):
+        """Replace the set of channels this subscription listens on."""
+        channels = set(channels)
+        with _lock:
+            for channel in self.channels - channels:
+                subscribers = _channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(self)
+                    if not subscribers:
+                        del _channels[channel]
+            for channel in channels - self.channels:
+                _channels.setdefault(channel, set()).add(self)
+        self.channels = channels
+
+    def close(self):
+        self.listen(())
+
+    def notify(self):
+        # Called from any thread
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            # Event loop already closed, the listener is gone
+            pass
+
+    async def wait(self, timeout):
+        """True if notified within timeout seconds, False on timeout."""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.event.clear()
+
+
+def publish(*channels):
+    """Wake everything subscribed to any of channels."""
+    with _lock:
+        subscribers = set()
+        for channel in channels:
+            subscribers.update(_channels.get(channel, ()))
+    for subscription in subscribers:
+        subscription.notify()
@@ -0,0 +1,145 @@
+"""
+Optional HLS packaging of rendered videos (RENDER_HLS).
+
+A finished render is cut into fMP4 segments of about
+RENDER_HLS_SEGMENT_SECONDS with a VOD playlist, without re-encoding, in
+the background as soon as the render is done (see package_later()), or
+the first time its playlist is asked for if the package is gone. Players start after the first
+segment instead of after the whole file. Renders get a keyframe every
+RENDER_HLS_SEGMENT_SECONDS while HLS is on (see jobs.submit), so the cuts
+land where they should.
+
+Packages live next to the cached MP4 as hls_<render key>/ and are pruned
+with it (see cache.prune).
+
+Settings:
+    RENDER_HLS                  package renders for HLS (default: False)
+    RENDER_HLS_SEGMENT_SECONDS  target segment length (default: 4)
+"""
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+
+from django.conf import settings
+from django.urls import reverse
+
+from arda_app import cache
+from arda_app import metrics
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST = 'index.m3u8'
+INIT_SEGMENT = 'init.mp4'
+# Everything a package holds; nothing else is served from it
+FILE_RE = re.compile(r'^(index\.m3u8|init\.mp4|seg_\d{5}\.m4s)$')
+KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.mp4': 'video/mp4',
+    '.m4s': 'video/iso.segment',
+}
+
+# Packaging of one render at a time, striped by render key like jobs._submit_lock()
+PACKAGE_LOCK_STRIPES = 64
+_package_locks = [threading.Lock() for _ in range(PACKAGE_LOCK_STRIPES)]
+
+
+def enabled():
+    return getattr(settings, 'RENDER_HLS', False)
+
+
+def segment_seconds():
+    return getattr(settings, 'RENDER_HLS_SEGMENT_SECONDS', 4)
+
+
+def package_dir(key):
+    return os.path.join(cache.cache_dir(), f"hls_{key}")
+
+
+def playlist_url(key):
+    return reverse('hls_file', args=[key, PLAYLIST])
+
+
+def package(video_path, output_dir):
+    """Cut video_path into an fMP4 HLS package in output_dir (stream copy)."""
+    os.makedirs(output_dir, exist_ok=True)
+    ffmpeg_cmd = [
+        'ffmpeg', '-y',
+        '-i', video_path,
+        '-c', 'copy',
+        '-f', 'hls',
+        '-hls_time', str(segment_seconds()),
+        '-hls_playlist_type', 'vod',
+        '-hls_segment_type', 'fmp4',
+        '-hls_fmp4_init_filename', INIT_SEGMENT,
+        '-hls_segment_filename', os.path.join(output_dir, 'seg_%05d.m4s'),
+        '-loglevel', 'error',
+        os.path.join(output_dir, PLAYLIST)
+    ]
+    with metrics.FFMPEG_PROCESSES.track():
+        subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.DEVNULL)
+
+
+def _package_lock(key):
+    return _package_locks[int(key[:8], 16) % len(_package_locks)]
+
+
+def ensure_package(key):
+    """
+    Directory of the HLS package of the render key, packaging the cached
+    render first if needed. None if the render is not in the cache.
+    Blocks while ffmpeg runs, so keep it out of the request thread.
+    """
+    directory = package_dir(key)
+    with _package_lock(key):
+        if os.path.exists(os.path.join(directory, PLAYLIST)):
+            # Touch so cache.prune() keeps it while it is in use
+            cache.touch(directory)
+            return directory
+        video_path = cache.lookup(key)
+        if video_path is None:
+            return None
+        partial_dir = directory + '.part'
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        try:
+            package(video_path, partial_dir)
+            shutil.rmtree(directory, ignore_errors=True)
+            os.replace(partial_dir, directory)
+        finally:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+    logger.info("Packaged render for HLS", extra={'key': key[:12], 'segment_seconds': segment_seconds()})
+    return directory
+
+
+def package_later(key):
+    """Package the render key in a background thread, so its playlist is ready when asked for."""
+    thread = threading.Thread(target=_package_quietly, args=(key,), name="hls-package")
+    thread.daemon = True
+    thread.start()
+
+
+def _package_quietly(key):
+    try:
+        ensure_package(key)
+    except Exception:
+        # The MP4 is fine; the playlist request will try again
+        logger.exception("Error packaging render for HLS", extra={'key': key[:12]})
+
+
+def file_path(key, name):
+    """Path of a file of the package of key, or None if there is no such file."""
+    if not KEY_RE.match(key) or not FILE_RE.match(name):
+        return None
+    directory = ensure_package(key) if name == PLAYLIST else package_dir(key)
+    if directory is None:
+        return None
+    path = os.path.join(directory, name)
+    return path if os.path.exists(path) else None
+
+
+def content_type(name):
+    return CONTENT_TYPES[os.path.splitext(name)[1]]
@@ -0,0 +1,172 @@
+"""
+Background janitor expiring finished renders.
+
+Finished jobs used to start one thread each that slept for CLEANUP_DELAY
+before cleaning up. Now a single thread keeps a heap of (due time, render
+key) and wakes up when the earliest one is due, expiring everything that
+is due by then in one batch followed by a single cache.prune().
+
+It is started by the server entry points (arda_website.wsgi and .asgi),
+or else by the first schedule(), so management commands and tests don't
+run it. When it starts it reconciles what a previous run left behind:
+- render temp dirs (see temp_dir()) of processes that are gone
+- finished jobs in the shared job store whose cleanup was pending when
+  the process stopped; they are scheduled again (or expired right away)
+
+Settings:
+    RENDER_JANITOR_INTERVAL  minimum seconds between two sweeps, so
+                             expirations close together are batched
+                             (default: 30)
+    RENDER_TEMP_MAX_AGE      seconds after which a render temp dir is
+                             removed even if its process still seems to be
+                             running (default: 6 hours)
+"""
+import heapq
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from arda_app import cache
+from arda_app import jobstore
+
+logger = logging.getLogger(__name__)
+
+TEMP_PREFIX = "arda_render_tmp_"
+# Only directories named by temp_dir() are ever removed
+TEMP_DIR_RE = re.compile(r'^arda_render_tmp_(\d+)_')
+
+_condition = threading.Condition()
+# (due time, render key), may hold stale entries, see _due
+_heap = []
+# render key -> due time of its latest schedule() call
+_due = {}
+_thread = None
+
+
+def sweep_interval():
+    return getattr(settings, 'RENDER_JANITOR_INTERVAL', 30)
+
+
+def temp_dir():
+    """A new temp dir for a render, named so reconcile_temp_dirs() can tell whose it is."""
+    return tempfile.mkdtemp(prefix=f"{TEMP_PREFIX}{os.getpid()}_")
+
+
+def schedule(key, delay):
+    """Expire key delay seconds from now (replacing an earlier schedule)."""
+    due = time.time() + delay
+    with _condition:
+        _due[key] = due
+        heapq.heappush(_heap, (due, key))
+        _condition.notify()
+    start()
+
+
+def start():
+    """Start the janitor thread, reconciling leftovers first. Safe to call repeatedly."""
+    global _thread
+    with _condition:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_run, name="render-janitor")
+        _thread.daemon = True
+        _thread.start()
+
+
+def _run():
+    try:
+        reconcile_temp_dirs()
+        reconcile_jobs()
+    except Exception:
+        logger.exception("Error reconciling render leftovers")
+
+    while True:
+        with _condition:
+            while not _heap:
+                _condition.wait()
+            wait = _heap[0][0] - time.time()
+            if wait > 0:
+                # Woken up early by a new schedule(), look at the heap again
+                _condition.wait(wait)
+                continue
+            due_keys = _pop_due(time.time() + sweep_interval() / 2)
+        try:
+            sweep(due_keys)
+        except Exception:
+            logger.exception("Error in render janitor sweep")
+        # Let more expirations pile up for the next batch
+        time.sleep(sweep_interval())
+
+
+def _pop_due(until):
+    """Pop the keys due by until, skipping entries replaced by a later schedule()."""
+    keys = []
+    while _heap and _heap[0][0] <= until:
+        due, key = heapq.heappop(_heap)
+        if _due.get(key) == due:
+            del _due[key]
+            keys.append(key)
+    return keys
+
+
+def sweep(keys):
+    """Expire a batch of finished jobs, then prune stale cached renders once."""
+    from arda_app import jobs
+
+    expired = jobs.expire(keys)
+    if keys:
+        logger.info("Expired due render jobs", extra={'expired': expired, 'due': len(keys)})
+    cache.prune()
+
+
+def reconcile_temp_dirs():
+    """Remove render temp dirs whose process is gone, or that are older than RENDER_TEMP_MAX_AGE."""
+    max_age = getattr(settings, 'RENDER_TEMP_MAX_AGE', 6 * 3600)
+    root = tempfile.gettempdir()
+    removed = 0
+    for name in os.listdir(root):
+        match = TEMP_DIR_RE.match(name)
+        path = os.path.join(root, name)
+        if not match or not os.path.isdir(path):
+            continue
+        try:
+            too_old = time.time() - os.stat(path).st_mtime > max_age
+        except OSError:
+            continue
+        if too_old or not _pid_running(int(match.group(1))):
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger.info("Removed orphaned render temp dirs", extra={'removed': removed})
+    return removed
+
+
+def _pid_running(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists, owned by someone else
+        return True
+    return True
+
+
+def reconcile_jobs():
+    """Schedule the expiry of finished jobs left in the job store by a previous run."""
+    from arda_app import jobs
+
+    now = time.time()
+    store = jobstore.get_store()
+    for status in jobstore.FINISHED:
+        for key, updated_at in store.keys_with_status(status):
+            if key not in _due:
+                schedule(key, max(0, updated_at + jobs.CLEANUP_DELAY - now))
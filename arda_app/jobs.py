@@ -0,0 +1,964 @@
+"""
+Background render jobs.
+
+Download requests no longer run ffmpeg in the request thread. They enqueue a
+RenderJob (or attach to the one already queued for the same output) and
+return; a fixed pool of worker threads picks jobs off the queue and runs the
+overlay + encode pipeline from arda_app.render.
+
+With RENDER_ASYNC the encodes are supervised by a single asyncio event loop
+thread instead (see run_job_async): one dispatcher thread hands queued jobs
+to it as encode slots free up, and ffmpeg's pipes are read on the loop, so
+the process needs the same few threads however many renders are running.
+
+Jobs are keyed by the render cache key (see arda_app.cache), not by user, so
+users whose renders would come out identical share one job and one file.
+
+Status, progress and output of every job live in the job store (see
+arda_app.jobstore), so every process serving the site sees the same state
+and only one of them queues a given render. JOBS only holds the in-process
+handles of the jobs this process queued, which streaming follows.
+
+Settings:
+    RENDER_WORKERS          number of worker threads (default: os.cpu_count());
+                            how many of them encode at once is capped by
+                            RENDER_MAX_ENCODES, see arda_app.admission
+    RENDER_ASYNC            supervise encodes from an asyncio event loop
+                            instead of the worker threads (default: False)
+    RENDER_LOAD_PROFILES    [(queue depth, profile name), ...] switches to a
+                            cheaper encoder profile once the queue is that deep
+    RENDER_PREVIEW_PROFILE  encoder profile used for the quick preview render
+    RENDER_COALESCE_WAIT    seconds a download request waits on the in-flight
+                            render it joined before answering 202 (default: 60)
+    RENDER_JOB_STALE_AFTER  seconds without an update after which a job left
+                            queued or encoding by another process is taken
+                            over (default: 600)
+    RENDER_SPECULATIVE      start rendering new users' videos as soon as they
+                            are created (see speculate())
+    RENDER_SPECULATIVE_MAX_QUEUE
+                            skip speculative renders while this many jobs are
+                            queued (default: the number of workers)
+    RENDER_SPECULATIVE_MAX_WAIT
+                            drop a speculative render still queued after this
+                            many seconds (default: 60)
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+from django.conf import settings
+
+from arda_app import admission
+from arda_app import assets
+from arda_app import cache
+from arda_app import events
+from arda_app import hls
+from arda_app import janitor
+from arda_app import jobstore
+from arda_app import metrics
+from arda_app import render
+from arda_app import renditions
+from arda_app import segments
+from arda_app.jobstore import QUEUED, ENCODING, READY, EXPIRED, FAILED
+
+logger = logging.getLogger(__name__)
+
+# Render jobs queued by this process, per render key
+JOBS = {}
+
+# Variants a user can have in flight at once; renditions other than the
+# default are final variants of their own, see rendition_variant()
+FINAL = "final"
+PREVIEW = "preview"
+
+# Requests that joined a render already in flight, and how their waits ended
+COALESCE_STATS = {'coalesced': 0, 'waits': 0, 'wait_timeouts': 0}
+# Speculative renders queued, dropped under load, and later asked for
+SPECULATIVE_STATS = {'queued': 0, 'dropped': 0, 'promoted': 0}
+
+# Queue priorities, lower runs first
+PRIORITY_NORMAL = 0
+PRIORITY_SPECULATIVE = 1
+
+# How often a wait on a job running in another process checks the store (seconds)
+REMOTE_POLL_INTERVAL = 0.5
+
+# Locks serializing submits, one per group of render keys
+SUBMIT_LOCK_STRIPES = 64
+
+# How long a finished job (ready, failed or dropped) is kept before the janitor expires it (seconds)
+CLEANUP_DELAY = 900
+
+# (priority, sequence, job); a promoted job can be in it twice, see submit()
+_queue = queue.PriorityQueue()
+_sequence = itertools.count()
+_lock = threading.Lock()
+# Striped by render key, see _submit_lock()
+_submit_locks = [threading.Lock() for _ in range(SUBMIT_LOCK_STRIPES)]
+_workers = []
+# RENDER_ASYNC: the event loop encodes are supervised on, and the thread
+# that writes their progress to the job store
+_render_loop = None
+_warm_up_thread = None
+_progress_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='render-progress')
+
+
+class RenderJob:
+    """A single overlay + encode request, shared by every user with the same render key."""
+
+    def __init__(self, key, username, video_path, frame_path, profile, speculative=False):
+        self.key = key
+        self.username = username
+        self.video_path = video_path
+        self.frame_path = frame_path
+        self.profile = profile
+        self.status = QUEUED
+        # False for a job another process is running; only its state in the
+        # job store can be followed
+        self.local = True
+        # Rendered ahead of any request; runs after normal jobs and may be
+        # dropped until a request asks for it
+        self.speculative = speculative
+        # Taken off the queue by a worker
+        self.picked = False
+        # Place in the queue, see queue_position()
+        self.priority = PRIORITY_SPECULATIVE if speculative else PRIORITY_NORMAL
+        self.sequence = None
+        self.output_path = None
+        # File ffmpeg is writing to while the job runs
+        self.partial_path = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        # Set once ffmpeg has started writing partial_path (or the job failed)
+        self.encoding = threading.Event()
+
+    @property
+    def is_active(self):
+        return self.status in jobstore.ACTIVE
+
+    def __repr__(self):
+        return f"<RenderJob key={self.key[:12]} status={self.status}>"
+
+
+def worker_count():
+    return getattr(settings, 'RENDER_WORKERS', None) or os.cpu_count() or 1
+
+
+def async_enabled():
+    return getattr(settings, 'RENDER_ASYNC', False)
+
+
+def _ensure_workers():
+    """Start the worker threads (or the render loop) the first time a job is submitted."""
+    global _render_loop
+    with _lock:
+        if _workers:
+            return
+        if async_enabled():
+            _render_loop = asyncio.new_event_loop()
+            for name, target in (('render-loop', _render_loop.run_forever), ('render-dispatcher', _dispatch_loop)):
+                worker = threading.Thread(target=target, name=name)
+                worker.daemon = True
+                worker.start()
+                _workers.append(worker)
+            logger.info("Started render loop", extra={'max_encodes': admission.max_encodes()})
+            return
+        for i in range(worker_count()):
+            worker = threading.Thread(target=_worker_loop, name=f"render-worker-{i}")
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+        logger.info("Started render workers", extra={'workers': len(_workers)})
+
+
+def _pick(job):
+    """Claim a job taken off the queue; False if it is not to be run."""
+    max_wait = getattr(settings, 'RENDER_SPECULATIVE_MAX_WAIT', 60)
+    with _lock:
+        if job.picked:
+            # Second queue entry of a promoted job
+            return False
+        job.picked = True
+        drop = job.speculative and time.time() - job.created_at > max_wait
+    if drop:
+        _drop(job)
+        return False
+    return True
+
+
+def _worker_loop():
+    while True:
+        priority, sequence, job = _queue.get()
+        try:
+            if not _pick(job):
+                continue
+            # Waits here while RENDER_MAX_ENCODES renders are encoding
+            admission.acquire()
+            try:
+                run_job(job)
+            finally:
+                admission.release()
+        except Exception:
+            logger.exception("Unhandled error in render worker", extra={'key': job.key[:12]})
+        finally:
+            _queue.task_done()
+
+
+def _dispatch_loop():
+    """
+    RENDER_ASYNC: start queued jobs on the render loop in queue order, as
+    soon as an encode slot is free. The slot is given back when the job is done.
+    """
+    while True:
+        priority, sequence, job = _queue.get()
+        try:
+            if not _pick(job):
+                _queue.task_done()
+                continue
+            admission.acquire()
+        except Exception:
+            logger.exception("Unhandled error in render dispatcher", extra={'key': job.key[:12]})
+            _queue.task_done()
+            continue
+        asyncio.run_coroutine_threadsafe(_run_dispatched(job), _render_loop)
+
+
+async def _run_dispatched(job):
+    try:
+        await run_job_async(job)
+    except Exception:
+        logger.exception("Unhandled error in render loop", extra={'key': job.key[:12]})
+    finally:
+        admission.release()
+        _queue.task_done()
+
+
+def get_state(user_id, variant=FINAL):
+    """Job store record of the user's latest request, or None."""
+    store = jobstore.get_store()
+    key = store.get_user_key(user_id, variant)
+    return store.get(key) if key is not None else None
+
+
+def rendition_variant(rendition):
+    """Variant the user's render of a rendition is tracked under."""
+    return FINAL if rendition == renditions.default_rendition() else f"{FINAL}-{rendition}"
+
+
+def key_for(user_id, variant=FINAL):
+    """Render key of the user's latest request, or None."""
+    return jobstore.get_store().get_user_key(user_id, variant)
+
+
+def keys_for(user_id, variant=FINAL):
+    """Render keys of the user's final variant and its preview."""
+    keys = (key_for(user_id, name) for name in (variant, PREVIEW))
+    return [key for key in keys if key is not None]
+
+
+def output_ready(state):
+    """True if state is a finished job whose video is still on disk."""
+    return state is not None and state['status'] == READY and os.path.exists(state['output_path'])
+
+
+def eta_remaining(state):
+    """Seconds an encoding job still needs, counted down from its last progress report, or None."""
+    if state is None or state['status'] != ENCODING or state.get('eta') is None:
+        return None
+    return round(max(state['eta'] - (time.time() - state['updated_at']), 0), 1)
+
+
+def progress_for(user_id, variant=FINAL):
+    state = get_state(user_id, variant)
+    return state['progress'] if state is not None else 0
+
+
+def video_path_for(user_id, variant=FINAL):
+    state = get_state(user_id, variant)
+    return state['output_path'] if output_ready(state) else None
+
+
+def ready_video(user_id, variant=FINAL):
+    """
+    (render key, path) of the user's finished video if it is on disk,
+    otherwise None. The key is read once, so the path always belongs to it.
+    """
+    store = jobstore.get_store()
+    key = store.get_user_key(user_id, variant)
+    state = store.get(key) if key is not None else None
+    return (key, state['output_path']) if output_ready(state) else None
+
+
+def is_ready(user_id, variant=FINAL):
+    """True if a finished video for this user's latest request is on disk."""
+    return output_ready(get_state(user_id, variant))
+
+
+def choose_profile(requested=None):
+    """
+    Name of the encoder profile to render with: the requested one if it
+    exists, otherwise the cheapest RENDER_LOAD_PROFILES entry whose queue
+    depth has been reached, otherwise the default profile.
+    """
+    profiles = render.encoder_profiles()
+    if requested in profiles:
+        return requested
+
+    depth = queue_depth()
+    load_profiles = getattr(settings, 'RENDER_LOAD_PROFILES', [])
+    for threshold, name in sorted(load_profiles, reverse=True):
+        if depth >= threshold and name in profiles:
+            return name
+    return render.default_profile_name()
+
+
+def preview_profile_name():
+    name = getattr(settings, 'RENDER_PREVIEW_PROFILE', None)
+    return name if name in render.encoder_profiles() else None
+
+
+def submit(user_id, username, profile_name=None, variant=FINAL, fragmented=False, speculative=False,
+           rendition=None):
+    """
+    Return the job that produces username's video: an already finished one
+    from the render cache, the one already queued or running for the same
+    render key, or a newly queued one.
+
+    fragmented renders to fragmented MP4 so the output can be streamed with
+    follow_output() while it is being encoded.
+
+    speculative queues the job behind all normal ones, see speculate().
+
+    rendition caps the profile's size and bitrate, see arda_app.renditions.
+    """
+    job, queued = _claim(user_id, username, profile_name, variant, fragmented, speculative, rendition)
+    if queued:
+        _put(job, user_id, variant, speculative)
+    return job
+
+
+def _claim(user_id, username, profile_name=None, variant=FINAL, fragmented=False, speculative=False,
+           rendition=None):
+    """
+    submit() up to putting the job on the queue: returns (job, True if the
+    caller has to _put() it). Raises QueueFull if there is no room for it.
+    """
+    profile = render.get_profile(profile_name or choose_profile())
+    if rendition is not None:
+        profile = renditions.apply(profile, rendition)
+    if fragmented:
+        profile['fragmented'] = True
+    if hls.enabled() and variant != PREVIEW:
+        profile['keyframe_interval'] = hls.segment_seconds()
+    video_path, frame_path = assets.resolve()
+    key = cache.render_key(
+        username, frame_path, video_path,
+        profile, render.overlay_signature()
+    )
+
+    store = jobstore.get_store()
+    # Submits of the same render run one at a time; _lock is only taken
+    # for the in-memory bookkeeping, never across job store or cache I/O
+    with _submit_lock(key):
+        job = _attach(key, user_id, speculative)
+        queued = False
+        if job is None:
+            # Raises QueueFull before the user is pointed at a render that
+            # never got queued
+            job, queued = _start(store, key, user_id, username, video_path, frame_path, profile, speculative)
+        store.set_user_key(user_id, variant, key)
+        # Listeners follow the user's keys, let them know the key may have changed
+        events.publish(events.user_channel(user_id))
+    return job, queued
+
+
+def _put(job, user_id, variant, speculative):
+    """Put a job claimed by _claim() on the queue."""
+    _ensure_workers()
+    with _lock:
+        # Queue order is the order jobs are put in, see submit_with_preview()
+        job.sequence = next(_sequence)
+        if speculative:
+            SPECULATIVE_STATS['queued'] += 1
+    _queue.put((job.priority, job.sequence, job))
+    logger.info("Queued render", extra={
+        'key': job.key[:12], 'user': user_id, 'variant': variant, 'profile': job.profile['name'],
+        'speculative': speculative, 'queue_depth': _queue.qsize(),
+    })
+
+
+def _attach(key, user_id, speculative):
+    """The job already queued or running here for key (promoting it if need be), or None."""
+    with _lock:
+        job = JOBS.get(key)
+        if job is None or not job.is_active:
+            return None
+        if job.speculative and not speculative:
+            # Somebody is waiting for it now, move it up to normal priority
+            job.speculative = False
+            SPECULATIVE_STATS['promoted'] += 1
+            if not job.picked:
+                job.priority, job.sequence = PRIORITY_NORMAL, next(_sequence)
+                _queue.put((job.priority, job.sequence, job))
+            logger.info("Promoted speculative render", extra={'key': key[:12], 'user': user_id})
+        elif not speculative:
+            COALESCE_STATS['coalesced'] += 1
+        return job
+
+
+def _start(store, key, user_id, username, video_path, frame_path, profile, speculative):
+    """
+    New job for key: ready from the render cache, claimed in the job store
+    for this process to render, or followed in the process that already
+    has it. Returns (job, True if it has to be put on the queue).
+    """
+    cached_path = cache.lookup(key)
+    job = RenderJob(key, username, video_path, frame_path, profile, speculative)
+    if cached_path:
+        # Same inputs were rendered before, no encode needed. Already
+        # ready in the store is fine too, it points at the same file
+        store.transition(
+            key, (None, EXPIRED, FAILED), READY,
+            output_path=cached_path, progress=100, profile=profile['name'], error=''
+        )
+        job.status = READY
+        job.output_path = cached_path
+        job.finished_at = job.created_at
+        job.encoding.set()
+        job.done.set()
+        with _lock:
+            JOBS[key] = job
+        logger.info("Render cache hit", extra={'key': key[:12], 'user': user_id})
+        events.publish(events.key_channel(key))
+        _schedule_cleanup(key)
+        return job, False
+
+    if not speculative:
+        # Turn the request away (QueueFull) rather than queue past the limit
+        with _lock:
+            waiting = sum(1 for other in _waiting_jobs() if not other.speculative)
+        admission.admit(waiting)
+    if not store.enqueue(key, profile=profile['name']) and not _reclaim_stale(store, key, profile):
+        # Another process already has this render queued or encoding
+        state = store.get(key)
+        job.local = False
+        job.status = state['status'] if state is not None else QUEUED
+        with _lock:
+            COALESCE_STATS['coalesced'] += 1
+        logger.info("Render already running in another process",
+                    extra={'key': key[:12], 'user': user_id, 'status': job.status})
+        return job, False
+    with _lock:
+        JOBS[key] = job
+        job.sequence = next(_sequence)
+    return job, True
+
+
+def _submit_lock(key):
+    """Lock serializing submits (and expiry) of the render key."""
+    return _submit_locks[int(key[:8], 16) % len(_submit_locks)]
+
+
+def speculate(user_id, username):
+    """
+    Start rendering a new user's video right away (if RENDER_SPECULATIVE is
+    on) with the same settings the loading page will ask for, so it is done
+    or nearly done by the time the page polls. Returns the job, or None if
+    it was skipped.
+    """
+    if not getattr(settings, 'RENDER_SPECULATIVE', False):
+        return None
+    max_queue = getattr(settings, 'RENDER_SPECULATIVE_MAX_QUEUE', None) or worker_count()
+    if queue_depth() >= max_queue:
+        with _lock:
+            SPECULATIVE_STATS['dropped'] += 1
+        logger.info("Skipping speculative render", extra={'user': user_id, 'queue_depth': queue_depth()})
+        return None
+    fragmented = getattr(settings, 'RENDER_STREAMING', False)
+    return submit(user_id, username, choose_profile(), fragmented=fragmented, speculative=True,
+                  rendition=renditions.default_rendition())
+
+
+def _drop(job):
+    """Give up on a speculative job nobody asked for in time."""
+    jobstore.get_store().transition(job.key, (QUEUED,), EXPIRED)
+    job.status = EXPIRED
+    job.encoding.set()
+    job.done.set()
+    with _lock:
+        SPECULATIVE_STATS['dropped'] += 1
+    metrics.RENDERS.inc(outcome='dropped')
+    logger.info("Dropped speculative render, it waited too long", extra={'key': job.key[:12]})
+    events.publish(events.key_channel(job.key))
+    _schedule_cleanup(job.key)
+
+
+def _reclaim_stale(store, key, profile):
+    """
+    Take over a job another process left queued or encoding without any
+    update for RENDER_JOB_STALE_AFTER seconds (it most likely died with the
+    job). Returns True if the job is now queued for this process to run.
+    """
+    state = store.get(key)
+    stale_after = getattr(settings, 'RENDER_JOB_STALE_AFTER', 600)
+    if state is None or state['status'] not in jobstore.ACTIVE or time.time() - state['updated_at'] < stale_after:
+        return False
+    store.transition(key, jobstore.ACTIVE, FAILED, error="Render abandoned")
+    logger.warning("Reclaiming abandoned render", extra={'key': key[:12]})
+    return store.enqueue(key, profile=profile['name'])
+
+
+def submit_with_preview(user_id, username, profile_name=None, rendition=None, variant=FINAL):
+    """
+    Two-pass delivery: queue a quick low resolution preview ahead of the
+    full quality render (of rendition, as variant). Returns (preview_job,
+    final_job); preview_job is None when no RENDER_PREVIEW_PROFILE is
+    configured or the queue has no room left for it.
+    """
+    # Pick the final profile before the preview joins the queue, so the
+    # preview does not count towards the load based choice
+    final_profile_name = choose_profile(profile_name)
+    # The final render goes through admission first: a request turned away
+    # (QueueFull) leaves no preview behind in the queue
+    final_job, queued = _claim(user_id, username, final_profile_name, variant, rendition=rendition)
+    preview_job = None
+    try:
+        preview_name = preview_profile_name()
+        if preview_name and preview_name != final_profile_name:
+            try:
+                preview_job = submit(user_id, username, preview_name, PREVIEW)
+            except admission.QueueFull:
+                # The final render took the last place in the queue
+                logger.info("Skipping preview, the render queue is full", extra={'user': user_id})
+    finally:
+        if queued:
+            # Behind the preview
+            _put(final_job, user_id, variant, False)
+    return preview_job, final_job
+
+
+def coalesce_wait():
+    return getattr(settings, 'RENDER_COALESCE_WAIT', 60)
+
+
+def _check_remote(job):
+    """
+    Update a job running in another process from the job store. Returns
+    True once it is no longer queued or encoding.
+    """
+    state = jobstore.get_store().get(job.key)
+    if state is not None and state['status'] in jobstore.ACTIVE:
+        return False
+    if state is not None:
+        job.status = state['status']
+        job.output_path = state['output_path'] or None
+        job.error = state['error'] or None
+    return True
+
+
+def wait_for(job, timeout):
+    """
+    Single flight: block until job is no longer queued or encoding, or
+    timeout seconds have passed. Every request for the same render waits on
+    the same encode this way. Returns True if the job finished (ready or
+    failed) in time.
+    """
+    with _lock:
+        COALESCE_STATS['waits'] += 1
+    if job.local:
+        finished = job.done.wait(timeout)
+    else:
+        # Running in another process, follow it through the job store
+        deadline = time.time() + timeout
+        while True:
+            finished = _check_remote(job)
+            remaining = deadline - time.time()
+            if finished or remaining <= 0:
+                break
+            time.sleep(min(REMOTE_POLL_INTERVAL, remaining))
+    if not finished:
+        with _lock:
+            COALESCE_STATS['wait_timeouts'] += 1
+    return finished
+
+
+async def _wait_until(job, flag, timeout, poll_interval=None):
+    """
+    Sleep until flag() is true or timeout seconds have passed, waking up
+    whenever the job's key is published (and every poll_interval seconds,
+    if given). Returns flag().
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    subscription = events.Subscription()
+    subscription.listen([events.key_channel(job.key)])
+    try:
+        while True:
+            if await flag():
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            await subscription.wait(min(poll_interval or remaining, remaining))
+    finally:
+        subscription.close()
+
+
+async def wait_for_async(job, timeout):
+    """wait_for for async views: the request sleeps on the job's events instead of blocking a thread."""
+    with _lock:
+        COALESCE_STATS['waits'] += 1
+    if job.local:
+        async def finished():
+            return job.done.is_set()
+        done = await _wait_until(job, finished, timeout)
+    else:
+        # Another process's progress is not published here, poll the store
+        async def finished():
+            return await asyncio.to_thread(_check_remote, job)
+        done = await _wait_until(job, finished, timeout, REMOTE_POLL_INTERVAL)
+    if not done:
+        with _lock:
+            COALESCE_STATS['wait_timeouts'] += 1
+    return done
+
+
+async def wait_for_encoding(job, timeout):
+    """Async wait until a job of this process starts writing its output (or fails). Returns True if it did."""
+    async def started():
+        return job.encoding.is_set()
+    return await _wait_until(job, started, timeout)
+
+
+def _is_waiting(job):
+    """Queued in this process and not encoding yet."""
+    return job.local and job.status == QUEUED and job.sequence is not None
+
+
+def _waiting_jobs():
+    """This process's jobs that have not started encoding yet. Call with _lock held."""
+    return [job for job in JOBS.values() if _is_waiting(job)]
+
+
+def queue_position(key):
+    """
+    (position, seconds until it should start) of a render still waiting in
+    this process's queue, position 1 being next; None if it is not waiting
+    here. The time is None until an encode time is known.
+    """
+    with _lock:
+        job = JOBS.get(key)
+        if job is None or not _is_waiting(job):
+            return None
+        place = (job.priority, job.sequence)
+        ahead = sum(1 for other in _waiting_jobs() if (other.priority, other.sequence) < place)
+    return ahead + 1, admission.start_estimate(ahead, admission.slots_in_use())
+
+
+def stats():
+    with _lock:
+        return dict(
+            COALESCE_STATS, queue_depth=_queue.qsize(), speculative=dict(SPECULATIVE_STATS),
+            encode_slots=admission.slots_in_use(), max_encodes=admission.max_encodes(),
+        )
+
+
+def warm_up():
+    """
+    Resolve and probe the source assets, and build the precomposited base
+    video when RENDER_PRECOMPOSITE is on, ahead of the first render so the
+    first user does not pay for them. Run in the background by
+    start_warm_up() when a server process starts.
+    """
+    try:
+        video_path, frame_path = assets.resolve()
+        video_width, video_height, duration, fps = assets.video_info(video_path)
+        if render.precomposite_enabled():
+            render.ensure_base_video(video_path, frame_path, video_width, video_height)
+    except Exception:
+        logger.exception("Error preparing render assets")
+
+
+def start_warm_up():
+    """
+    Run warm_up() in a background thread, once per process. Called from the
+    server entry points (arda_website.wsgi and .asgi) rather than at app
+    loading, so management commands and tests don't probe the assets.
+    """
+    global _warm_up_thread
+    with _lock:
+        if _warm_up_thread is not None:
+            return
+        _warm_up_thread = threading.Thread(target=warm_up, name="render-warm-up")
+        _warm_up_thread.daemon = True
+        _warm_up_thread.start()
+
+
+def queue_depth():
+    return _queue.qsize()
+
+
+def _begin(job):
+    """Move a job from queued to encoding; False if it is no longer queued."""
+    key = job.key
+    if not jobstore.get_store().transition(key, (QUEUED,), ENCODING):
+        # Failed or expired while it was waiting in the queue
+        state = jobstore.get_store().get(key)
+        job.status = state['status'] if state is not None else EXPIRED
+        job.encoding.set()
+        job.done.set()
+        logger.info("Skipping render, it is no longer queued", extra={'key': key[:12], 'status': job.status})
+        return False
+    job.status = ENCODING
+    job.started_at = time.time()
+    metrics.RENDER_STAGE_SECONDS.observe(job.started_at - job.created_at, stage='queue')
+    logger.info("Starting render", extra={'key': key[:12], 'profile': job.profile['name']})
+    return True
+
+
+def _report_progress(key, value, speed=None, eta=None):
+    jobstore.get_store().set_progress(key, value, speed=speed, eta=eta)
+    events.publish(events.key_channel(key))
+
+
+def _prepare(job, temp_dir):
+    """
+    Everything before the encode: probe the source and build the overlay.
+    Returns the keyword arguments of render.encode_video but on_progress.
+    """
+    stage_seconds = metrics.RENDER_STAGE_SECONDS
+    with stage_seconds.time(stage='probe'):
+        video_width, video_height, duration, fps = assets.video_info(job.video_path)
+
+    # Render next to the overlay, then move the result into the cache
+    output_video_path = os.path.join(temp_dir, f"output_{job.key[:12]}.mp4")
+
+    overlay_started = time.perf_counter()
+    if render.precomposite_enabled():
+        # Frame is already burned into the base video, only the small
+        # username sprite has to be blended per frame
+        source_path = render.ensure_base_video(job.video_path, job.frame_path, video_width, video_height)
+        overlay, position = render.build_sprite(job.username, video_width, video_height)
+    else:
+        # The frame image with username, handed to ffmpeg in memory
+        source_path = job.video_path
+        position = None
+        overlay = render.build_overlay(job.frame_path, job.username, video_width, video_height)
+    stage_seconds.observe(time.perf_counter() - overlay_started, stage='overlay')
+
+    # Create the output up front so followers can open it straight away;
+    # ffmpeg truncates and writes the same file
+    open(output_video_path, 'wb').close()
+    job.partial_path = output_video_path
+    job.encoding.set()
+    # Streaming requests wait for this, see wait_for_encoding()
+    events.publish(events.key_channel(job.key))
+    return {
+        'video_path': source_path, 'overlay': overlay, 'output_video_path': output_video_path,
+        'duration': duration, 'position': position, 'profile': job.profile,
+        'height': render.output_height(job.profile, video_height),
+    }
+
+
+def _complete(job, encode_args, encode_seconds):
+    """Everything after a successful encode: move the video into the cache and mark the job ready."""
+    key = job.key
+    duration = encode_args['duration']
+    stage_seconds = metrics.RENDER_STAGE_SECONDS
+    stage_seconds.observe(encode_seconds, stage='encode')
+    if job.profile['name'] != preview_profile_name():
+        # Previews are much quicker and would skew the queue estimates
+        admission.record_encode(encode_seconds)
+    if encode_seconds > 0 and duration:
+        metrics.ENCODE_SPEED.observe(duration / encode_seconds)
+
+    with stage_seconds.time(stage='store'):
+        cached_path = cache.store(key, encode_args['output_video_path'])
+    job.output_path = cached_path
+
+    # Ensure progress is set to 100% when complete
+    jobstore.get_store().transition(key, (ENCODING,), READY, output_path=cached_path, progress=100)
+    job.status = READY
+    metrics.RENDERS.inc(outcome='ready')
+    logger.info("Render completed", extra={
+        'key': key[:12], 'encode_seconds': round(encode_seconds, 3),
+        'speed': round(duration / encode_seconds, 2) if encode_seconds > 0 and duration else None,
+    })
+    if hls.enabled() and job.profile['name'] != preview_profile_name():
+        # Have the package ready before the playlist is asked for
+        hls.package_later(key)
+
+    # Start cleanup thread after successful generation
+    _schedule_cleanup(key)
+
+
+def _fail(job, e):
+    job.status = FAILED
+    job.error = f"Error in processing video: {str(e)}"
+    metrics.RENDERS.inc(outcome='failed')
+    logger.error("Render failed", exc_info=e, extra={'key': job.key[:12]})
+    jobstore.get_store().transition(job.key, (ENCODING,), FAILED, error=job.error)
+    # Keep the error around for the progress page for a while, like a video
+    _schedule_cleanup(job.key)
+
+
+def _finish(job, temp_dir):
+    # The frame and any partial output are not needed any more
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    job.finished_at = time.time()
+    metrics.RENDER_STAGE_SECONDS.observe(job.finished_at - job.created_at, stage='total')
+    job.encoding.set()
+    job.done.set()
+    events.publish(events.key_channel(job.key))
+
+
+def run_job(job):
+    """Run the overlay + encode pipeline for a job. Called from a worker thread."""
+    if not _begin(job):
+        return
+
+    def on_progress(value, speed=None, eta=None, **stats):
+        _report_progress(job.key, value, speed=speed, eta=eta)
+
+    # Create temp directory for the intermediate files
+    temp_dir = janitor.temp_dir()
+    try:
+        encode_args = _prepare(job, temp_dir)
+        encode_started = time.perf_counter()
+        # Long videos can be encoded in parallel segments (RENDER_PARALLEL)
+        encode = segments.encode_video if segments.enabled(job.profile) else render.encode_video
+        encode(on_progress=on_progress, **encode_args)
+        _complete(job, encode_args, time.perf_counter() - encode_started)
+    except Exception as e:
+        _fail(job, e)
+    finally:
+        _finish(job, temp_dir)
+
+
+async def run_job_async(job):
+    """
+    run_job on the render loop (RENDER_ASYNC). ffmpeg is supervised by the
+    loop itself; the short blocking steps around it (job store, probing,
+    drawing the overlay, moving the result into the cache) run in threads.
+    """
+    if not await asyncio.to_thread(_begin, job):
+        return
+
+    def on_progress(value, speed=None, eta=None, **stats):
+        # Job store writes block (and the database store can not be used on
+        # an event loop at all); one thread writes them for every job, in order
+        _progress_writer.submit(_report_progress, job.key, value, speed=speed, eta=eta)
+
+    temp_dir = await asyncio.to_thread(janitor.temp_dir)
+    try:
+        encode_args = await asyncio.to_thread(_prepare, job, temp_dir)
+        encode_started = time.perf_counter()
+        encode = segments.encode_video_async if segments.enabled(job.profile) else render.encode_video_async
+        await encode(on_progress=on_progress, **encode_args)
+        encode_seconds = time.perf_counter() - encode_started
+        # Let the last progress reports land before the job is marked ready
+        await asyncio.wrap_future(_progress_writer.submit(lambda: None))
+        await asyncio.to_thread(_complete, job, encode_args, encode_seconds)
+    except Exception as e:
+        await asyncio.to_thread(_fail, job, e)
+    finally:
+        await asyncio.to_thread(_finish, job, temp_dir)
+
+
+def follow_output(job, chunk_size=64 * 1024, poll_interval=0.1):
+    """
+    Iterator over the bytes of a running job's output as ffmpeg writes them,
+    until the job is done. The file is opened right away (raising OSError if
+    the job already moved it into the cache) and stays readable through the
+    open handle after the job moves it and removes its temp dir.
+    """
+    f = open(job.partial_path, 'rb')
+
+    def chunks():
+        try:
+            while True:
+                chunk = f.read(chunk_size)
+                if chunk:
+                    metrics.BYTES_SERVED.inc(len(chunk), mode='stream')
+                    yield chunk
+                    continue
+                if job.done.is_set():
+                    # Drain whatever was written between the last read and the end
+                    chunk = f.read(chunk_size)
+                    while chunk:
+                        metrics.BYTES_SERVED.inc(len(chunk), mode='stream')
+                        yield chunk
+                        chunk = f.read(chunk_size)
+                    break
+                time.sleep(poll_interval)
+        finally:
+            f.close()
+
+    return chunks()
+
+
+def follow_output_async(job, chunk_size=64 * 1024, poll_interval=0.1):
+    """follow_output as an async iterator, for streaming responses on the ASGI server."""
+    f = open(job.partial_path, 'rb')
+
+    async def chunks():
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if chunk:
+                    metrics.BYTES_SERVED.inc(len(chunk), mode='stream')
+                    yield chunk
+                    continue
+                if job.done.is_set():
+                    # Drain whatever was written between the last read and the end
+                    chunk = await asyncio.to_thread(f.read, chunk_size)
+                    while chunk:
+                        metrics.BYTES_SERVED.inc(len(chunk), mode='stream')
+                        yield chunk
+                        chunk = await asyncio.to_thread(f.read, chunk_size)
+                    break
+                await asyncio.sleep(poll_interval)
+        finally:
+            f.close()
+
+    return chunks()
+
+
+def _schedule_cleanup(key):
+    janitor.schedule(key, CLEANUP_DELAY)
+
+
+def expire(keys):
+    """
+    Forget finished (ready, failed or dropped) jobs, called by the janitor
+    once CLEANUP_DELAY has passed: they are removed from JOBS and from the
+    job store, with the users pointing at them. The videos stay in the
+    render cache until cache.prune() decides they are stale, and a later
+    request turns the job ready again. Returns how many jobs were expired.
+    """
+    store = jobstore.get_store()
+    expired = 0
+    for key in keys:
+        # Not while a submit of the same render is deciding what to do
+        with _submit_lock(key):
+            with _lock:
+                job = JOBS.get(key)
+                if job is not None and not job.is_active:
+                    del JOBS[key]
+            # Only if nobody queued it again in the meantime
+            if store.delete(key, jobstore.FINISHED):
+                store.delete_user_keys(key)
+                expired += 1
+    return expired
+
+
+metrics.QUEUE_DEPTH.set_function(queue_depth)
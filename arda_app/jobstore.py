@@ -0,0 +1,421 @@
+"""
+Shared render job state.
+
+The status, progress and output of every render, and which render each user
+is waiting for, live in a JobStore instead of module-level dicts, so several
+gunicorn workers (or threads) see one consistent view.
+
+Every job follows one state machine:
+
+    queued -> encoding -> ready -> expired
+       |         |
+       +---------+-----> failed
+
+failed and expired jobs can be queued again, and a job can be created
+directly as ready (render cache hit) or go from expired back to ready.
+Transitions are compare-and-set: transition() only succeeds if the job is
+still in one of the expected states, so two workers can never both pick
+up, finish or expire the same job.
+
+Backends, picked with settings.RENDER_JOB_STORE:
+    'memory'    in-process dicts; fine for a single process
+    'sqlite'    a local SQLite file (RENDER_JOB_STORE_PATH) shared by all
+                processes on the machine
+    'database'  the Django database (RenderJobState / UserRenderKey models)
+A dotted path to a JobStore subclass works too.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+QUEUED = "queued"
+ENCODING = "encoding"
+READY = "ready"
+EXPIRED = "expired"
+FAILED = "failed"
+
+ACTIVE = (QUEUED, ENCODING)
+# Done one way or the other, left for the janitor to clean up
+FINISHED = (READY, FAILED, EXPIRED)
+
+# state -> states it may move to; None is "no job yet"
+TRANSITIONS = {
+    None: {QUEUED, READY},
+    QUEUED: {ENCODING, FAILED, EXPIRED},
+    ENCODING: {READY, FAILED},
+    READY: {EXPIRED, QUEUED},
+    EXPIRED: {QUEUED, READY},
+    FAILED: {QUEUED, READY},
+}
+
+# Fields kept for every job. speed (x realtime) and eta (seconds left as of
+# updated_at) are reported by ffmpeg while the job is encoding, None otherwise
+FIELDS = ('status', 'progress', 'output_path', 'error', 'profile', 'speed', 'eta', 'updated_at')
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+def check_transition(from_states, to_state):
+    for from_state in from_states:
+        if to_state not in TRANSITIONS[from_state]:
+            raise InvalidTransition(f"Render job cannot go from {from_state} to {to_state}")
+
+
+def new_record(status, **fields):
+    record = {
+        'status': status,
+        'progress': 100 if status == READY else 0,
+        'output_path': '',
+        'error': '',
+        'profile': '',
+        'speed': None,
+        'eta': None,
+        'updated_at': time.time(),
+    }
+    record.update(fields)
+    return record
+
+
+class JobStore:
+    """
+    Interface of a job state backend. Records are plain dicts with the keys
+    in FIELDS; the render cache key identifies the job.
+    """
+
+    def get(self, key):
+        """Record for key, or None."""
+        raise NotImplementedError
+
+    def transition(self, key, from_states, to_state, **fields):
+        """
+        Atomically move key from one of from_states (None meaning "no job
+        yet") to to_state, updating fields. Returns False if the job was
+        not in any of from_states.
+        """
+        raise NotImplementedError
+
+    def set_progress(self, key, progress, speed=None, eta=None):
+        """Update the progress (and encode speed and ETA, if known) of an encoding job."""
+        raise NotImplementedError
+
+    def delete(self, key, from_states=None):
+        """
+        Remove the record for key, only if its status is one of from_states
+        when they are given. Returns True if a record was removed.
+        """
+        raise NotImplementedError
+
+    def keys_with_status(self, status):
+        """[(key, updated_at), ...] of every job in status."""
+        raise NotImplementedError
+
+    def set_user_key(self, user_id, variant, key):
+        raise NotImplementedError
+
+    def get_user_key(self, user_id, variant):
+        raise NotImplementedError
+
+    def delete_user_keys(self, key):
+        """Forget every user mapping pointing at key."""
+        raise NotImplementedError
+
+    def enqueue(self, key, **fields):
+        """
+        Move key into queued unless it is already queued or encoding.
+        Returns True if the caller queued it (and so has to run it).
+        """
+        return self.transition(
+            key, (None, READY, EXPIRED, FAILED), QUEUED, **dict(fields, progress=0, error='', speed=None, eta=None)
+        )
+
+
+class MemoryJobStore(JobStore):
+    """Job state in this process only."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.user_keys = {}
+
+    def get(self, key):
+        with self.lock:
+            record = self.jobs.get(key)
+            return dict(record) if record is not None else None
+
+    def transition(self, key, from_states, to_state, **fields):
+        check_transition(from_states, to_state)
+        with self.lock:
+            record = self.jobs.get(key)
+            current = record['status'] if record is not None else None
+            if current not in from_states:
+                return False
+            if record is None:
+                self.jobs[key] = new_record(to_state, **fields)
+            else:
+                record.update(fields, status=to_state, updated_at=time.time())
+            return True
+
+    def set_progress(self, key, progress, speed=None, eta=None):
+        with self.lock:
+            record = self.jobs.get(key)
+            if record is not None and record['status'] == ENCODING:
+                record.update(progress=progress, speed=speed, eta=eta, updated_at=time.time())
+
+    def delete(self, key, from_states=None):
+        with self.lock:
+            record = self.jobs.get(key)
+            if record is None or (from_states is not None and record['status'] not in from_states):
+                return False
+            del self.jobs[key]
+            return True
+
+    def keys_with_status(self, status):
+        with self.lock:
+            return [(key, r['updated_at']) for key, r in self.jobs.items() if r['status'] == status]
+
+    def set_user_key(self, user_id, variant, key):
+        with self.lock:
+            self.user_keys[(user_id, variant)] = key
+
+    def get_user_key(self, user_id, variant):
+        return self.user_keys.get((user_id, variant))
+
+    def delete_user_keys(self, key):
+        with self.lock:
+            for user_key in [u for u, k in self.user_keys.items() if k == key]:
+                del self.user_keys[user_key]
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Job state in a SQLite file, shared by every process on the machine.
+    Each thread gets its own connection; transitions run inside
+    BEGIN IMMEDIATE so the read and the write are one atomic step. Plain
+    reads run in autocommit mode and never take the write lock.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'RENDER_JOB_STORE_PATH', None) or os.path.join(
+            tempfile.gettempdir(), 'arda_render_jobs.sqlite3'
+        )
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS render_jobs ("
+                " key TEXT PRIMARY KEY, status TEXT NOT NULL, progress REAL NOT NULL DEFAULT 0,"
+                " output_path TEXT NOT NULL DEFAULT '', error TEXT NOT NULL DEFAULT '',"
+                " profile TEXT NOT NULL DEFAULT '', speed REAL, eta REAL, updated_at REAL NOT NULL)"
+            )
+            # Files created before speed and eta were tracked
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(render_jobs)")}
+            for column in ('speed', 'eta'):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE render_jobs ADD COLUMN {column} REAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS render_user_keys ("
+                " user_id TEXT NOT NULL, variant TEXT NOT NULL, key TEXT NOT NULL,"
+                " PRIMARY KEY (user_id, variant))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS render_user_keys_key ON render_user_keys (key)")
+
+    def reader(self):
+        """This thread's connection, in autocommit mode: each statement is its own read transaction."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            # Readers do not block the writer (and the other way round)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def connection(self):
+        """This thread's connection inside a write transaction, for use with 'with'."""
+        return _Transaction(self.reader())
+
+    def get(self, key):
+        row = self.reader().execute(
+            f"SELECT {', '.join(FIELDS)} FROM render_jobs WHERE key = ?",
+            (key,)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def transition(self, key, from_states, to_state, **fields):
+        check_transition(from_states, to_state)
+        with self.connection() as conn:
+            row = conn.execute("SELECT status FROM render_jobs WHERE key = ?", (key,)).fetchone()
+            current = row['status'] if row is not None else None
+            if current not in from_states:
+                return False
+            if row is None:
+                record = new_record(to_state, **fields)
+                conn.execute(
+                    f"INSERT INTO render_jobs (key, {', '.join(FIELDS)}) VALUES (?{', ?' * len(FIELDS)})",
+                    (key, *(record[field] for field in FIELDS))
+                )
+            else:
+                fields = dict(fields, status=to_state, updated_at=time.time())
+                assignments = ", ".join(f"{field} = ?" for field in fields)
+                conn.execute(
+                    f"UPDATE render_jobs SET {assignments} WHERE key = ?",
+                    (*fields.values(), key)
+                )
+            return True
+
+    def set_progress(self, key, progress, speed=None, eta=None):
+        with self.connection() as conn:
+            conn.execute(
+                "UPDATE render_jobs SET progress = ?, speed = ?, eta = ?, updated_at = ? WHERE key = ? AND status = ?",
+                (progress, speed, eta, time.time(), key, ENCODING)
+            )
+
+    def delete(self, key, from_states=None):
+        with self.connection() as conn:
+            if from_states is None:
+                cursor = conn.execute("DELETE FROM render_jobs WHERE key = ?", (key,))
+            else:
+                placeholders = ', '.join('?' * len(from_states))
+                cursor = conn.execute(
+                    f"DELETE FROM render_jobs WHERE key = ? AND status IN ({placeholders})", (key, *from_states)
+                )
+            return cursor.rowcount > 0
+
+    def keys_with_status(self, status):
+        rows = self.reader().execute("SELECT key, updated_at FROM render_jobs WHERE status = ?", (status,)).fetchall()
+        return [(row['key'], row['updated_at']) for row in rows]
+
+    def set_user_key(self, user_id, variant, key):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO render_user_keys (user_id, variant, key) VALUES (?, ?, ?)",
+                (user_id, variant, key)
+            )
+
+    def get_user_key(self, user_id, variant):
+        row = self.reader().execute(
+            "SELECT key FROM render_user_keys WHERE user_id = ? AND variant = ?",
+            (user_id, variant)
+        ).fetchone()
+        return row['key'] if row is not None else None
+
+    def delete_user_keys(self, key):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM render_user_keys WHERE key = ?", (key,))
+
+
+class _Transaction:
+    """Context manager running a block in BEGIN IMMEDIATE ... COMMIT."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+class DatabaseJobStore(JobStore):
+    """Job state in the Django database, shared by every instance using it."""
+
+    def get(self, key):
+        from arda_app.models import RenderJobState
+
+        values = RenderJobState.objects.filter(key=key).values(*FIELDS).first()
+        if values is not None:
+            values['updated_at'] = values['updated_at'].timestamp()
+        return values
+
+    def transition(self, key, from_states, to_state, **fields):
+        from django.db import IntegrityError, transaction
+        from django.utils import timezone
+        from arda_app.models import RenderJobState
+
+        check_transition(from_states, to_state)
+        existing = [state for state in from_states if state is not None]
+        updated = RenderJobState.objects.filter(key=key, status__in=existing).update(
+            status=to_state, updated_at=timezone.now(), **fields
+        ) if existing else 0
+        if updated:
+            return True
+        if None not in from_states:
+            return False
+        record = new_record(to_state, **fields)
+        record['updated_at'] = timezone.now()
+        try:
+            with transaction.atomic():
+                RenderJobState.objects.create(key=key, **record)
+            return True
+        except IntegrityError:
+            # Somebody else created it first
+            return False
+
+    def set_progress(self, key, progress, speed=None, eta=None):
+        from django.utils import timezone
+        from arda_app.models import RenderJobState
+
+        RenderJobState.objects.filter(key=key, status=ENCODING).update(
+            progress=progress, speed=speed, eta=eta, updated_at=timezone.now()
+        )
+
+    def delete(self, key, from_states=None):
+        from arda_app.models import RenderJobState
+
+        records = RenderJobState.objects.filter(key=key)
+        if from_states is not None:
+            records = records.filter(status__in=from_states)
+        deleted, _ = records.delete()
+        return deleted > 0
+
+    def keys_with_status(self, status):
+        from arda_app.models import RenderJobState
+
+        rows = RenderJobState.objects.filter(status=status).values_list('key', 'updated_at')
+        return [(key, updated_at.timestamp()) for key, updated_at in rows]
+
+    def set_user_key(self, user_id, variant, key):
+        from arda_app.models import UserRenderKey
+
+        UserRenderKey.objects.update_or_create(user_id=user_id, variant=variant, defaults={'key': key})
+
+    def get_user_key(self, user_id, variant):
+        from arda_app.models import UserRenderKey
+
+        return UserRenderKey.objects.filter(user_id=user_id, variant=variant).values_list('key', flat=True).first()
+
+    def delete_user_keys(self, key):
+        from arda_app.models import UserRenderKey
+
+        UserRenderKey.objects.filter(key=key).delete()
+
+
+BACKENDS = {
+    'memory': MemoryJobStore,
+    'sqlite': SQLiteJobStore,
+    'database': DatabaseJobStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The configured JobStore, created on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = getattr(settings, 'RENDER_JOB_STORE', 'memory')
+                store_class = BACKENDS.get(backend) or import_string(backend)
+                _store = store_class()
+    return _store
@@ -0,0 +1,57 @@
+"""
+Structured log output for the app's loggers (configured in settings.LOGGING).
+
+Log calls pass their data as fields instead of formatting it into the
+message, e.g.
+
+    logger.info("Queued render", extra={'key': key[:12], 'queue_depth': 3})
+
+and the formatter writes one line per record, either as logfmt
+
+    ts=2025-04-01T12:00:00.123Z level=info logger=arda_app.jobs msg="Queued render" key=3f2a... queue_depth=3
+
+or, with LOG_FORMAT=json, as a JSON object with the same keys.
+"""
+import json
+import logging
+import time
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+def record_fields(record):
+    """The extra= fields of a record."""
+    return {name: value for name, value in vars(record).items() if name not in _RECORD_ATTRIBUTES}
+
+
+def _logfmt_value(value):
+    text = str(value)
+    if not text or any(c in text for c in ' "=\n'):
+        return json.dumps(text)
+    return text
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as logfmt (output='logfmt') or JSON lines (output='json')."""
+
+    def __init__(self, output='logfmt', **kwargs):
+        super().__init__(**kwargs)
+        self.output = output
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z'
+
+    def format(self, record):
+        fields = {
+            'ts': self.formatTime(record),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        fields.update(record_fields(record))
+        if record.exc_info:
+            fields['exc'] = self.formatException(record.exc_info)
+        if self.output == 'json':
+            return json.dumps(fields, default=str)
+        return ' '.join(f'{name}={_logfmt_value(value)}' for name, value in fields.items())
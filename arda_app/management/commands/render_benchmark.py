@@ -0,0 +1,326 @@
+"""
+Offline benchmark of the render pipeline.
+
+Builds synthetic source videos with ffmpeg's lavfi testsrc (so the real
+liolio.mp4 is not needed), then runs the same steps as a download in
+views.home for each of them, timing every stage:
+
+    db        looking up the username (only with --db: benchmark users are
+              created in the configured database and removed afterwards)
+    resolve   finding the source assets (assets.resolve; skipped if the
+              real assets are not there)
+    cache_key hashing the assets into the render cache key
+    probe     ffprobe of the source video
+    overlay   drawing the username on the frame (PIL)
+    encode    the ffmpeg overlay + encode
+    serve     streaming the result through serving.serve_file
+
+The renders run directly on a thread pool, not through the job queue, so
+RENDER_WORKERS does not cap the concurrency levels and nothing is cached
+between renders. Results are written as JSON; pass an earlier result as
+--baseline to compare against it (and --max-regression to fail on a
+slowdown).
+
+    python manage.py render_benchmark --resolutions 640x360,1280x720 \\
+        --durations 5 --concurrency 1,2,4 --output bench.json
+"""
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+
+from arda_app import assets
+from arda_app import cache
+from arda_app import render
+from arda_app import segments
+from arda_app import serving
+from arda_app.models import UserList, bulk_create_users
+
+STAGES = ('db', 'resolve', 'cache_key', 'probe', 'overlay', 'encode', 'serve')
+
+FRAME_PATH = os.path.join(render.BASE_DIR, 'static', 'image', 'frame.png')
+
+
+def parse_list(value, convert):
+    return [convert(item) for item in value.split(',') if item.strip()]
+
+
+def parse_resolution(value):
+    width, _, height = value.strip().partition('x')
+    return int(width), int(height)
+
+
+def build_source(directory, width, height, duration, fps=25):
+    """A testsrc video with a sine tone, like the real source (video + audio track)."""
+    path = os.path.join(directory, f"testsrc_{width}x{height}_{duration}s.mp4")
+    if not os.path.exists(path):
+        partial_path = path + '.part.mp4'
+        subprocess.run([
+            'ffmpeg', '-y',
+            '-f', 'lavfi', '-i', f'testsrc=size={width}x{height}:rate={fps}:duration={duration}',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+            '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-shortest',
+            '-loglevel', 'error',
+            partial_path
+        ], check=True, stdout=subprocess.DEVNULL)
+        os.replace(partial_path, path)
+    return path
+
+
+def summarize(values):
+    """min / mean / p50 / p95 / max of a list of seconds."""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+    return {
+        'min': round(ordered[0], 4),
+        'mean': round(sum(ordered) / len(ordered), 4),
+        'p50': round(percentile(50), 4),
+        'p95': round(percentile(95), 4),
+        'max': round(ordered[-1], 4),
+    }
+
+
+@contextlib.contextmanager
+def quiet_logs():
+    """Only warnings and errors from the pipeline, which logs every render."""
+    logger = logging.getLogger('arda_app')
+    level = logger.level
+    logger.setLevel(max(level, logging.WARNING))
+    try:
+        yield
+    finally:
+        logger.setLevel(level)
+
+
+def ffmpeg_version():
+    try:
+        output = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout
+    except OSError:
+        return None
+    return output.splitlines()[0] if output else None
+
+
+class Command(BaseCommand):
+    help = "Benchmark the overlay + encode pipeline on synthetic videos and report per-stage timings."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolutions', default='640x360,1280x720',
+                            help="Comma separated WIDTHxHEIGHT of the synthetic videos")
+        parser.add_argument('--durations', default='5',
+                            help="Comma separated video lengths in seconds")
+        parser.add_argument('--concurrency', default='1,2,4',
+                            help="Comma separated numbers of renders running at once")
+        parser.add_argument('--renders', type=int, default=None,
+                            help="Renders per concurrency level (default: 2 x the level)")
+        parser.add_argument('--profile', default=None,
+                            help="Encoder profile (default: RENDER_DEFAULT_PROFILE)")
+        parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'arda_render_benchmark'),
+                            help="Where the synthetic videos are kept between runs")
+        parser.add_argument('--output', default=None,
+                            help="Write the results as JSON to this file")
+        parser.add_argument('--baseline', default=None,
+                            help="Earlier JSON results to compare against")
+        parser.add_argument('--max-regression', type=float, default=None,
+                            help="Fail if the mean encode time or throughput is this many percent worse than the baseline")
+        parser.add_argument('--db', action='store_true',
+                            help="Time the username lookup too; creates benchmark users in the configured "
+                                 "database (removed afterwards)")
+
+    def handle(self, *args, **options):
+        resolutions = parse_list(options['resolutions'], parse_resolution)
+        durations = parse_list(options['durations'], float)
+        levels = parse_list(options['concurrency'], int)
+        profile_name = options['profile'] or render.default_profile_name()
+        if profile_name not in render.encoder_profiles():
+            raise CommandError(f"Unknown encoder profile {profile_name!r}")
+        profile = render.get_profile(profile_name)
+        if shutil.which('ffmpeg') is None:
+            raise CommandError("ffmpeg is not on the PATH")
+
+        os.makedirs(options['workdir'], exist_ok=True)
+        total_renders = sum(options['renders'] or 2 * level for level in levels) * len(resolutions) * len(durations)
+        users = []
+        if options['db']:
+            # One user per render, each with its own name, so every render is
+            # a real encode
+            users = bulk_create_users([
+                {'name': f"Benchmark {i}", 'mood': 'benchmark', 'genre': 'benchmark'}
+                for i in range(total_renders)
+            ])
+
+        results = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'ffmpeg': ffmpeg_version(),
+            'profile': profile,
+            'overlay_version': render.OVERLAY_VERSION,
+            'precomposite': render.precomposite_enabled(),
+            'backend': render.render_backend(),
+            'parallel': segments.enabled(profile),
+            'cases': [],
+        }
+        renders_done = 0
+        try:
+            for width, height in resolutions:
+                for duration in durations:
+                    self.stdout.write(f"Building {width}x{height} {duration:g}s test video")
+                    video_path = build_source(options['workdir'], width, height, duration)
+                    for level in levels:
+                        count = options['renders'] or 2 * level
+                        case_users = users[renders_done:renders_done + count]
+                        renders_done += count
+                        case = self.run_case(video_path, width, height, duration, level, count, profile, case_users)
+                        results['cases'].append(case)
+                        self.report(case)
+        finally:
+            if users:
+                UserList.objects.filter(id__in=users).delete()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['max_regression'])
+
+    def run_case(self, video_path, width, height, duration, level, count, profile, users):
+        """count renders of video_path, level at a time."""
+        factory = RequestFactory()
+        timings = {stage: [] for stage in STAGES}
+        base_path = None
+        if render.precomposite_enabled():
+            # Built once per source like in production, so not part of any render's timings
+            with quiet_logs():
+                base_path = render.ensure_base_video(video_path, FRAME_PATH, width, height)
+
+        def one_render(index):
+            stage_times = {}
+            username = f"Benchmark {index}"
+            if users:
+                started = time.perf_counter()
+                username = UserList.objects.values_list('name', flat=True).get(id=users[index])
+                stage_times['db'] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            try:
+                assets.resolve()
+            except FileNotFoundError:
+                pass
+            else:
+                stage_times['resolve'] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            key = cache.render_key(username, FRAME_PATH, video_path, profile, render.overlay_signature())
+            stage_times['cache_key'] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            video_width, video_height, video_duration, fps = render.probe_video(video_path)
+            stage_times['probe'] = time.perf_counter() - started
+
+            temp_dir = tempfile.mkdtemp(prefix='arda_render_benchmark_')
+            try:
+                started = time.perf_counter()
+                if base_path:
+                    overlay, position = render.build_sprite(username, video_width, video_height)
+                else:
+                    overlay, position = render.build_overlay(FRAME_PATH, username, video_width, video_height), None
+                stage_times['overlay'] = time.perf_counter() - started
+
+                output_path = os.path.join(temp_dir, f"output_{key[:12]}.mp4")
+                started = time.perf_counter()
+                encode = segments.encode_video if segments.enabled(profile) else render.encode_video
+                encode(
+                    base_path or video_path, overlay, output_path, video_duration, lambda progress, **stats: None,
+                    position=position, profile=profile, height=render.output_height(profile, video_height)
+                )
+                stage_times['encode'] = time.perf_counter() - started
+
+                started = time.perf_counter()
+                response = serving.serve_file(factory.get('/'), output_path, 'benchmark.mp4')
+                for _ in response:
+                    pass
+                response.close()
+                stage_times['serve'] = time.perf_counter() - started
+                stage_times['output_bytes'] = os.path.getsize(output_path)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            return stage_times
+
+        with quiet_logs():
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=level) as executor:
+                renders = list(executor.map(one_render, range(count)))
+            wall = time.perf_counter() - started
+
+        for stage_times in renders:
+            for stage in STAGES:
+                if stage_times.get(stage) is not None:
+                    timings[stage].append(stage_times[stage])
+
+        return {
+            'resolution': f"{width}x{height}",
+            'duration': duration,
+            'concurrency': level,
+            'renders': count,
+            'wall_seconds': round(wall, 3),
+            'renders_per_minute': round(count / wall * 60, 2),
+            'output_bytes': round(sum(r['output_bytes'] for r in renders) / len(renders)),
+            'stages': {stage: summarize(values) for stage, values in timings.items()},
+        }
+
+    def report(self, case):
+        self.stdout.write(
+            f"{case['resolution']} {case['duration']:g}s x{case['concurrency']}: "
+            f"{case['renders']} renders in {case['wall_seconds']:.1f}s, "
+            f"{case['renders_per_minute']:.1f} renders/min"
+        )
+        for stage in STAGES:
+            summary = case['stages'][stage]
+            if summary is None:
+                continue
+            self.stdout.write(
+                f"    {stage:<9} mean {summary['mean'] * 1000:9.1f} ms"
+                f"   p50 {summary['p50'] * 1000:9.1f} ms   p95 {summary['p95'] * 1000:9.1f} ms"
+            )
+
+    def compare(self, results, baseline_path, max_regression):
+        """Print the change against an earlier run; fail past max_regression percent."""
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        previous = {
+            (case['resolution'], case['duration'], case['concurrency']): case
+            for case in baseline.get('cases', [])
+        }
+        regressions = []
+        for case in results['cases']:
+            before = previous.get((case['resolution'], case['duration'], case['concurrency']))
+            if before is None:
+                continue
+            throughput_change = (case['renders_per_minute'] / before['renders_per_minute'] - 1) * 100
+            encode_change = (case['stages']['encode']['mean'] / before['stages']['encode']['mean'] - 1) * 100
+            self.stdout.write(
+                f"{case['resolution']} {case['duration']:g}s x{case['concurrency']}: "
+                f"throughput {throughput_change:+.1f}%, encode time {encode_change:+.1f}%"
+            )
+            if max_regression is not None and (throughput_change < -max_regression or encode_change > max_regression):
+                regressions.append(f"{case['resolution']} {case['duration']:g}s x{case['concurrency']}")
+        if regressions:
+            raise CommandError(f"Slower than {baseline_path} by more than {max_regression:g}%: {', '.join(regressions)}")
@@ -0,0 +1,218 @@
+"""
+In-process counters, gauges and histograms, served in the Prometheus text
+format at /metrics (see views.metrics).
+
+Updating a metric is a dict update under a lock, cheap enough for the
+render and serving hot paths. Values live in the process that recorded
+them: with several gunicorn workers, scrape each worker (or run one worker
+per container) rather than the load-balanced URL.
+
+Settings:
+    METRICS_ENABLED  serve /metrics at all (default: True)
+    METRICS_TOKEN    scrapes need "Authorization: Bearer <token>"; staff
+                     users logged in to the site get in without it
+    METRICS_PUBLIC   with no METRICS_TOKEN set, serve /metrics and
+                     /cache-stats/ to anyone (default: False, staff only)
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; renders take from well under a second (cache hits, previews) to
+# minutes (full encodes of long videos)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    """A named metric with optional labels; every label combination is one series."""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """[(suffix, label values, extra labels, value), ...] for the exposition."""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def expose(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from function() at scrape time."""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Read the (unlabelled) value from function() on every scrape."""
+        self.function = function
+
+    @contextmanager
+    def track(self, **labels):
+        """+1 while the block runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [('', (), (), self.function())]
+            except Exception:
+                return []
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (not cumulative), sum, count
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block took, in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', key, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), count))
+        return samples
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+RENDER_STAGE_SECONDS = Histogram(
+    'arda_render_stage_seconds',
+    'Time spent in each stage of a render (queue, probe, overlay, encode, store, total).',
+    ['stage'],
+)
+RENDERS = Counter('arda_renders_total', 'Finished renders by outcome (ready, failed, dropped).', ['outcome'])
+QUEUE_DEPTH = Gauge('arda_render_queue_depth', 'Render jobs waiting for a worker.')
+ENCODE_SLOTS = Gauge('arda_encode_slots_in_use', 'Encode slots taken (see RENDER_MAX_ENCODES).')
+ADMISSION_REJECTIONS = Counter(
+    'arda_render_rejections_total',
+    'Render requests turned away with 429 because the render queue was full.',
+)
+FFMPEG_PROCESSES = Gauge('arda_ffmpeg_processes', 'ffmpeg processes currently running.')
+ENCODE_SPEED = Histogram(
+    'arda_encode_speed_ratio',
+    'Encode speed as a multiple of realtime (seconds of video per second of encoding).',
+    buckets=(0.25, 0.5, 1, 1.5, 2, 3, 4, 6, 8, 12, 16, 32),
+)
+CACHE_EVENTS = Counter(
+    'arda_render_cache_events_total',
+    'Render cache lookups and moves (hits, misses, promotions, demotions, evictions).',
+    ['event'],
+)
+BYTES_SERVED = Counter(
+    'arda_bytes_served_total',
+    'Video bytes sent to clients, by how they were sent (file, range, sendfile, stream).',
+    ['mode'],
+)
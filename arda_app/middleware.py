@@ -0,0 +1,42 @@
+"""
+WhiteNoise, usable by async views.
+
+WhiteNoise's middleware is sync only. Django then runs every request that
+passes through it in its one thread for sync code, async views included,
+so a single download waiting on a render holds up every other request on
+the ASGI server. This subclass only looks for a static file in a thread and
+otherwise awaits the rest of the chain on the event loop.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware as BaseWhiteNoiseMiddleware
+
+
+class WhiteNoiseMiddleware(BaseWhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, **kwargs):
+        super().__init__(get_response, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    def static_response(self, request):
+        """WhiteNoise's response for request if it is for a static file, otherwise None."""
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is None:
+            return None
+        return self.serve(static_file, request)
+
+    async def __acall__(self, request):
+        response = await sync_to_async(self.static_response, thread_sensitive=False)(request)
+        if response is not None:
+            return response
+        return await self.get_response(request)
@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-17 03:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arda_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderJobState',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('status', models.CharField(max_length=16)),
+                ('progress', models.FloatField(default=0)),
+                ('output_path', models.CharField(blank=True, default='', max_length=1024)),
+                ('error', models.TextField(blank=True, default='')),
+                ('profile', models.CharField(blank=True, default='', max_length=64)),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserRenderKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=28)),
+                ('variant', models.CharField(max_length=16)),
+                ('key', models.CharField(db_index=True, max_length=64)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user_id', 'variant'), name='unique_user_render_variant')],
+            },
+        ),
+    ]
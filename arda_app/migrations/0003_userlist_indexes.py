@@ -0,0 +1,51 @@
+# Generated by Django 5.2 on 2026-10-17 04:04
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class AddIndexConcurrentlyIfPostgres(AddIndexConcurrently):
+    """
+    CREATE INDEX CONCURRENTLY on PostgreSQL, so building indexes on the large
+    user table doesn't block writes to it; a plain AddIndex elsewhere.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    # Concurrent index builds can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('arda_app', '0002_render_job_state'),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyIfPostgres(
+            model_name='userlist',
+            index=models.Index(fields=['created_at', 'id'], name='userlist_created_idx'),
+        ),
+        AddIndexConcurrentlyIfPostgres(
+            model_name='userlist',
+            index=models.Index(fields=['mood', 'created_at'], name='userlist_mood_created_idx'),
+        ),
+        AddIndexConcurrentlyIfPostgres(
+            model_name='userlist',
+            index=models.Index(fields=['genre', 'created_at'], name='userlist_genre_created_idx'),
+        ),
+        AddIndexConcurrentlyIfPostgres(
+            model_name='userlist',
+            index=models.Index(fields=['name'], name='userlist_name_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-17 04:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arda_app', '0003_userlist_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjobstate',
+            name='eta',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='renderjobstate',
+            name='speed',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -1,12 +1,32 @@
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 import string
 import secrets
 
 # Create your models here.
 
+ID_CHARACTERS = string.ascii_letters + string.digits  # A-Z, a-z, 0-9
+# Random bytes at or above this would make some characters more likely
+# than others, so they are skipped
+_ID_BYTE_LIMIT = 256 - 256 % len(ID_CHARACTERS)
+
+def generate_unique_ids(count, length=28):
+    """count random IDs, drawn from one batch of random bytes instead of a call per character"""
+    needed = count * length
+    chars = []
+    while len(chars) < needed:
+        # A few extra bytes make up for the skipped ones
+        for byte in secrets.token_bytes(needed - len(chars) + needed // 32 + 8):
+            if byte < _ID_BYTE_LIMIT:
+                chars.append(ID_CHARACTERS[byte % len(ID_CHARACTERS)])
+    chars = ''.join(chars[:needed])
+    return [chars[i:i + length] for i in range(0, needed, length)]
+
 def generate_unique_id(length=28):
-    characters = string.ascii_letters + string.digits  # A-Z, a-z, 0-9
-    return ''.join(secrets.choice(characters) for _ in range(length))
+    return generate_unique_ids(1, length)[0]
 
 class UserList(models.Model):
     id = models.CharField(max_length=28, unique=True, default=generate_unique_id, primary_key=True)
@@ -15,7 +35,113 @@ class UserList(models.Model):
     genre = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Match what the admin changelist filters, orders and searches by
+        # (see UserListAdmin), so it never scans the whole table
+        indexes = [
+            # Default ordering and keyset pagination: newest first, id as tie breaker
+            models.Index(fields=['created_at', 'id'], name='userlist_created_idx'),
+            models.Index(fields=['mood', 'created_at'], name='userlist_mood_created_idx'),
+            models.Index(fields=['genre', 'created_at'], name='userlist_genre_created_idx'),
+            # Prefix search (LIKE 'x%') on name; the pattern opclass makes PostgreSQL
+            # use the index whatever the collation, other databases ignore it.
+            # id prefixes already have the primary key's index
+            models.Index(fields=['name'], name='userlist_name_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.id:
             self.id = generate_unique_id()
-        super().save(*args, **kwargs)
\ No newline at end of file
+        super().save(*args, **kwargs)
+
+def _username_cache_key(user_id):
+    return f"username:{user_id}"
+
+def username_for(user_id):
+    """Name of a user, from the cache if possible. Raises UserList.DoesNotExist."""
+    key = _username_cache_key(user_id)
+    name = cache.get(key)
+    if name is None:
+        name = UserList.objects.values_list('name', flat=True).get(id=user_id)
+        cache.set(key, name, getattr(settings, 'USERNAME_CACHE_TTL', 300))
+    return name
+
+async def ausername_for(user_id):
+    """username_for with the async cache and ORM calls, for async views"""
+    key = _username_cache_key(user_id)
+    name = await cache.aget(key)
+    if name is None:
+        name = await UserList.objects.values_list('name', flat=True).aget(id=user_id)
+        await cache.aset(key, name, getattr(settings, 'USERNAME_CACHE_TTL', 300))
+    return name
+
+@receiver(post_save, sender=UserList)
+def refresh_cached_username(sender, instance, **kwargs):
+    # Saved users are about to load the page, so cache the new name right away
+    cache.set(_username_cache_key(instance.id), instance.name, getattr(settings, 'USERNAME_CACHE_TTL', 300))
+
+@receiver(post_delete, sender=UserList)
+def forget_cached_username(sender, instance, **kwargs):
+    cache.delete(_username_cache_key(instance.id))
+
+class RenderJobState(models.Model):
+    """State of a render job, used by the 'database' job store (see arda_app.jobstore)"""
+    key = models.CharField(max_length=64, primary_key=True)
+    status = models.CharField(max_length=16)
+    progress = models.FloatField(default=0)
+    output_path = models.CharField(max_length=1024, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    profile = models.CharField(max_length=64, blank=True, default='')
+    # Encode speed (x realtime) and seconds left as of updated_at, while encoding
+    speed = models.FloatField(null=True, blank=True)
+    eta = models.FloatField(null=True, blank=True)
+    updated_at = models.DateTimeField()
+
+class UserRenderKey(models.Model):
+    """Render a user is waiting for, per variant, used by the 'database' job store"""
+    user_id = models.CharField(max_length=28)
+    variant = models.CharField(max_length=16)
+    key = models.CharField(max_length=64, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'variant'], name='unique_user_render_variant'),
+        ]
+
+def bulk_create_users(rows, batch_size=500, max_attempts=5):
+    """
+    Insert many users (dicts with name, mood and genre) with bulk_create in
+    chunks of batch_size. Returns their generated IDs in input order.
+
+    IDs that already exist, or repeat within the batch, are drawn again
+    before inserting; if a chunk still hits a primary key collision (e.g.
+    a concurrent insert) it is retried with fresh IDs.
+
+    The import is all or nothing: it runs in one transaction, with a
+    savepoint per chunk so a collision only rolls back that chunk's attempt.
+    """
+    ids = []
+    with transaction.atomic():
+        for start in range(0, len(rows), batch_size):
+            chunk = rows[start:start + batch_size]
+            chunk_ids = generate_unique_ids(len(chunk))
+            for attempt in range(max_attempts):
+                taken = set(UserList.objects.filter(id__in=chunk_ids).values_list('id', flat=True))
+                seen = set()
+                for i, user_id in enumerate(chunk_ids):
+                    while user_id in taken or user_id in seen:
+                        user_id = generate_unique_id()
+                    chunk_ids[i] = user_id
+                    seen.add(user_id)
+                try:
+                    with transaction.atomic():
+                        UserList.objects.bulk_create(
+                            [UserList(id=user_id, **row) for user_id, row in zip(chunk_ids, chunk)]
+                        )
+                    break
+                except IntegrityError:
+                    if attempt == max_attempts - 1:
+                        raise
+                    chunk_ids = generate_unique_ids(len(chunk))
+            ids.extend(chunk_ids)
+    return ids
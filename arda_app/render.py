@@ -0,0 +1,753 @@
+"""
+Overlay + encode pipeline for the personalized videos.
+
+Everything in here used to run inline inside views.home. It is kept free of
+request handling so it can be driven by the background workers in
+arda_app.jobs.
+
+encode_video() supervises ffmpeg from the calling thread (plus a reader
+thread per pipe); encode_video_async() does the same from an asyncio event
+loop without any threads of its own (see RENDER_ASYNC in arda_app.jobs).
+"""
+import asyncio
+import os
+import time
+import collections
+import threading
+import hashlib
+import functools
+import logging
+import subprocess
+from fractions import Fraction
+from pathlib import Path
+
+from django.conf import settings
+
+# Import Pillow for image manipulation
+from PIL import Image, ImageDraw, ImageFont
+
+# Import FFmpeg for video processing
+import ffmpeg
+
+from arda_app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Add compatibility for newer PIL versions (PIL.Image.ANTIALIAS is deprecated)
+# In newer Pillow versions, ANTIALIAS was removed and replaced with LANCZOS
+if not hasattr(Image, 'ANTIALIAS'):
+    Image.ANTIALIAS = Image.LANCZOS
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Possible static file locations, checked in order
+STATIC_DIRS = [
+    os.path.join(BASE_DIR, 'static'),  # App static dir
+    os.path.join(BASE_DIR, '../static'),  # Project static dir
+    os.path.join(BASE_DIR, '../staticfiles'),  # Collected static dir
+    os.path.join(BASE_DIR, '../arda_website/staticfiles'),  # Django project staticfiles
+    '/var/task/arda_app/static',  # Vercel path
+    '/var/task/static',  # Vercel alternative path
+    '/var/task/public',  # Vercel public dir
+    '/public',  # Vercel public dir (root)
+    '/tmp/static'  # Temp dir as fallback
+]
+
+# Try common font locations across different OSes
+FONT_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/System/Library/Fonts/Supplemental/Arial Bold.ttf",
+    "C:\\Windows\\Fonts\\arialbd.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+    "/usr/share/fonts/truetype/ubuntu/Ubuntu-B.ttf",
+    # Bundled with the app, so serverless hosts without system fonts still
+    # get a scalable font instead of PIL's tiny bitmap default
+    os.path.join(BASE_DIR, 'static', 'fonts', 'DejaVuSans.ttf'),
+]
+
+# Used when settings.RENDER_ENCODER_PROFILES does not define any profiles.
+# Same output as the original hardcoded libx264 -b:v 2M command.
+DEFAULT_ENCODER_PROFILES = {
+    'quality': {'preset': 'medium', 'bitrate': '2M'},
+}
+
+# Bump whenever build_overlay changes what it draws, so cached renders with
+# the old layout are not served any more.
+# 2: outline drawn as a single text stroke, bundled font fallback
+OVERLAY_VERSION = 2
+
+# Fonts are cached and shared between worker threads, and FreeType faces
+# must not be used by two threads at once
+_text_lock = threading.Lock()
+
+
+def precomposite_enabled():
+    """Render from a base video with the frame already burned in (RENDER_PRECOMPOSITE)."""
+    return getattr(settings, 'RENDER_PRECOMPOSITE', False)
+
+
+def render_backend():
+    """
+    'ffmpeg' (overlay filter in one ffmpeg command) or 'compositor' (NumPy
+    blending in process, see arda_app.compositor), from RENDER_BACKEND.
+    """
+    return getattr(settings, 'RENDER_BACKEND', 'ffmpeg')
+
+
+def overlay_signature():
+    """Everything about the overlay step that goes into the render cache key."""
+    return {
+        'version': OVERLAY_VERSION,
+        'precomposite': precomposite_enabled(),
+    }
+
+
+def encoder_profiles():
+    return getattr(settings, 'RENDER_ENCODER_PROFILES', None) or DEFAULT_ENCODER_PROFILES
+
+
+def default_profile_name():
+    profiles = encoder_profiles()
+    name = getattr(settings, 'RENDER_DEFAULT_PROFILE', None)
+    return name if name in profiles else next(iter(profiles))
+
+
+def get_profile(name):
+    """
+    Encoder profile by name, with every key filled in. A profile has:
+        preset      libx264 preset
+        crf         constant quality; used instead of bitrate when set
+        bitrate     target bitrate, e.g. '2M'
+        threads     encoder threads, 0 lets ffmpeg decide
+        max_height  downscale taller sources to this height, None keeps it
+    These values are part of the render cache key. Jobs add 'fragmented'
+    for renders that are streamed while encoding, 'keyframe_interval' for
+    renders packaged as HLS, and renditions add 'maxrate' (see
+    arda_app.renditions).
+    """
+    profile = encoder_profiles()[name]
+    return {
+        'name': name,
+        'preset': profile.get('preset', 'medium'),
+        'crf': profile.get('crf'),
+        'bitrate': profile.get('bitrate', '2M') if profile.get('crf') is None else None,
+        'threads': profile.get('threads', 0),
+        'max_height': profile.get('max_height'),
+    }
+
+
+def output_height(profile, video_height):
+    """Height to scale the output to for this profile, or None to keep the source size."""
+    max_height = profile.get('max_height')
+    if not max_height or video_height <= max_height:
+        return None
+    # libx264 with yuv420p needs even dimensions
+    return max_height - max_height % 2
+
+
+def encoder_options(profile):
+    """ffmpeg output options for an encoder profile, as {option: value}."""
+    options = {
+        'c:v': 'libx264',  # Video codec
+        'c:a': 'copy',  # Copy audio stream without re-encoding
+        'preset': profile['preset'],
+    }
+    if profile['crf'] is not None:
+        options['crf'] = str(profile['crf'])
+    else:
+        options['b:v'] = profile['bitrate']  # Video bitrate
+    if profile.get('maxrate'):
+        # Ceiling for constant quality encodes of a rendition, over ~1 second
+        options['maxrate'] = profile['maxrate']
+        options['bufsize'] = profile['maxrate']
+    if profile['threads']:
+        options['threads'] = str(profile['threads'])
+    if profile.get('keyframe_interval'):
+        # Regular keyframes, so HLS packaging can cut segments of that length
+        options['force_key_frames'] = f"expr:gte(t,n_forced*{profile['keyframe_interval']})"
+    if profile.get('fragmented'):
+        # Fragmented MP4 is playable while it is still being written, so it
+        # can be streamed to the client during the encode
+        options['movflags'] = 'frag_keyframe+empty_moov+default_base_moof'
+    else:
+        options['movflags'] = '+faststart'  # Optimize for web playback
+    return options
+
+
+def find_assets():
+    """
+    Look for the source video and the frame image in the known static dirs.
+    Returns (video_path, frame_path) or raises FileNotFoundError.
+
+    Use arda_app.assets.resolve(), which remembers the result.
+    """
+    video_path = None
+    frame_path = None
+
+    for static_dir in STATIC_DIRS:
+        potential_video_path = os.path.join(static_dir, 'video', 'liolio.mp4')
+        if not video_path and os.path.exists(potential_video_path):
+            video_path = potential_video_path
+        potential_frame_path = os.path.join(static_dir, 'image', 'frame.png')
+        if not frame_path and os.path.exists(potential_frame_path):
+            frame_path = potential_frame_path
+        if video_path and frame_path:
+            break
+
+    if not video_path or not frame_path:
+        raise FileNotFoundError(f"Video or frame not found in any of: {', '.join(STATIC_DIRS)}")
+
+    return video_path, frame_path
+
+
+def probe_video(video_path):
+    """
+    Get (width, height, duration, fps) of the source video using ffprobe.
+    Falls back to sane defaults if no video stream could be read.
+
+    Spawns ffprobe every time, use arda_app.assets.video_info() instead.
+    """
+    probe = ffmpeg.probe(video_path)
+    video_info = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+
+    if video_info:
+        # Get original video dimensions
+        video_width = int(video_info['width'])
+        video_height = int(video_info['height'])
+        duration = float(video_info.get('duration', 0))
+        try:
+            fps = float(Fraction(video_info.get('r_frame_rate', '24/1')))
+        except (ValueError, ZeroDivisionError):
+            fps = 24.0
+
+        logger.debug("Probed video", extra={'path': video_path, 'width': video_width, 'height': video_height,
+                                            'duration': duration, 'fps': fps})
+        return video_width, video_height, duration, fps
+
+    # Fallback values
+    logger.warning("Could not get video info from ffprobe, using defaults", extra={'path': video_path})
+    return 1280, 720, 10, 24
+
+
+@functools.lru_cache(maxsize=1)
+def font_path():
+    """First of FONT_PATHS that exists, or None. Looked up once."""
+    for path in FONT_PATHS:
+        if os.path.exists(path):
+            logger.info("Using font", extra={'path': path})
+            return path
+    return None
+
+
+@functools.lru_cache(maxsize=32)
+def load_font(font_size):
+    """Load the first available bold font at font_size, or PIL's default font. Cached per size."""
+    # Try to use a better font if available, otherwise fallback
+    try:
+        path = font_path()
+        if path:
+            return ImageFont.truetype(path, font_size)
+
+        logger.warning("No font found, using the default font")
+        return ImageFont.load_default()
+    except Exception as e:
+        # Fallback to default font
+        logger.warning("Error loading font, falling back to the default font", extra={'error': str(e)})
+        return ImageFont.load_default()
+
+
+def layout_name(username, video_width, video_height):
+    """
+    Work out where the username goes on a video_width x video_height frame.
+    Returns (font, font_size, position, text_size, bg_box).
+    """
+    # Calculate font size based on image dimensions
+    font_size = max(20, min(video_width, video_height) // 15)  # Responsive font size
+    font = load_font(font_size)
+
+    # Calculate text size to position it centrally
+    # PIL has different APIs in different versions
+    if hasattr(font, 'getbbox'):
+        with _text_lock:
+            bbox = font.getbbox(username)
+        text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    else:
+        # Fallback estimation
+        text_width = int(font_size * len(username) * 0.6)
+        text_height = int(font_size * 1.2)
+
+
+    # Center text position
+    position = ((video_width - text_width) // 2, (video_height - text_height) // 2)
+    logger.debug("Laid out username", extra={'font_size': font_size, 'text_size': f"{text_width}x{text_height}",
+                                             'position': position})
+
+    # Add a semi-transparent background for the text
+    bg_padding = font_size // 2
+    bg_box = [
+        position[0] - bg_padding,
+        position[1] - bg_padding,
+        position[0] + text_width + bg_padding,
+        position[1] + text_height + bg_padding
+    ]
+    return font, font_size, position, (text_width, text_height), bg_box
+
+
+def draw_name(draw, username, font, font_size, position, bg_box):
+    """Draw the background box, outline and the username itself."""
+    # Draw semi-transparent background
+    bg_color = (0, 0, 0, 128)  # Semi-transparent black
+    draw.rectangle(bg_box, fill=bg_color)
+
+    # Add outline/shadow for better visibility
+    shadow_color = (0, 0, 0, 180)  # Semi-transparent black
+    outline_size = max(1, font_size // 20)
+
+    # Draw the main text, with the outline as a stroke in the same pass
+    text_color = (255, 255, 255, 255)  # Solid white
+    with _text_lock:
+        draw.text(
+            position, username, font=font, fill=text_color,
+            stroke_width=outline_size, stroke_fill=shadow_color
+        )
+
+
+@functools.lru_cache(maxsize=4)
+def _resized_frame(frame_path, mtime_ns, video_width, video_height):
+    return Image.open(frame_path).convert("RGBA").resize((video_width, video_height))
+
+
+def frame_image(frame_path, video_width, video_height):
+    """
+    The frame image as RGBA, resized to the video dimensions. Kept in memory
+    until frame_path changes; copy it before drawing on it.
+    """
+    return _resized_frame(frame_path, os.stat(frame_path).st_mtime_ns, video_width, video_height)
+
+
+def build_overlay(frame_path, username, video_width, video_height):
+    """
+    Draw the username (with a background box and outline) on top of the
+    frame image, resized to the video dimensions. Returns an RGBA image.
+    """
+    img = frame_image(frame_path, video_width, video_height).copy()
+    logger.debug("Built overlay", extra={'size': f"{img.width}x{img.height}"})
+
+    font, font_size, position, text_size, bg_box = layout_name(username, img.width, img.height)
+    draw_name(ImageDraw.Draw(img), username, font, font_size, position, bg_box)
+    return img
+
+
+def build_sprite(username, video_width, video_height):
+    """
+    Precomposite mode: only the username and its background box, cropped
+    tightly. Returns (sprite, (x, y)) where (x, y) is the sprite's top-left
+    corner on the video.
+    """
+    font, font_size, position, text_size, bg_box = layout_name(username, video_width, video_height)
+    left, top, right, bottom = (int(v) for v in bg_box)
+
+    sprite = Image.new("RGBA", (right - left + 1, bottom - top + 1), (0, 0, 0, 0))
+    # Same drawing as build_overlay, shifted into the sprite's coordinates
+    draw_name(
+        ImageDraw.Draw(sprite), username, font, font_size,
+        (position[0] - left, position[1] - top),
+        [0, 0, right - left, bottom - top]
+    )
+    logger.debug("Built sprite", extra={'size': f"{sprite.width}x{sprite.height}", 'position': (left, top)})
+    return sprite, (left, top)
+
+
+def build_base_video(video_path, frame_path, video_width, video_height, output_path):
+    """
+    Burn the (resized) frame into the source video once. Per-user renders in
+    precomposite mode then only overlay the small username sprite on top.
+    Encoded near-lossless since it is encoded again for every user.
+    """
+    frame = frame_image(frame_path, video_width, video_height)
+    frame_png = output_path + '.frame.png'
+    frame.save(frame_png)
+
+    ffmpeg_cmd = [
+        'ffmpeg', '-y',
+        '-i', video_path,
+        '-i', frame_png,
+        '-filter_complex', '[0:v][1:v]overlay=0:0:format=auto,format=yuv420p',
+        '-c:v', 'libx264', '-crf', '12', '-preset', 'veryfast',
+        '-c:a', 'copy',
+        '-loglevel', 'error',
+        output_path
+    ]
+    try:
+        with metrics.FFMPEG_PROCESSES.track():
+            subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.DEVNULL)
+    finally:
+        if os.path.exists(frame_png):
+            os.remove(frame_png)
+    logger.info("Built precomposited base video", extra={'path': output_path})
+
+
+_base_lock = threading.Lock()
+
+
+def ensure_base_video(video_path, frame_path, video_width, video_height):
+    """
+    Path of the precomposited base video for these assets, building it first
+    if it does not exist yet. A changed video or frame gives a new base.
+    """
+    from arda_app import cache
+
+    base_key = hashlib.sha256(
+        f"{cache.file_digest(video_path)}:{cache.file_digest(frame_path)}:{video_width}x{video_height}".encode('utf-8')
+    ).hexdigest()
+    base_path = os.path.join(cache.cache_dir(), f"base_{base_key}.mp4")
+
+    with _base_lock:
+        if not os.path.exists(base_path):
+            partial_path = base_path + '.part.mp4'
+            build_base_video(video_path, frame_path, video_width, video_height, partial_path)
+            os.replace(partial_path, base_path)
+        else:
+            # Touch so cache.prune() keeps it while it is in use
+            cache.touch(base_path)
+    return base_path
+
+
+def parse_progress(block, duration, elapsed):
+    """
+    (percentage, stats) from one block of ffmpeg -progress output, as a
+    dict of its key=value lines. stats has:
+        speed  encode speed as a multiple of realtime, None if not known yet
+        fps    frames encoded per second
+        eta    seconds until the encode is done, None if not known yet
+    elapsed is the wall time since ffmpeg started, used for the ETA while
+    ffmpeg does not report a speed.
+    """
+    def number(key, suffix=''):
+        value = block.get(key, '').strip().removesuffix(suffix)
+        try:
+            return float(value)
+        except ValueError:
+            # 'N/A' until ffmpeg has written something
+            return None
+
+    out_time_us = number('out_time_us')
+    out_time = max(out_time_us / 1_000_000, 0) if out_time_us is not None else 0
+    speed = number('speed', 'x') or None
+    percentage = round(min(out_time / duration * 100, 100), 2) if duration else 0
+
+    eta = None
+    remaining = max(duration - out_time, 0) if duration else None
+    if remaining is not None:
+        if speed:
+            eta = remaining / speed
+        elif out_time > 0 and elapsed > 0:
+            eta = remaining * elapsed / out_time
+    return percentage, {
+        'speed': round(speed, 3) if speed else None,
+        'fps': number('fps'),
+        'eta': round(eta, 1) if eta is not None else None,
+    }
+
+
+def progress_reader(on_progress, duration):
+    """
+    Function to feed ffmpeg's "-progress pipe:1" output to, one raw line at
+    a time; it reports every finished block through on_progress(percentage,
+    speed=..., fps=..., eta=...). See monitor_ffmpeg_progress.
+    """
+    started = time.monotonic()
+    block = {}
+
+    def feed(raw_line):
+        key, sep, value = raw_line.decode('utf-8', errors='replace').strip().partition('=')
+        if not sep:
+            return
+        if key != 'progress':
+            block[key] = value
+            return
+        percentage, stats = parse_progress(block, duration, time.monotonic() - started)
+        if value == 'end':
+            percentage, stats['eta'] = 100, 0
+        on_progress(percentage, **stats)
+        logger.debug("FFmpeg progress", extra={'progress': percentage, **stats})
+        block.clear()
+
+    return feed
+
+
+def monitor_ffmpeg_progress(process, on_progress, duration):
+    """
+    Follow ffmpeg's "-progress pipe:1" output on its stdout and report it
+    through on_progress(percentage, speed=..., fps=..., eta=...).
+
+    ffmpeg writes a block of key=value lines about twice a second, each block
+    ending with progress=continue, and progress=end after the last one:
+
+        frame=250
+        fps=61.20
+        out_time_us=10000000
+        speed=2.45x
+        progress=continue
+
+    Only stdout is read here; ffmpeg's log on stderr is drained separately
+    (see _drain_stderr), so neither pipe can fill up and block ffmpeg.
+    """
+    feed = progress_reader(on_progress, duration)
+    try:
+        for raw_line in process.stdout:
+            feed(raw_line)
+    except Exception as e:
+        logger.warning("Error monitoring FFmpeg progress", extra={'error': str(e)})
+        # Don't let monitoring errors crash the whole process
+        # If monitoring fails, we'll still have the final video if FFmpeg completes successfully
+
+
+async def monitor_ffmpeg_progress_async(process, on_progress, duration):
+    """monitor_ffmpeg_progress for a process started with asyncio.create_subprocess_exec."""
+    feed = progress_reader(on_progress, duration)
+    try:
+        async for raw_line in process.stdout:
+            feed(raw_line)
+    except Exception as e:
+        logger.warning("Error monitoring FFmpeg progress", extra={'error': str(e)})
+
+
+def _drain_stderr(process, lines):
+    """Keep the last lines of ffmpeg's log for error messages."""
+    for raw_line in process.stderr:
+        line = raw_line.decode('utf-8', errors='replace').rstrip()
+        if line:
+            lines.append(line)
+
+
+async def _drain_stderr_async(process, lines):
+    async for raw_line in process.stderr:
+        line = raw_line.decode('utf-8', errors='replace').rstrip()
+        if line:
+            lines.append(line)
+
+
+async def _write_overlay_async(process, overlay):
+    try:
+        process.stdin.write(overlay.tobytes())
+        await process.stdin.drain()
+    finally:
+        process.stdin.close()
+
+
+def ffmpeg_command(video_path, overlay, output_video_path, position, profile, height):
+    """
+    (ffmpeg command, overlay path) for encode_video. The overlay path is
+    None for an in-memory overlay, which goes to ffmpeg's stdin.
+    """
+    options = encoder_options(profile)
+
+    if position is None:
+        overlay_x, overlay_y = '(main_w-overlay_w)/2', '(main_h-overlay_h)/2'
+    else:
+        overlay_x, overlay_y = str(position[0]), str(position[1])
+
+    filters = f'[0:v][1:v]overlay={overlay_x}:{overlay_y}:format=auto'
+    if height:
+        filters += f',scale=-2:{height}'
+    filters += ',format=yuv420p'
+
+    output_args = []
+    for option, value in options.items():
+        output_args += [f'-{option}', value]
+
+    if isinstance(overlay, Image.Image):
+        overlay_path = None
+        overlay_args = [
+            '-f', 'rawvideo', '-pix_fmt', 'rgba',
+            '-s', f'{overlay.width}x{overlay.height}',
+            '-i', 'pipe:0'
+        ]
+    else:
+        overlay_path = overlay
+        overlay_args = ['-i', overlay_path]
+
+    # Generate command for running FFmpeg
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-y',  # Overwrite output files without asking
+        '-i', video_path,  # Input video
+        *overlay_args,  # Input overlay image
+        '-filter_complex',
+        # Ensure overlay is properly positioned and scaled
+        # The format=auto ensures proper alpha handling
+        # The format=yuv420p ensures compatibility with most players
+        filters,
+        *output_args,  # Codec, preset, rate control and threads from the profile
+        '-loglevel', 'warning',  # Only problems on stderr
+        '-nostats',  # No human readable stats line on stderr either
+        '-progress', 'pipe:1',  # Machine readable progress on stdout
+        output_video_path
+    ]
+
+    logger.info("Starting FFmpeg", extra={
+        'input': video_path,
+        'overlay': overlay_path or f'{overlay.width}x{overlay.height} in memory',
+        'profile': profile['name'],
+        'output': output_video_path,
+    })
+    return ffmpeg_cmd, overlay_path
+
+
+def encode_video(video_path, overlay, output_video_path, duration, on_progress,
+                 position=None, profile=None, height=None):
+    """
+    Overlay overlay on video_path and encode to output_video_path with
+    the given encoder profile, reporting progress through
+    on_progress(percentage, speed=..., fps=..., eta=...) (see
+    monitor_ffmpeg_progress; speed, fps and eta may be None).
+
+    overlay is an image file path or an RGBA PIL image. Images are piped to
+    ffmpeg as a single raw RGBA frame (the overlay filter repeats it for the
+    whole video), which saves encoding and decoding a full size PNG.
+
+    The overlay is centered unless position gives its top-left (x, y). The
+    result is scaled down to height when one is given.
+
+    With RENDER_BACKEND = 'compositor' (or when the ffmpeg command fails)
+    the overlay is blended in process instead, see arda_app.compositor.
+    Fragmented (streamed) encodes are not retried that way: their partial
+    output may already be on its way to clients, so the error is raised.
+    """
+    if render_backend() == 'compositor':
+        from arda_app import compositor
+        return compositor.composite_video(
+            video_path, overlay, output_video_path, duration, on_progress,
+            position=position, profile=profile, height=height
+        )
+    if profile is None:
+        profile = get_profile(default_profile_name())
+    ffmpeg_cmd, overlay_path = ffmpeg_command(video_path, overlay, output_video_path, position, profile, height)
+
+    try:
+        # Start FFmpeg; leaving the with block waits for it and closes its pipes
+        with subprocess.Popen(
+            ffmpeg_cmd,
+            stdin=subprocess.PIPE if overlay_path is None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=False
+        ) as process:
+            metrics.FFMPEG_PROCESSES.inc()
+            stderr_lines = collections.deque(maxlen=20)
+            try:
+                # Start monitoring progress in a separate thread
+                monitor_thread = threading.Thread(
+                    target=monitor_ffmpeg_progress,
+                    args=(process, on_progress, duration)
+                )
+                monitor_thread.daemon = True
+                monitor_thread.start()
+                stderr_thread = threading.Thread(target=_drain_stderr, args=(process, stderr_lines))
+                stderr_thread.daemon = True
+                stderr_thread.start()
+
+                if overlay_path is None:
+                    try:
+                        process.stdin.write(overlay.tobytes())
+                    finally:
+                        process.stdin.close()
+
+                # Wait for FFmpeg to finish
+                process.wait()
+                # Let the final progress=end report land before the job moves on
+                monitor_thread.join(timeout=5)
+                stderr_thread.join(timeout=5)
+            finally:
+                metrics.FFMPEG_PROCESSES.dec()
+
+        for line in stderr_lines:
+            logger.debug("FFmpeg output", extra={'line': line})
+
+        # Check if FFmpeg was successful
+        if process.returncode != 0:
+            detail = f": {stderr_lines[-1]}" if stderr_lines else ""
+            raise Exception(f"FFmpeg exited with error code {process.returncode}{detail}")
+    except Exception as e:
+        if profile.get('fragmented'):
+            # Clients may be streaming the partial output already (see
+            # jobs.follow_output); the compositor would write it over
+            raise
+        logger.warning("Error with subprocess FFmpeg, falling back to the compositor",
+                       extra={'error': str(e)})
+        from arda_app import compositor
+        compositor.composite_video(
+            video_path, overlay_path or overlay, output_video_path, duration, on_progress,
+            position=position, profile=profile, height=height
+        )
+
+
+async def encode_video_async(video_path, overlay, output_video_path, duration, on_progress,
+                             position=None, profile=None, height=None):
+    """
+    encode_video for an asyncio event loop: ffmpeg is started with
+    asyncio.create_subprocess_exec and its progress and log are read on the
+    loop, so supervising an encode takes no thread. on_progress is called
+    on the loop (from the compositor's thread for the compositor) and must
+    not block.
+
+    The compositor (RENDER_BACKEND = 'compositor', or the fallback when
+    ffmpeg fails on a non-fragmented encode) does its blending in Python
+    and runs in a thread.
+    """
+    from arda_app import compositor
+
+    if render_backend() == 'compositor':
+        return await asyncio.to_thread(
+            compositor.composite_video, video_path, overlay, output_video_path, duration,
+            on_progress, position=position, profile=profile, height=height
+        )
+    if profile is None:
+        profile = get_profile(default_profile_name())
+    ffmpeg_cmd, overlay_path = ffmpeg_command(video_path, overlay, output_video_path, position, profile, height)
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *ffmpeg_cmd,
+            stdin=subprocess.PIPE if overlay_path is None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        metrics.FFMPEG_PROCESSES.inc()
+        stderr_lines = collections.deque(maxlen=20)
+        try:
+            pipes = [
+                monitor_ffmpeg_progress_async(process, on_progress, duration),
+                _drain_stderr_async(process, stderr_lines),
+            ]
+            if overlay_path is None:
+                pipes.append(_write_overlay_async(process, overlay))
+            await asyncio.gather(*pipes)
+            await process.wait()
+        except BaseException:
+            # Failed or cancelled, don't leave ffmpeg running
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        finally:
+            metrics.FFMPEG_PROCESSES.dec()
+
+        for line in stderr_lines:
+            logger.debug("FFmpeg output", extra={'line': line})
+
+        if process.returncode != 0:
+            detail = f": {stderr_lines[-1]}" if stderr_lines else ""
+            raise Exception(f"FFmpeg exited with error code {process.returncode}{detail}")
+    except Exception as e:
+        if profile.get('fragmented'):
+            # Clients may be streaming the partial output already (see
+            # jobs.follow_output); the compositor would write it over
+            raise
+        logger.warning("Error with subprocess FFmpeg, falling back to the compositor",
+                       extra={'error': str(e)})
+        await asyncio.to_thread(
+            compositor.composite_video, video_path, overlay_path or overlay, output_video_path, duration,
+            on_progress, position=position, profile=profile, height=height
+        )
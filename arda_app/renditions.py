@@ -0,0 +1,136 @@
+"""
+Rendition ladder: the same personalized video at several sizes, so phones
+on slow links get a small file instead of the full resolution one.
+
+A rendition caps the height and bitrate of whatever encoder profile the
+render uses (see apply()). Those caps are part of the profile, and so of
+the render cache key, which makes every rendition a cache entry of its own.
+
+Which rendition a request gets (see choose()):
+1. ?rendition=<name>, if it names one
+2. the smallest one for Save-Data: on or a 2G connection (ECT client hint)
+3. the smallest one at least as tall as the viewport (Sec-CH-Viewport-Width
+   and Sec-CH-DPR client hints, for a 16:9 video), capped at
+   RENDER_MOBILE_RENDITION on 3G and on phones (Sec-CH-UA-Mobile)
+4. RENDER_DEFAULT_RENDITION
+
+Browsers only send most client hints after a response asked for them with
+Accept-CH (see ACCEPT_CH), so a first visit without hints gets the default.
+
+Settings:
+    RENDER_RENDITIONS         {name: {'max_height': ..., 'bitrate': ...}};
+                              either key may be left out, {} is the
+                              profile's own output. Keep names short (up to
+                              10 characters), they are stored with the job.
+    RENDER_DEFAULT_RENDITION  rendition without any hints (default: the
+                              largest)
+    RENDER_MOBILE_RENDITION   largest rendition sent to phones and 3G
+                              connections (default: none, no cap)
+"""
+import math
+import re
+
+from django.conf import settings
+
+# Used when settings.RENDER_RENDITIONS is empty: only the profile's own output
+DEFAULT_RENDITIONS = {
+    'source': {},
+}
+
+# Client hints a rendition can be chosen by; responses chosen by them vary on them
+CLIENT_HINTS = (
+    'Save-Data', 'ECT', 'Sec-CH-UA-Mobile',
+    'Sec-CH-Viewport-Width', 'Viewport-Width', 'Sec-CH-DPR', 'DPR',
+)
+# Hints the loading page asks the browser to send from then on
+ACCEPT_CH = 'ECT, Sec-CH-Viewport-Width, Viewport-Width, Sec-CH-DPR, DPR'
+
+BITRATE_RE = re.compile(r'^(\d+(?:\.\d+)?)([kKmM]?)$')
+
+
+def renditions():
+    return getattr(settings, 'RENDER_RENDITIONS', None) or DEFAULT_RENDITIONS
+
+
+def _height(name):
+    """Height cap of a rendition, infinite for an uncapped one."""
+    return renditions()[name].get('max_height') or math.inf
+
+
+def ladder():
+    """Rendition names, smallest first."""
+    return sorted(renditions(), key=_height)
+
+
+def default_rendition():
+    name = getattr(settings, 'RENDER_DEFAULT_RENDITION', None)
+    return name if name in renditions() else ladder()[-1]
+
+
+def requested(request):
+    """The rendition named by ?rendition=, otherwise the default."""
+    name = request.GET.get('rendition')
+    return name if name in renditions() else default_rendition()
+
+
+def _number(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+def choose(request):
+    """Rendition for a request, from ?rendition= or the client hints."""
+    name = request.GET.get('rendition')
+    if name in renditions():
+        return name
+
+    headers = request.headers
+    names = ladder()
+    connection = headers.get('ECT', '').strip().lower()
+    if headers.get('Save-Data', '').strip().lower() == 'on' or connection in ('slow-2g', '2g'):
+        return names[0]
+
+    choice = default_rendition()
+    width = _number(headers.get('Sec-CH-Viewport-Width') or headers.get('Viewport-Width'))
+    if width is not None:
+        dpr = _number(headers.get('Sec-CH-DPR') or headers.get('DPR')) or 1
+        needed = width * dpr * 9 / 16
+        choice = next((name for name in names if _height(name) >= needed), names[-1])
+
+    mobile = headers.get('Sec-CH-UA-Mobile', '').strip() == '?1'
+    cap = getattr(settings, 'RENDER_MOBILE_RENDITION', None)
+    if (mobile or connection == '3g') and cap in renditions() and _height(cap) < _height(choice):
+        choice = cap
+    return choice
+
+
+def parse_bitrate(value):
+    """Bits per second of an ffmpeg bitrate like '800k' or '2M', or None."""
+    match = BITRATE_RE.match(str(value).strip())
+    if not match:
+        return None
+    number, unit = match.groups()
+    return float(number) * {'': 1, 'k': 1e3, 'm': 1e6}[unit.lower()]
+
+
+def apply(profile, name):
+    """
+    Copy of an encoder profile (see render.get_profile) capped to a
+    rendition: the lower of the two heights, and the rendition's bitrate as
+    the target (bitrate profiles) or as a ceiling (crf profiles).
+    """
+    rendition = renditions()[name]
+    profile = dict(profile)
+    max_height = rendition.get('max_height')
+    if max_height and (not profile['max_height'] or max_height < profile['max_height']):
+        profile['max_height'] = max_height
+    bitrate = rendition.get('bitrate')
+    if bitrate:
+        if profile['crf'] is not None:
+            profile['maxrate'] = bitrate
+        elif (parse_bitrate(bitrate) or math.inf) < (parse_bitrate(profile['bitrate']) or math.inf):
+            profile['bitrate'] = bitrate
+    return profile
@@ -0,0 +1,317 @@
+"""
+Segment-parallel rendering for long source videos.
+
+One libx264 process stops getting faster after a few cores, so with
+RENDER_PARALLEL a render is split up:
+
+1. The source is cut at keyframes into about one segment per available CPU
+   (stream copy, no re-encode). The segments are kept in the render cache
+   dir next to the precomposited base videos, so this happens once per
+   source, not once per render.
+2. Every segment gets the overlay and is encoded by its own ffmpeg process
+   through render.encode_video, in parallel. The overlay is the same on
+   every frame, so the segments need no time offsets.
+3. The encoded segments are joined with the concat demuxer and the source
+   audio is added, both without re-encoding.
+
+Progress of the segments, weighted by their length, is reported as the
+progress of the whole render. Only encode slots that are idle are used for
+the extra segment processes (see arda_app.admission), so a busy server
+encodes the segments a few at a time instead of oversubscribing the CPUs.
+encode_video_async() does the same from an asyncio event loop.
+
+Settings:
+    RENDER_PARALLEL             render long videos in segments (default: False)
+    RENDER_SEGMENTS             number of segments (default: available CPUs)
+    RENDER_SEGMENT_MIN_SECONDS  shortest segment worth its own process; shorter
+                                videos are rendered in one piece (default: 10)
+"""
+import asyncio
+import concurrent.futures
+import glob
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+from arda_app import admission
+from arda_app import assets
+from arda_app import cache
+from arda_app import metrics
+from arda_app import render
+
+logger = logging.getLogger(__name__)
+
+# segment_<source key>_<index>_of_<count>.mp4; a split is complete when
+# all count files are there
+SEGMENT_RE = re.compile(r'^segment_[0-9a-f]{64}_(\d{3})_of_(\d{3})\.mp4$')
+
+# Share of the progress bar for the encodes; the join takes the rest
+ENCODE_SHARE = 99
+
+_split_lock = threading.Lock()
+
+
+def enabled(profile):
+    """
+    Whether renders with this encoder profile are split. Streamed renders
+    (fragmented profiles) are not: their output has to be written front to
+    back while it is sent.
+    """
+    return getattr(settings, 'RENDER_PARALLEL', False) and not profile.get('fragmented')
+
+
+def segment_count(duration):
+    """Segments to split a video of duration seconds into; 1 means no split."""
+    count = getattr(settings, 'RENDER_SEGMENTS', None) or admission.available_cpus()
+    min_seconds = getattr(settings, 'RENDER_SEGMENT_MIN_SECONDS', 10)
+    if min_seconds:
+        count = min(count, int(duration // min_seconds))
+    return max(count, 1)
+
+
+def split_source(video_path, duration, count):
+    """
+    Paths of video_path cut into at most count segments of video only, in
+    order. Cuts happen at the first keyframe after each even split point,
+    so there can be fewer (or shorter and longer) segments than asked for.
+    """
+    source_key = hashlib.sha256(f"{cache.file_digest(video_path)}:{count}".encode('utf-8')).hexdigest()
+    directory = cache.cache_dir()
+    pattern = os.path.join(directory, f"segment_{source_key}_*.mp4")
+
+    with _split_lock:
+        paths = _complete_split(pattern)
+        if paths:
+            for path in paths:
+                # Touch so cache.prune() keeps them while they are in use
+                cache.touch(path)
+            return paths
+
+        partial_pattern = os.path.join(directory, f"segment_{source_key}_%03d.part")
+        for leftover in glob.glob(os.path.join(directory, f"segment_{source_key}_*")):
+            os.remove(leftover)
+        split_points = ','.join(f"{duration * i / count:.3f}" for i in range(1, count))
+        ffmpeg_cmd = [
+            'ffmpeg', '-y',
+            '-i', video_path,
+            '-map', '0:v:0',  # Audio is added back in one piece by the join
+            '-c', 'copy',
+            '-f', 'segment',
+            '-segment_format', 'mp4',
+            '-segment_times', split_points,
+            '-reset_timestamps', '1',
+            '-loglevel', 'error',
+            partial_pattern
+        ]
+        with metrics.FFMPEG_PROCESSES.track():
+            subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.DEVNULL)
+
+        parts = sorted(glob.glob(os.path.join(directory, f"segment_{source_key}_*.part")))
+        paths = []
+        for index, part in enumerate(parts):
+            path = os.path.join(directory, f"segment_{source_key}_{index:03d}_of_{len(parts):03d}.mp4")
+            os.replace(part, path)
+            paths.append(path)
+    logger.info("Split source video", extra={'source': video_path, 'segments': len(paths), 'asked': count})
+    return paths
+
+
+def _complete_split(pattern):
+    paths = sorted(glob.glob(pattern))
+    counts = set()
+    for path in paths:
+        match = SEGMENT_RE.match(os.path.basename(path))
+        if match is None:
+            return None
+        counts.add(int(match.group(2)))
+    if len(counts) != 1 or len(paths) != counts.pop():
+        return None
+    return paths
+
+
+def _durations(segment_paths):
+    return [assets.video_info(path)[2] for path in segment_paths]
+
+
+def _segment_profile(profile, parallel):
+    segment_profile = dict(profile)
+    if not segment_profile['threads']:
+        # One process per segment already uses every core; ffmpeg's default
+        # of a thread per core in each of them would only add contention
+        segment_profile['threads'] = max(1, admission.available_cpus() // parallel)
+    return segment_profile
+
+
+def _progress_reporter(segment_durations, total, on_progress):
+    """
+    Function returning the on_progress callback of segment index, which
+    reports the progress of all segments (total seconds) through on_progress.
+    """
+    # Seconds of video encoded so far, per segment
+    done = [0.0] * len(segment_durations)
+    progress_lock = threading.Lock()
+    started = time.monotonic()
+
+    def segment_progress(index):
+        def report(percentage, **stats):
+            with progress_lock:
+                done[index] = segment_durations[index] * percentage / 100
+                encoded = sum(done)
+            elapsed = time.monotonic() - started
+            speed = encoded / elapsed if elapsed > 0 else 0
+            on_progress(
+                round(min(encoded / total, 1) * ENCODE_SHARE, 2),
+                speed=round(speed, 3) if speed else None,
+                fps=None,
+                eta=round(max(total - encoded, 0) / speed, 1) if speed else None,
+            )
+        return report
+    return segment_progress
+
+
+def _report_done(total, started, on_progress):
+    elapsed = time.monotonic() - started
+    on_progress(100, speed=round(total / elapsed, 3) if elapsed else None, fps=None, eta=0)
+
+
+def _encoded_paths(output_video_path, segment_paths):
+    work_dir = os.path.dirname(output_video_path)
+    return [os.path.join(work_dir, f"part_{index:03d}.mp4") for index in range(len(segment_paths))]
+
+
+def encode_video(video_path, overlay, output_video_path, duration, on_progress,
+                 position=None, profile=None, height=None):
+    """
+    render.encode_video, with the work split over segments of video_path
+    encoded in parallel. The caller holds an encode slot (see
+    admission.acquire()). Videos too short to split are rendered in one piece.
+    The encoded segments are written next to output_video_path.
+    """
+    if profile is None:
+        profile = render.get_profile(render.default_profile_name())
+    count = segment_count(duration)
+    segment_paths = split_source(video_path, duration, count) if count > 1 else []
+    if len(segment_paths) < 2:
+        return render.encode_video(video_path, overlay, output_video_path, duration, on_progress,
+                                   position=position, profile=profile, height=height)
+
+    segment_durations = _durations(segment_paths)
+    total = sum(segment_durations) or duration
+    # The caller's slot runs one segment at a time, idle ones run more
+    borrowed = admission.try_acquire(len(segment_paths) - 1)
+    parallel = 1 + borrowed
+    segment_profile = _segment_profile(profile, parallel)
+    segment_progress = _progress_reporter(segment_durations, total, on_progress)
+    started = time.monotonic()
+    encoded_paths = _encoded_paths(output_video_path, segment_paths)
+    logger.info("Rendering in segments", extra={
+        'source': video_path, 'segments': len(segment_paths), 'parallel': parallel,
+        'threads': segment_profile['threads'],
+    })
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [
+                executor.submit(
+                    render.encode_video, segment_path, overlay, encoded_path, segment_duration,
+                    segment_progress(index), position=position, profile=segment_profile, height=height
+                )
+                for index, (segment_path, encoded_path, segment_duration)
+                in enumerate(zip(segment_paths, encoded_paths, segment_durations))
+            ]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except Exception:
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        admission.release(borrowed)
+
+    join_segments(encoded_paths, video_path, output_video_path, profile)
+    _report_done(total, started, on_progress)
+
+
+async def encode_video_async(video_path, overlay, output_video_path, duration, on_progress,
+                             position=None, profile=None, height=None):
+    """
+    encode_video for an asyncio event loop: the segments are encoded with
+    render.encode_video_async. Splitting and joining are quick stream
+    copies and run in a thread.
+    """
+    if profile is None:
+        profile = render.get_profile(render.default_profile_name())
+    count = segment_count(duration)
+    segment_paths = await asyncio.to_thread(split_source, video_path, duration, count) if count > 1 else []
+    if len(segment_paths) < 2:
+        return await render.encode_video_async(video_path, overlay, output_video_path, duration, on_progress,
+                                               position=position, profile=profile, height=height)
+
+    segment_durations = await asyncio.to_thread(_durations, segment_paths)
+    total = sum(segment_durations) or duration
+    borrowed = admission.try_acquire(len(segment_paths) - 1)
+    parallel = 1 + borrowed
+    segment_profile = _segment_profile(profile, parallel)
+    segment_progress = _progress_reporter(segment_durations, total, on_progress)
+    started = time.monotonic()
+    encoded_paths = _encoded_paths(output_video_path, segment_paths)
+    logger.info("Rendering in segments", extra={
+        'source': video_path, 'segments': len(segment_paths), 'parallel': parallel,
+        'threads': segment_profile['threads'],
+    })
+    running = asyncio.Semaphore(parallel)
+
+    async def encode_segment(index, segment_path, encoded_path, segment_duration):
+        async with running:
+            await render.encode_video_async(
+                segment_path, overlay, encoded_path, segment_duration, segment_progress(index),
+                position=position, profile=segment_profile, height=height
+            )
+
+    tasks = [
+        asyncio.ensure_future(encode_segment(index, *segment))
+        for index, segment in enumerate(zip(segment_paths, encoded_paths, segment_durations))
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # One segment failed; stop the others (their ffmpeg gets killed)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        admission.release(borrowed)
+
+    await asyncio.to_thread(join_segments, encoded_paths, video_path, output_video_path, profile)
+    _report_done(total, started, on_progress)
+
+
+def join_segments(encoded_paths, audio_path, output_video_path, profile):
+    """Concatenate the encoded segments and add audio_path's audio, without re-encoding."""
+    list_path = output_video_path + '.segments.txt'
+    with open(list_path, 'w') as f:
+        for path in encoded_paths:
+            # The concat demuxer's quoting: ' is written as '\''
+            escaped = path.replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    ffmpeg_cmd = [
+        'ffmpeg', '-y',
+        '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-i', audio_path,
+        '-map', '0:v:0', '-map', '1:a:0?',
+        '-c', 'copy',
+        '-movflags', render.encoder_options(profile)['movflags'],
+        '-loglevel', 'error',
+        output_video_path
+    ]
+    try:
+        with metrics.FFMPEG_PROCESSES.track():
+            subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.DEVNULL)
+    finally:
+        os.remove(list_path)
@@ -12,4 +12,10 @@ class UserSerializer(serializers.ModelSerializer):
             mood=validated_data['mood'],
             genre=validated_data['genre']
         )
-        return user 
\ No newline at end of file
+        return user
+
+class BulkUserSerializer(serializers.ModelSerializer):
+    """One user of a bulk import; IDs are always generated by the server"""
+    class Meta:
+        model = UserList
+        fields = ['name', 'mood', 'genre']
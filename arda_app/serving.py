@@ -0,0 +1,215 @@
+"""
+Serving rendered videos.
+
+Adds what a plain FileResponse is missing for large MP4 downloads:
+- byte ranges (Range / If-Range), so players can seek and mobile clients
+  can resume a dropped download instead of starting over
+- ETag / Last-Modified, answering 304 for unchanged artifacts
+- optionally handing the file to the front server (X-Sendfile or
+  X-Accel-Redirect) so no Python worker is busy sending it
+
+Whole files and open-ended ranges are served from a real file object, so
+servers with wsgi.file_wrapper (e.g. gunicorn) can send them with
+os.sendfile. On the ASGI server files are streamed by an async iterator
+instead, in CHUNK_SIZE reads. Files are only opened once the response is
+known to need a body and are closed by the response when it is closed.
+
+Settings:
+    RENDER_SENDFILE       '' (serve from Python), 'x-sendfile' or 'x-accel-redirect'
+    RENDER_SENDFILE_ROOT  directory the front server can serve files from
+                          (default: RENDER_CACHE_DIR)
+    RENDER_SENDFILE_URL   internal URL prefix mapped to RENDER_SENDFILE_ROOT
+                          for X-Accel-Redirect (default: /internal-renders/)
+"""
+import asyncio
+import os
+import re
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+from arda_app import metrics
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Bytes per read when streaming a file to the ASGI server
+CHUNK_SIZE = 64 * 1024
+
+
+class FileRange:
+    """Read-only file wrapper that stops after length bytes."""
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def file_chunks_async(f, length, chunk_size=CHUNK_SIZE):
+    """Async iterator over the next length bytes of f, closing it at the end."""
+    async def chunks():
+        remaining = length
+        try:
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+    return chunks()
+
+
+def file_etag(st):
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """
+    (start, end) inclusive for a single "bytes=" range, None to ignore the
+    header (missing, malformed or multiple ranges), or 'unsatisfiable'.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return 'unsatisfiable'
+    return start, min(end, size - 1)
+
+
+def if_range_matches(request, etag, mtime):
+    """False if an If-Range precondition says the client's copy is stale."""
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        # Weak ETags never match for ranges
+        return value == etag
+    date = parse_http_date_safe(value)
+    return date is not None and int(mtime) <= date
+
+
+def sendfile_response(path):
+    """Response asking the front server to send path, or None if not configured or not allowed."""
+    mode = getattr(settings, 'RENDER_SENDFILE', '')
+    if not mode:
+        return None
+
+    root = getattr(settings, 'RENDER_SENDFILE_ROOT', None) or getattr(settings, 'RENDER_CACHE_DIR', '')
+    if not root:
+        return None
+    root = os.path.realpath(root)
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([root, real_path]) != root:
+        # Only files under the configured root are exposed to the front server
+        return None
+
+    response = HttpResponse()
+    if mode == 'x-accel-redirect':
+        prefix = getattr(settings, 'RENDER_SENDFILE_URL', '/internal-renders/')
+        relative = os.path.relpath(real_path, root).replace(os.sep, '/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + relative
+    elif mode == 'x-sendfile':
+        response['X-Sendfile'] = real_path
+    else:
+        return None
+    # The front server fills in the body, length and ranges
+    return response
+
+
+def serve_file(request, path, filename, content_type='video/mp4', disposition='attachment'):
+    """
+    Serve path as a download (or with disposition='inline', for the
+    browser or player to show), honouring conditional and Range requests.
+    """
+    st = os.stat(path)
+    etag = file_etag(st)
+    last_modified = http_date(st.st_mtime)
+
+    def add_headers(response):
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        response['Accept-Ranges'] = 'bytes'
+        response['Cache-Control'] = 'private, max-age=900'
+        return response
+
+    # 304 Not Modified / 412 Precondition Failed
+    conditional = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+    if conditional is not None:
+        return add_headers(conditional)
+
+    response = sendfile_response(path)
+    if response is not None:
+        # Counted as the whole file, the front server handles any range
+        metrics.BYTES_SERVED.inc(st.st_size, mode='sendfile')
+        response['Content-Type'] = content_type
+        response['Content-Disposition'] = f'{disposition}; filename="{filename}"'
+        return add_headers(response)
+
+    size = st.st_size
+    byte_range = None
+    if if_range_matches(request, etag, st.st_mtime):
+        byte_range = parse_range(request.headers.get('Range'), size)
+
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return add_headers(response)
+
+    f = open(path, 'rb')
+    # Counted when the response is built, so aborted downloads count in full
+    if byte_range is None:
+        start, end, status = 0, size - 1, 200
+        metrics.BYTES_SERVED.inc(size, mode='file')
+    else:
+        start, end = byte_range
+        status = 206
+        metrics.BYTES_SERVED.inc(end - start + 1, mode='range')
+        f.seek(start)
+    length = end - start + 1
+
+    if isinstance(request, ASGIRequest):
+        # FileResponse's iterator is sync, which the ASGI handler would
+        # read whole into memory first; stream it chunk by chunk instead
+        response = StreamingHttpResponse(file_chunks_async(f, length), status=status, content_type=content_type)
+        response['Content-Length'] = str(length)
+    elif end == size - 1:
+        # Whole file or open-ended range: the real file keeps the sendfile fast path
+        response = FileResponse(f, status=status, content_type=content_type)
+    else:
+        response = FileResponse(FileRange(f, length), status=status, content_type=content_type)
+    if byte_range is not None:
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Content-Disposition'] = f'{disposition}; filename="{filename}"'
+    return add_headers(response)
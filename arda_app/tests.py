@@ -1,3 +1,1000 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.db import IntegrityError
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from PIL import Image
+
+from arda_app import (
+    admission, artifacts, assets, cache, compositor, hls, janitor, jobs, jobstore, models, render, renditions,
+    segments, serving, views,
+)
+from arda_app.jobstore import ENCODING, EXPIRED, FAILED, QUEUED, READY
+from arda_app.models import UserList
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(serving.parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(serving.parse_range('bytes=500-', 1000), (500, 999))
+        # Past the end is cut to the file
+        self.assertEqual(serving.parse_range('bytes=900-2000', 1000), (900, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(serving.parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(serving.parse_range('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(serving.parse_range('bytes=-0', 1000), 'unsatisfiable')
+
+    def test_unsatisfiable(self):
+        self.assertEqual(serving.parse_range('bytes=1000-', 1000), 'unsatisfiable')
+        self.assertEqual(serving.parse_range('bytes=50-10', 1000), 'unsatisfiable')
+
+    def test_ignored(self):
+        for header in (None, '', 'bytes=-', 'items=0-9', 'bytes=0-9,20-29', 'bytes=a-b'):
+            with self.subTest(header=header):
+                self.assertIsNone(serving.parse_range(header, 1000))
+
+
+@override_settings(RENDER_SENDFILE='')
+class ServeFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'video.mp4')
+        self.content = bytes(range(256)) * 4
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        self.factory = RequestFactory()
+
+    def serve(self, **headers):
+        response = serving.serve_file(self.factory.get('/', headers=headers), self.path, 'video.mp4')
+        self.addCleanup(response.close)
+        return response
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_whole_file(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.body(response), self.content)
+
+    def test_partial_content(self):
+        response = self.serve(Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(self.body(response), self.content[10:20])
+
+    def test_open_ended_range(self):
+        response = self.serve(Range='bytes=1000-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), self.content[1000:])
+
+    def test_not_modified(self):
+        etag = self.serve()['ETag']
+        response = self.serve(If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_precondition_failed(self):
+        response = self.serve(If_Match='"stale"')
+        self.assertEqual(response.status_code, 412)
+
+    def test_range_not_satisfiable(self):
+        response = self.serve(Range=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+    def test_stale_if_range_gets_whole_file(self):
+        response = self.serve(Range='bytes=10-19', If_Range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+
+
+class MetricsAccessTests(SimpleTestCase):
+    def get(self, view, staff=False, **headers):
+        request = RequestFactory().get('/', headers=headers)
+        request.user = mock.Mock(is_staff=staff)
+        with mock.patch.object(cache, 'stats', return_value={}), mock.patch.object(jobs, 'stats', return_value={}):
+            return view(request).status_code
+
+    def test_closed_by_default(self):
+        for view in (views.metrics_view, views.cache_stats):
+            self.assertEqual(self.get(view), 401)
+            self.assertEqual(self.get(view, staff=True), 200)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_token(self):
+        for view in (views.metrics_view, views.cache_stats):
+            self.assertEqual(self.get(view, Authorization='Bearer s3cret'), 200)
+            self.assertEqual(self.get(view, Authorization='Bearer wrong'), 401)
+
+    @override_settings(METRICS_PUBLIC=True)
+    def test_public(self):
+        for view in (views.metrics_view, views.cache_stats):
+            self.assertEqual(self.get(view), 200)
+        # A token still has to be sent once one is set
+        with self.settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.get(views.metrics_view), 401)
+
+
+class JobStoreTransitionTests:
+    """Compare-and-set behaviour every job store has to share, see make_store()."""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+
+    def test_create(self):
+        self.assertTrue(self.store.transition('a', (None,), QUEUED, profile='fast'))
+        record = self.store.get('a')
+        self.assertEqual(record['status'], QUEUED)
+        self.assertEqual(record['profile'], 'fast')
+
+    def test_only_from_expected_state(self):
+        self.store.transition('a', (None,), QUEUED)
+        # Already exists
+        self.assertFalse(self.store.transition('a', (None,), QUEUED))
+        # Not encoding yet
+        self.assertFalse(self.store.transition('a', (ENCODING,), READY, output_path='/tmp/x.mp4'))
+        self.assertEqual(self.store.get('a')['status'], QUEUED)
+        self.assertEqual(self.store.get('a')['output_path'], '')
+
+        self.assertTrue(self.store.transition('a', (QUEUED,), ENCODING))
+        self.assertTrue(self.store.transition('a', (ENCODING,), READY, output_path='/tmp/x.mp4', progress=100))
+        record = self.store.get('a')
+        self.assertEqual(record['status'], READY)
+        self.assertEqual(record['output_path'], '/tmp/x.mp4')
+
+    def test_missing_job(self):
+        self.assertFalse(self.store.transition('missing', (QUEUED,), ENCODING))
+        self.assertIsNone(self.store.get('missing'))
+
+    def test_invalid_transition(self):
+        with self.assertRaises(jobstore.InvalidTransition):
+            self.store.transition('a', (QUEUED,), READY)
+
+    def test_enqueue(self):
+        self.assertTrue(self.store.enqueue('a'))
+        # Already queued, the caller does not run it
+        self.assertFalse(self.store.enqueue('a'))
+        self.store.transition('a', (QUEUED,), FAILED, error='boom')
+        self.assertTrue(self.store.enqueue('a'))
+        self.assertEqual(self.store.get('a')['error'], '')
+
+    def test_expired_job_can_be_queued_again(self):
+        self.store.transition('a', (None,), READY, output_path='/tmp/x.mp4')
+        self.assertTrue(self.store.transition('a', (READY,), EXPIRED))
+        self.assertTrue(self.store.enqueue('a'))
+        self.assertEqual(self.store.get('a')['status'], QUEUED)
+
+    def test_delete_only_from_expected_state(self):
+        self.store.transition('a', (None,), QUEUED)
+        self.assertFalse(self.store.delete('a', jobstore.FINISHED))
+        self.assertEqual(self.store.get('a')['status'], QUEUED)
+        self.store.transition('a', (QUEUED,), FAILED, error='boom')
+        self.assertTrue(self.store.delete('a', jobstore.FINISHED))
+        self.assertIsNone(self.store.get('a'))
+        self.assertFalse(self.store.delete('a'))
+
+
+class MemoryJobStoreTests(JobStoreTransitionTests, SimpleTestCase):
+    def make_store(self):
+        return jobstore.MemoryJobStore()
+
+
+class SQLiteJobStoreTests(JobStoreTransitionTests, SimpleTestCase):
+    def make_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return jobstore.SQLiteJobStore(os.path.join(directory, 'jobs.sqlite3'))
+
+
+class DatabaseJobStoreTests(JobStoreTransitionTests, TestCase):
+    def make_store(self):
+        return jobstore.DatabaseJobStore()
+
+
+class GenerateIdsTests(SimpleTestCase):
+    def test_ids(self):
+        ids = models.generate_unique_ids(200, length=12)
+        self.assertEqual(len(ids), 200)
+        self.assertEqual(len(set(ids)), 200)
+        for user_id in ids:
+            self.assertEqual(len(user_id), 12)
+            self.assertTrue(set(user_id) <= set(models.ID_CHARACTERS))
+
+    def test_none(self):
+        self.assertEqual(models.generate_unique_ids(0), [])
+
+
+class BulkCreateUsersTests(TestCase):
+    rows = [{'name': f'User {i}', 'mood': 'happy', 'genre': 'pop'} for i in range(5)]
+
+    def test_creates_in_order(self):
+        ids = models.bulk_create_users(self.rows, batch_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(
+            [UserList.objects.get(id=user_id).name for user_id in ids],
+            [row['name'] for row in self.rows],
+        )
+
+    def test_redraws_taken_and_repeated_ids(self):
+        UserList.objects.create(id='taken', name='Existing', mood='sad', genre='rock')
+        generate_unique_ids = models.generate_unique_ids
+        draws = iter([['taken', 'a', 'a', 'b', 'c']])
+
+        def draw(count, length=28):
+            # The first chunk's IDs, then real ones for the redraws
+            return next(draws, None) or generate_unique_ids(count, length)
+
+        with mock.patch.object(models, 'generate_unique_ids', side_effect=draw):
+            ids = models.bulk_create_users(self.rows)
+        self.assertNotIn('taken', ids)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(UserList.objects.get(id='taken').name, 'Existing')
+        self.assertEqual(UserList.objects.count(), 6)
+
+    def test_retries_chunk_after_collision(self):
+        bulk_create = UserList.objects.bulk_create
+        calls = []
+
+        def collide_once(objs, *args, **kwargs):
+            calls.append([obj.id for obj in objs])
+            if len(calls) == 1:
+                # e.g. a concurrent insert took one of the IDs
+                raise IntegrityError('duplicate key')
+            return bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(UserList.objects, 'bulk_create', side_effect=collide_once):
+            ids = models.bulk_create_users(self.rows)
+        self.assertEqual(len(calls), 2)
+        # Retried with fresh IDs
+        self.assertEqual(ids, calls[1])
+        self.assertNotEqual(calls[0], calls[1])
+        self.assertEqual(sorted(UserList.objects.values_list('id', flat=True)), sorted(ids))
+
+    def test_gives_up(self):
+        with mock.patch.object(UserList.objects, 'bulk_create', side_effect=IntegrityError('duplicate key')):
+            with self.assertRaises(IntegrityError):
+                models.bulk_create_users(self.rows, max_attempts=2)
+
+    def test_all_or_nothing(self):
+        bulk_create = UserList.objects.bulk_create
+        calls = []
+
+        def fail_second_chunk(objs, *args, **kwargs):
+            calls.append(objs)
+            if len(calls) > 1:
+                raise IntegrityError('duplicate key')
+            return bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(UserList.objects, 'bulk_create', side_effect=fail_second_chunk):
+            with self.assertRaises(IntegrityError):
+                models.bulk_create_users(self.rows, batch_size=2, max_attempts=2)
+        # The first chunk was rolled back with the rest
+        self.assertFalse(UserList.objects.exists())
+
+
+class ParseProgressTests(SimpleTestCase):
+    def test_with_speed(self):
+        percentage, stats = render.parse_progress(
+            {'out_time_us': '5000000', 'speed': '2.5x', 'fps': '75'}, duration=10, elapsed=2,
+        )
+        self.assertEqual(percentage, 50)
+        self.assertEqual(stats, {'speed': 2.5, 'fps': 75, 'eta': 2})
+
+    def test_eta_from_elapsed_without_speed(self):
+        percentage, stats = render.parse_progress({'out_time_us': '2000000', 'speed': 'N/A'}, duration=10, elapsed=4)
+        self.assertEqual(percentage, 20)
+        self.assertIsNone(stats['speed'])
+        self.assertEqual(stats['eta'], 16)
+
+    def test_nothing_written_yet(self):
+        percentage, stats = render.parse_progress({'out_time_us': 'N/A', 'speed': 'N/A'}, duration=10, elapsed=1)
+        self.assertEqual(percentage, 0)
+        self.assertEqual(stats, {'speed': None, 'fps': None, 'eta': None})
+
+    def test_capped_at_100(self):
+        percentage, stats = render.parse_progress({'out_time_us': '10500000', 'speed': '1x'}, duration=10, elapsed=10)
+        self.assertEqual(percentage, 100)
+        self.assertEqual(stats['eta'], 0)
+
+    def test_unknown_duration(self):
+        percentage, stats = render.parse_progress({'out_time_us': '1000000'}, duration=0, elapsed=1)
+        self.assertEqual(percentage, 0)
+        self.assertIsNone(stats['eta'])
+
+
+class SegmentProgressTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.enterContext(mock.patch.object(segments, 'time', mock.Mock(monotonic=lambda: self.now)))
+        self.reports = []
+
+    def reporter(self, durations, total):
+        return segments._progress_reporter(
+            durations, total, lambda progress, **stats: self.reports.append((progress, stats))
+        )
+
+    def test_weighted_by_segment_duration(self):
+        report = self.reporter([10, 30], 40)
+        self.now += 5
+        report(0)(100)
+        self.assertEqual(self.reports[-1][0], round(10 / 40 * segments.ENCODE_SHARE, 2))
+        report(1)(50)
+        progress, stats = self.reports[-1]
+        self.assertEqual(progress, round(25 / 40 * segments.ENCODE_SHARE, 2))
+        # 25 seconds of video in 5 seconds
+        self.assertEqual(stats['speed'], 5)
+        self.assertEqual(stats['eta'], 3)
+
+    def test_later_report_replaces_earlier(self):
+        report = self.reporter([10, 10], 20)
+        self.now += 1
+        report(0)(50)
+        report(0)(80)
+        self.assertEqual(self.reports[-1][0], round(8 / 20 * segments.ENCODE_SHARE, 2))
+
+    def test_capped_below_done(self):
+        # Segments cut at keyframes can add up to more than the video
+        report = self.reporter([10, 12], 20)
+        self.now += 1
+        report(0)(100)
+        report(1)(100)
+        progress, stats = self.reports[-1]
+        self.assertEqual(progress, segments.ENCODE_SHARE)
+        self.assertEqual(stats['eta'], 0)
+
+    def test_no_time_passed(self):
+        self.reporter([10], 10)(0)(50)
+        progress, stats = self.reports[-1]
+        self.assertEqual(progress, round(0.5 * segments.ENCODE_SHARE, 2))
+        self.assertEqual(stats, {'speed': None, 'fps': None, 'eta': None})
+
+
+class CompleteSplitTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.pattern = os.path.join(self.directory, f"segment_{'a' * 64}_*.mp4")
+
+    def segment(self, index, count):
+        path = os.path.join(self.directory, f"segment_{'a' * 64}_{index:03d}_of_{count:03d}.mp4")
+        open(path, 'wb').close()
+        return path
+
+    def test_complete(self):
+        paths = [self.segment(index, 3) for index in (2, 0, 1)]
+        self.assertEqual(segments._complete_split(self.pattern), sorted(paths))
+
+    def test_missing_segment(self):
+        self.segment(0, 3)
+        self.segment(2, 3)
+        self.assertIsNone(segments._complete_split(self.pattern))
+
+    def test_mixed_splits(self):
+        # Leftovers of an interrupted split into a different number of segments
+        self.segment(0, 2)
+        self.segment(1, 2)
+        self.segment(0, 3)
+        self.assertIsNone(segments._complete_split(self.pattern))
+
+    def test_nothing_split_yet(self):
+        self.assertIsNone(segments._complete_split(self.pattern))
+
+
+@override_settings(RENDER_BACKEND='ffmpeg')
+class EncodeFallbackTests(SimpleTestCase):
+    def setUp(self):
+        # An ffmpeg command that fails straight away
+        self.enterContext(mock.patch.object(render, 'ffmpeg_command', return_value=(['false'], 'overlay.png')))
+        self.composite = self.enterContext(mock.patch.object(compositor, 'composite_video'))
+
+    def encode(self, profile):
+        render.encode_video('video.mp4', 'overlay.png', 'output.mp4', 1, lambda progress, **stats: None,
+                            profile=profile)
+
+    def encode_async(self, profile):
+        asyncio.run(render.encode_video_async('video.mp4', 'overlay.png', 'output.mp4', 1,
+                                              lambda progress, **stats: None, profile=profile))
+
+    def test_falls_back_to_compositor(self):
+        for encode in (self.encode, self.encode_async):
+            self.composite.reset_mock()
+            encode({'name': 'quality'})
+            self.composite.assert_called_once()
+
+    def test_fragmented_fails_instead(self):
+        # The partial output may already be streaming to clients
+        for encode in (self.encode, self.encode_async):
+            with self.assertRaises(Exception):
+                encode({'name': 'quality', 'fragmented': True})
+        self.composite.assert_not_called()
+
+
+class CompositorBlendTests(SimpleTestCase):
+    def overlay(self):
+        # Transparent border around a 2x1 visible part: opaque red, half transparent blue
+        overlay = Image.new('RGBA', (4, 3), (0, 0, 0, 0))
+        overlay.putpixel((1, 1), (255, 0, 0, 255))
+        overlay.putpixel((2, 1), (0, 0, 200, 128))
+        return overlay
+
+    def test_blend(self):
+        frames = np.full((2, 5, 6, 3), 100, dtype=np.uint8)
+        masks = compositor.overlay_masks(self.overlay(), 6, 5, position=(1, 2))
+        rows, columns = masks[:2]
+        # Trimmed to the visible pixels
+        self.assertEqual((rows, columns), (slice(3, 4), slice(2, 4)))
+
+        compositor.blend(frames, masks)
+        expected = np.full((5, 6, 3), 100, dtype=np.uint8)
+        expected[3, 2] = (255, 0, 0)
+        # (100 * 127 + channel * 128 + 127) // 255
+        expected[3, 3] = (50, 50, 150)
+        for frame in frames:
+            np.testing.assert_array_equal(frame, expected)
+
+    def test_centered(self):
+        masks = compositor.overlay_masks(self.overlay(), 8, 5)
+        self.assertEqual(masks[:2], (slice(2, 3), slice(3, 5)))
+
+    def test_clipped_to_frame(self):
+        masks = compositor.overlay_masks(self.overlay(), 6, 5, position=(-2, 0))
+        # Only the blue pixel is left inside the frame
+        self.assertEqual(masks[:2], (slice(1, 2), slice(0, 1)))
+        self.assertEqual(masks[2].tolist(), [[[127]]])
+
+    def test_nothing_visible(self):
+        self.assertIsNone(compositor.overlay_masks(self.overlay(), 6, 5, position=(10, 10)))
+        self.assertIsNone(compositor.overlay_masks(Image.new('RGBA', (4, 3)), 6, 5))
+
+
+@override_settings(
+    RENDER_RENDITIONS={
+        '360p': {'max_height': 360, 'bitrate': '800k'},
+        '720p': {'max_height': 720, 'bitrate': '2500k'},
+        'source': {},
+    },
+    RENDER_DEFAULT_RENDITION=None,
+    RENDER_MOBILE_RENDITION='360p',
+)
+class ChooseRenditionTests(SimpleTestCase):
+    def choose(self, query=None, **headers):
+        return renditions.choose(RequestFactory().get('/', query or {}, headers=headers))
+
+    def test_default_is_largest(self):
+        self.assertEqual(self.choose(), 'source')
+
+    def test_query_wins(self):
+        self.assertEqual(self.choose({'rendition': '720p'}, Save_Data='on'), '720p')
+        self.assertEqual(self.choose({'rendition': 'unknown'}), 'source')
+
+    def test_save_data_and_slow_connections(self):
+        self.assertEqual(self.choose(Save_Data='on'), '360p')
+        self.assertEqual(self.choose(ECT='2g'), '360p')
+        self.assertEqual(self.choose(ECT='slow-2g'), '360p')
+
+    def test_viewport(self):
+        # 400 CSS pixels at 2x need 450 rows
+        self.assertEqual(self.choose(Sec_CH_Viewport_Width='400', Sec_CH_DPR='2'), '720p')
+        self.assertEqual(self.choose(Viewport_Width='600'), '360p')
+        self.assertEqual(self.choose(Sec_CH_Viewport_Width='2560'), 'source')
+        # Unusable hints are ignored
+        self.assertEqual(self.choose(Sec_CH_Viewport_Width='wide'), 'source')
+
+    def test_mobile_cap(self):
+        self.assertEqual(self.choose(Sec_CH_Viewport_Width='2560', Sec_CH_UA_Mobile='?1'), '360p')
+        self.assertEqual(self.choose(ECT='3g'), '360p')
+        self.assertEqual(self.choose(ECT='4g'), 'source')
+
+
+class CacheTests(SimpleTestCase):
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        self.tier2_dir = tempfile.mkdtemp()
+        for directory in (self.local_dir, self.tier2_dir):
+            self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.enterContext(override_settings(
+            RENDER_CACHE_DIR=self.local_dir, RENDER_CACHE_TIER2_DIR=None,
+            RENDER_CACHE_MAX_BYTES=25, RENDER_CACHE_EVICTION='lru',
+        ))
+        self.enterContext(mock.patch.object(cache, '_index', None))
+        self.enterContext(mock.patch.object(cache, '_backends', {}))
+        self.enterContext(mock.patch.dict(cache.CACHE_STATS))
+        self.now = 1000.0
+        self.enterContext(mock.patch.object(artifacts, 'time', mock.Mock(time=lambda: self.now)))
+
+    def store(self, key):
+        """Cache a 10 byte render as key."""
+        fd, path = tempfile.mkstemp(dir=self.local_dir, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'0123456789')
+        cache.store(key, path)
+        self.now += 1
+
+    def lookup(self, key):
+        path = cache.lookup(key)
+        self.now += 1
+        return path
+
+    def cached(self):
+        return {key[0] for key in cache.index().keys(artifacts.LOCAL) if os.path.exists(cache.artifact_path(key))}
+
+    def test_lru_evicts_least_recently_used(self):
+        self.store('a' * 64)
+        self.store('b' * 64)
+        self.lookup('a' * 64)
+        self.lookup('a' * 64)
+        self.lookup('b' * 64)
+        self.store('c' * 64)
+        self.assertEqual(self.cached(), {'b', 'c'})
+        self.assertEqual(cache.CACHE_STATS['evictions'], 1)
+
+    @override_settings(RENDER_CACHE_EVICTION='lfu')
+    def test_lfu_evicts_least_frequently_used(self):
+        self.store('a' * 64)
+        self.store('b' * 64)
+        self.lookup('a' * 64)
+        self.lookup('a' * 64)
+        self.lookup('b' * 64)
+        self.store('c' * 64)
+        self.assertEqual(self.cached(), {'a', 'c'})
+
+    def test_within_budget_nothing_is_evicted(self):
+        self.store('a' * 64)
+        self.store('b' * 64)
+        self.assertEqual(self.cached(), {'a', 'b'})
+        self.assertEqual(cache.CACHE_STATS['evictions'], 0)
+
+    def test_second_tier_promotion(self):
+        with self.settings(RENDER_CACHE_TIER2_DIR=self.tier2_dir, RENDER_CACHE_MAX_BYTES=15):
+            self.store('a' * 64)
+            self.store('b' * 64)
+            # a made room for b by moving down
+            self.assertEqual(cache.index().get('a' * 64)['tier'], artifacts.TIER2)
+            self.assertTrue(os.path.exists(os.path.join(self.tier2_dir, 'a' * 64 + '.mp4')))
+
+            self.assertEqual(self.lookup('a' * 64), cache.artifact_path('a' * 64))
+            self.assertEqual(cache.index().get('a' * 64)['tier'], artifacts.LOCAL)
+            self.assertFalse(os.path.exists(os.path.join(self.tier2_dir, 'a' * 64 + '.mp4')))
+            # and b made room for a
+            self.assertEqual(cache.index().get('b' * 64)['tier'], artifacts.TIER2)
+            self.assertEqual(cache.CACHE_STATS['promotions'], 1)
+            self.assertEqual(cache.CACHE_STATS['demotions'], 2)
+            self.assertEqual(cache.CACHE_STATS['hits'], 1)
+
+    def test_index_is_reconciled_with_disk(self):
+        stale = artifacts.ArtifactIndex(os.path.join(self.local_dir, 'index.sqlite3'))
+        stale.add('a' * 64, artifacts.LOCAL, 10)
+        with open(os.path.join(self.local_dir, 'b' * 64 + '.mp4'), 'wb') as f:
+            f.write(b'01234')
+        # Not artifacts
+        open(os.path.join(self.local_dir, 'base_video.mp4'), 'wb').close()
+
+        artifact_index = cache.index()
+        self.assertIsNone(artifact_index.get('a' * 64))
+        self.assertEqual(artifact_index.get('b' * 64)['size'], 5)
+        self.assertEqual(artifact_index.usage(artifacts.LOCAL), (1, 5))
+
+
+class HLSPackageTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.enterContext(override_settings(RENDER_CACHE_DIR=directory))
+        self.video = os.path.join(directory, 'render.mp4')
+        open(self.video, 'wb').close()
+        self.enterContext(mock.patch.object(cache, 'lookup', return_value=self.video))
+        self.enterContext(mock.patch.object(cache, 'touch'))
+        self.enterContext(mock.patch.object(hls, 'package', side_effect=self.package))
+        self.packaged = []
+        self.blocked = threading.Event()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def package(self, video_path, output_dir):
+        self.packaged.append(os.path.basename(output_dir))
+        if 'a' * 64 in output_dir:
+            self.blocked.set()
+            self.release.wait(10)
+        os.makedirs(output_dir)
+        open(os.path.join(output_dir, hls.PLAYLIST), 'w').close()
+
+    def test_other_keys_are_not_held_up(self):
+        thread = threading.Thread(target=hls.ensure_package, args=('a' * 64,))
+        thread.start()
+        self.assertTrue(self.blocked.wait(5))
+        self.assertEqual(hls.ensure_package('b' * 64), hls.package_dir('b' * 64))
+        self.release.set()
+        thread.join(5)
+        self.assertTrue(os.path.exists(hls.file_path('a' * 64, hls.PLAYLIST)))
+
+    def test_packaged_once(self):
+        self.release.set()
+        hls.package_later('a' * 64)
+        # The playlist request waits for the background packaging instead of starting its own
+        self.assertTrue(self.blocked.wait(5))
+        self.assertIsNotNone(hls.file_path('a' * 64, hls.PLAYLIST))
+        self.assertEqual(self.packaged, [f"hls_{'a' * 64}.part"])
+
+
+class ExpireTests(SimpleTestCase):
+    def setUp(self):
+        self.store = jobstore.MemoryJobStore()
+        patcher = mock.patch.object(jobstore, '_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(jobs.JOBS.clear)
+        self.schedule = mock.patch.object(janitor, 'schedule').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def job(self, key, status):
+        self.store.transition(key, (None,), QUEUED)
+        if status != QUEUED:
+            self.store.transition(key, (QUEUED,), ENCODING)
+        if status not in (QUEUED, ENCODING):
+            self.store.transition(key, (ENCODING,), status)
+        self.store.set_user_key('user', jobs.FINAL, key)
+        job = jobs.RenderJob(key, 'User', 'video.mp4', 'frame.png', {'name': 'fast'})
+        job.status = status
+        jobs.JOBS[key] = job
+        return job
+
+    def test_failed_job_is_scheduled_and_forgotten(self):
+        job = self.job('a' * 64, ENCODING)
+        jobs._fail(job, Exception('boom'))
+        self.schedule.assert_called_once_with(job.key, jobs.CLEANUP_DELAY)
+
+        self.assertEqual(jobs.expire([job.key]), 1)
+        self.assertNotIn(job.key, jobs.JOBS)
+        self.assertIsNone(self.store.get(job.key))
+        self.assertIsNone(self.store.get_user_key('user', jobs.FINAL))
+
+    def test_ready_job_is_forgotten(self):
+        job = self.job('b' * 64, READY)
+        self.assertEqual(jobs.expire([job.key]), 1)
+        self.assertNotIn(job.key, jobs.JOBS)
+        self.assertIsNone(self.store.get(job.key))
+
+    def test_dropped_job_is_scheduled(self):
+        job = self.job('c' * 64, QUEUED)
+        jobs._drop(job)
+        self.assertEqual(self.store.get(job.key)['status'], EXPIRED)
+        self.schedule.assert_called_once_with(job.key, jobs.CLEANUP_DELAY)
+        self.assertEqual(jobs.expire([job.key]), 1)
+        self.assertIsNone(self.store.get(job.key))
+
+    def test_queued_again_is_kept(self):
+        job = self.job('d' * 64, QUEUED)
+        self.assertEqual(jobs.expire([job.key]), 0)
+        self.assertIs(jobs.JOBS[job.key], job)
+        self.assertEqual(self.store.get(job.key)['status'], QUEUED)
+        self.assertEqual(self.store.get_user_key('user', jobs.FINAL), job.key)
+
+
+class JanitorTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        for patcher in (
+            # A fake clock for the janitor only
+            mock.patch.object(janitor, 'time', mock.Mock(time=lambda: self.now)),
+            mock.patch.object(janitor, '_heap', []),
+            mock.patch.object(janitor, '_due', {}),
+            # No thread, the tests call _pop_due and sweep themselves
+            mock.patch.object(janitor, 'start'),
+        ):
+            patcher.start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_pops_due_keys_in_order(self):
+        janitor.schedule('a', 10)
+        janitor.schedule('b', 5)
+        janitor.schedule('c', 20)
+        self.assertEqual(janitor._pop_due(self.now + 4), [])
+        self.assertEqual(janitor._pop_due(self.now + 12), ['b', 'a'])
+        self.assertEqual(janitor._pop_due(self.now + 100), ['c'])
+        self.assertEqual(janitor._pop_due(self.now + 100), [])
+
+    def test_reschedule_replaces_pending(self):
+        janitor.schedule('a', 5)
+        janitor.schedule('a', 30)
+        # The first entry is stale now
+        self.assertEqual(janitor._pop_due(self.now + 10), [])
+        self.assertEqual(janitor._pop_due(self.now + 30), ['a'])
+        self.assertEqual(janitor._pop_due(self.now + 1000), [])
+
+    def test_expired_exactly_once(self):
+        janitor.schedule('a', 5)
+        janitor.schedule('b', 5)
+        janitor.schedule('a', 10)
+        with mock.patch.object(jobs, 'expire', return_value=2) as expire, mock.patch.object(cache, 'prune'):
+            for step in range(30):
+                self.now += 1
+                janitor.sweep(janitor._pop_due(self.now))
+        expired = [key for call in expire.call_args_list for key in call.args[0]]
+        self.assertEqual(sorted(expired), ['a', 'b'])
+
+    def test_reconcile_jobs(self):
+        store = jobstore.MemoryJobStore()
+        store.transition('old', (None,), READY)
+        store.transition('failed', (None,), QUEUED)
+        store.transition('failed', (QUEUED,), ENCODING)
+        store.transition('failed', (ENCODING,), FAILED)
+        store.transition('queued', (None,), QUEUED)
+        store.transition('pending', (None,), READY)
+        store.jobs['old']['updated_at'] = self.now - jobs.CLEANUP_DELAY - 60
+        store.jobs['failed']['updated_at'] = self.now - 100
+        janitor.schedule('pending', 5)
+
+        with mock.patch.object(jobstore, '_store', store):
+            janitor.reconcile_jobs()
+        self.assertEqual(janitor._due, {
+            'old': self.now,
+            'failed': self.now + jobs.CLEANUP_DELAY - 100,
+            # Already scheduled by this process
+            'pending': self.now + 5,
+        })
+
+    def test_reconcile_temp_dirs(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        names = ['arda_render_tmp_1111_live', 'arda_render_tmp_2222_dead', 'arda_render_tmp_1111_old', 'unrelated']
+        for name in names:
+            os.mkdir(os.path.join(root, name))
+        self.now = time.time()
+        old = self.now - 7 * 3600
+        os.utime(os.path.join(root, 'arda_render_tmp_1111_old'), (old, old))
+
+        with mock.patch.object(janitor.tempfile, 'gettempdir', return_value=root), \
+                mock.patch.object(janitor, '_pid_running', side_effect=lambda pid: pid == 1111), \
+                override_settings(RENDER_TEMP_MAX_AGE=6 * 3600):
+            self.assertEqual(janitor.reconcile_temp_dirs(), 2)
+        self.assertEqual(sorted(os.listdir(root)), ['arda_render_tmp_1111_live', 'unrelated'])
+
+
+@override_settings(RENDER_WORKERS=1, RENDER_ASYNC=False, RENDER_PARALLEL=False, RENDER_HLS=False,
+                   RENDER_RENDITIONS=None, RENDER_MAX_QUEUE=None)
+class RenderQueueTestCase(SimpleTestCase):
+    """
+    Runs jobs through the real queue and worker with the encode replaced:
+    each encode records its profile name in self.encodes and waits for
+    self.release.
+    """
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.assets = (os.path.join(directory, 'video.mp4'), os.path.join(directory, 'frame.png'))
+        for path in self.assets:
+            with open(path, 'wb') as f:
+                f.write(path.encode())
+
+        self.encodes = []
+        self.release = threading.Event()
+        # Let a blocked encode finish even if the test failed
+        self.addCleanup(self.release.set)
+        self.store = jobstore.MemoryJobStore()
+        for patcher in (
+            mock.patch.object(jobstore, '_store', self.store),
+            mock.patch.object(assets, 'resolve', return_value=self.assets),
+            mock.patch.object(cache, 'lookup', return_value=None),
+            mock.patch.object(cache, 'store', side_effect=lambda key, path: path),
+            mock.patch.object(jobs, '_prepare', side_effect=self.prepare),
+            mock.patch.object(render, 'encode_video', side_effect=self.encode),
+            mock.patch.object(janitor, 'schedule'),
+        ):
+            patcher.start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(jobs.JOBS.clear)
+
+    def prepare(self, job, temp_dir):
+        output_path = os.path.join(temp_dir, 'output.mp4')
+        open(output_path, 'wb').close()
+        job.partial_path = output_path
+        job.encoding.set()
+        return {
+            'video_path': job.video_path, 'overlay': None, 'output_video_path': output_path,
+            'duration': 1, 'position': None, 'profile': job.profile, 'height': None,
+        }
+
+    def encode(self, video_path, overlay, output_video_path, duration, on_progress, **kwargs):
+        self.encodes.append(kwargs['profile']['name'])
+        self.release.wait(10)
+        on_progress(100)
+
+    def wait_until(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "Timed out")
+            time.sleep(0.01)
+
+
+class CoalescingTests(RenderQueueTestCase):
+    def test_concurrent_submits_share_one_encode(self):
+        submitted = []
+        results = []
+
+        def download(user_id):
+            job = jobs.submit(user_id, 'Same Name')
+            submitted.append(job)
+            results.append((job, jobs.wait_for(job, 10)))
+
+        coalesced = jobs.COALESCE_STATS['coalesced']
+        threads = [threading.Thread(target=download, args=(f'user-{i}',)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        self.wait_until(lambda: len(submitted) == 5 and self.encodes)
+        self.release.set()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(len(self.encodes), 1)
+        job = submitted[0]
+        self.assertEqual(results, [(job, True)] * 5)
+        self.assertEqual(job.status, READY)
+        self.assertEqual(self.store.get(job.key)['status'], READY)
+        self.assertEqual(jobs.COALESCE_STATS['coalesced'] - coalesced, 4)
+        for i in range(5):
+            self.assertEqual(self.store.get_user_key(f'user-{i}', jobs.FINAL), job.key)
+
+    def test_wait_for_times_out(self):
+        timeouts = jobs.COALESCE_STATS['wait_timeouts']
+        job = jobs.submit('user', 'Slow Render')
+        self.assertFalse(jobs.wait_for(job, 0.05))
+        self.assertEqual(jobs.COALESCE_STATS['wait_timeouts'] - timeouts, 1)
+        self.assertTrue(job.is_active)
+
+        self.release.set()
+        self.assertTrue(jobs.wait_for(job, 10))
+        self.assertEqual(job.status, READY)
+
+
+@override_settings(RENDER_MAX_ENCODES=2, RENDER_MAX_QUEUE=2, RENDER_RETRY_AFTER=10)
+class AdmissionTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(admission, '_average_encode', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_queue_limit(self):
+        admission.admit(0)
+        admission.admit(1)
+        with self.assertRaises(admission.QueueFull) as raised:
+            admission.admit(2)
+        self.assertEqual(raised.exception.retry_after, 10)
+
+    @override_settings(RENDER_MAX_QUEUE=None)
+    def test_default_queue_limit(self):
+        self.assertEqual(admission.max_queue(), 8)
+
+    def test_running_average(self):
+        self.assertIsNone(admission.average_encode())
+        admission.record_encode(10)
+        self.assertEqual(admission.average_encode(), 10)
+        admission.record_encode(20)
+        self.assertAlmostEqual(admission.average_encode(), 10 + admission.ESTIMATE_WEIGHT * 10)
+
+    def test_retry_after(self):
+        # Nothing known yet
+        self.assertEqual(admission.retry_after(2), 10)
+        admission.record_encode(30)
+        # One place frees up every 30 / 2 seconds
+        self.assertEqual(admission.retry_after(2), 15)
+        self.assertEqual(admission.retry_after(5), 60)
+        self.assertEqual(admission.retry_after(100), admission.MAX_RETRY_AFTER)
+
+    def test_retry_after_at_least_a_second(self):
+        admission.record_encode(0.1)
+        self.assertEqual(admission.retry_after(2), admission.MIN_RETRY_AFTER)
+
+    def test_start_estimate(self):
+        self.assertIsNone(admission.start_estimate(0, 0))
+        admission.record_encode(12)
+        # A slot is free
+        self.assertEqual(admission.start_estimate(0, 1), 0)
+        self.assertEqual(admission.start_estimate(0, 2), 6)
+        self.assertEqual(admission.start_estimate(3, 2), 24)
+
+
+@override_settings(RENDER_MAX_ENCODES=1, RENDER_MAX_QUEUE=1, RENDER_PREVIEW_PROFILE='preview')
+class PreviewAdmissionTests(RenderQueueTestCase):
+    def setUp(self):
+        super().setUp()
+        # Keeps the worker busy until self.release is set
+        self.blocker = jobs.submit('blocker', 'Blocker', 'quality')
+        self.wait_until(lambda: self.encodes)
+
+    def finish(self, *jobs_to_wait_for):
+        self.release.set()
+        for job in (self.blocker, *jobs_to_wait_for):
+            self.assertTrue(jobs.wait_for(job, 10))
+
+    def preview_keys(self):
+        return [job.key for job in jobs.JOBS.values() if job.profile['name'] == 'preview']
+
+    def test_turned_away_leaves_no_preview(self):
+        waiting = jobs.submit('waiting', 'Waiting', 'quality')
+        with self.assertRaises(admission.QueueFull):
+            jobs.submit_with_preview('user', 'Turned Away', 'quality')
+        self.assertEqual(self.preview_keys(), [])
+        self.assertIsNone(self.store.get_user_key('user', jobs.PREVIEW))
+        self.assertIsNone(self.store.get_user_key('user', jobs.FINAL))
+        self.finish(waiting)
+        self.assertEqual(self.encodes, ['quality', 'quality'])
+
+    def test_no_room_for_preview(self):
+        preview_job, final_job = jobs.submit_with_preview('user', 'Last Place', 'quality')
+        self.assertIsNone(preview_job)
+        self.assertEqual(self.preview_keys(), [])
+        self.finish(final_job)
+        self.assertEqual(final_job.status, READY)
+
+    @override_settings(RENDER_MAX_QUEUE=2)
+    def test_preview_runs_first(self):
+        preview_job, final_job = jobs.submit_with_preview('user', 'Both', 'quality')
+        self.assertEqual(preview_job.profile['name'], 'preview')
+        self.finish(preview_job, final_job)
+        self.assertEqual(self.encodes, ['quality', 'preview', 'quality'])
+
+
+@override_settings(RENDER_SPECULATIVE=True, RENDER_SPECULATIVE_MAX_QUEUE=10, RENDER_STREAMING=False,
+                   RENDER_LOAD_PROFILES=[])
+class SpeculativeTests(RenderQueueTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock.patch.dict(jobs.SPECULATIVE_STATS, {'queued': 0, 'dropped': 0, 'promoted': 0}))
+        # Keeps the worker busy until self.release is set
+        self.blocker = jobs.submit('blocker', 'Blocker', 'quality')
+        self.wait_until(lambda: self.encodes)
+
+    @override_settings(RENDER_SPECULATIVE_MAX_WAIT=-1)
+    def test_dropped_after_waiting_too_long(self):
+        job = jobs.speculate('user', 'Nobody Came')
+        self.assertTrue(job.speculative)
+        self.release.set()
+        self.assertTrue(jobs.wait_for(job, 10))
+
+        self.assertEqual(job.status, EXPIRED)
+        self.assertEqual(self.store.get(job.key)['status'], EXPIRED)
+        self.assertEqual(self.encodes, ['quality'])
+        self.assertEqual(jobs.SPECULATIVE_STATS['dropped'], 1)
+        # Cleaned up like any other finished job
+        self.wait_until(lambda: mock.call(job.key, jobs.CLEANUP_DELAY) in janitor.schedule.call_args_list)
+
+    @override_settings(RENDER_SPECULATIVE_MAX_WAIT=-1)
+    def test_promoted_when_asked_for(self):
+        job = jobs.speculate('user', 'Came Back')
+        promoted = jobs.submit('user', 'Came Back', jobs.choose_profile(), rendition=renditions.default_rendition())
+        self.assertIs(promoted, job)
+        self.assertFalse(job.speculative)
+        self.assertEqual(jobs.SPECULATIVE_STATS['promoted'], 1)
+        # Queued after the promotion, so it runs after the promoted job
+        later = jobs.submit('other', 'Later', 'fast')
+
+        self.release.set()
+        self.assertTrue(jobs.wait_for(job, 10))
+        self.assertTrue(jobs.wait_for(later, 10))
+        # Not dropped for its wait, and encoded once despite its two queue entries
+        self.assertEqual(job.status, READY)
+        self.assertEqual(self.encodes, ['quality', 'quality', 'fast'])
+        self.assertEqual(jobs.SPECULATIVE_STATS['dropped'], 0)
+
+    def test_runs_behind_normal_jobs(self):
+        job = jobs.speculate('user', 'Can Wait')
+        normal = jobs.submit('other', 'In A Hurry', 'fast')
+        self.release.set()
+        self.assertTrue(jobs.wait_for(job, 10))
+        self.assertTrue(jobs.wait_for(normal, 10))
+        self.assertEqual(self.encodes, ['quality', 'fast', 'quality'])
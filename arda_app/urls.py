@@ -5,5 +5,9 @@ from . import views
 urlpatterns = [
     path('', views.home, name='home'),
     path('progress/', views.get_progress, name='get_progress'),
+    path('progress/stream/', views.progress_stream, name='progress_stream'),
+    path('cache-stats/', views.cache_stats, name='cache_stats'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('hls/<str:key>/<str:name>', views.hls_file, name='hls_file'),
     path('apis/v1', include('apis.urls')),
 ]
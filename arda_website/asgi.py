@@ -5,6 +5,12 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+The loading page, its download and progress endpoints are async views, so
+under an ASGI server (e.g. gunicorn arda_website.asgi -k
+uvicorn.workers.UvicornWorker) requests waiting on a render or holding a
+progress stream open do not take a thread each. Set RENDER_ASYNC to
+supervise the encodes from an event loop as well.
 """
 
 import os
@@ -14,3 +20,11 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'arda_website.settings')
 
 application = get_asgi_application()
+
+# Resolve and probe the render assets (and build the precomposited base
+# video) in the background, before the first render needs them; start the
+# janitor expiring finished renders, which cleans up after a previous run
+from arda_app import janitor, jobs  # noqa: E402
+
+jobs.start_warm_up()
+janitor.start()
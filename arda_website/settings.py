@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -49,7 +50,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # WhiteNoise, made async capable so it does not hold up async views
+    'arda_app.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -101,9 +103,23 @@ DATABASES = {
       'sslmode': 'require',
     },
     'DISABLE_SERVER_SIDE_CURSORS': True,
+    # Keep connections open between requests instead of paying a new TLS
+    # handshake each time, checking they are still alive before reuse
+    'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+    'CONN_HEALTH_CHECKS': True,
   }
 }
 
+# Optional connection pool shared by a process's threads (render workers,
+# ASGI). Needs psycopg 3 with the pool extra (pip install "psycopg[pool]")
+# instead of psycopg2, and replaces persistent connections.
+if os.getenv('DB_POOL', 'False').lower() in ('1', 'true', 'yes'):
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+    }
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -156,3 +172,177 @@ REST_FRAMEWORK = {
 }
 
 CSRF_TRUSTED_ORIGINS = ['https://arda-website.vercel.app']
+
+# Video rendering
+# Renders run on a pool of background worker threads (see arda_app/jobs.py)
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', os.cpu_count() or 1))
+# Admission control (arda_app/admission.py): at most RENDER_MAX_ENCODES
+# encodes at once (default: one per available CPU) and RENDER_MAX_QUEUE
+# renders waiting (default: 4 per encode slot); past that, downloads get 429
+# with a Retry-After (RENDER_RETRY_AFTER until encode times are known)
+RENDER_MAX_ENCODES = int(os.getenv('RENDER_MAX_ENCODES', 0)) or None
+RENDER_MAX_QUEUE = int(os.getenv('RENDER_MAX_QUEUE')) if os.getenv('RENDER_MAX_QUEUE') else None
+RENDER_RETRY_AFTER = 10
+# Supervise every encode from one asyncio event loop thread (ffmpeg started
+# with asyncio.create_subprocess_exec) instead of a worker thread each plus
+# two pipe readers; RENDER_WORKERS is not used then
+RENDER_ASYNC = os.getenv('RENDER_ASYNC', 'False').lower() in ('1', 'true', 'yes')
+
+# Finished renders are cached on disk by a hash of their inputs (arda_app/cache.py)
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'arda_render_cache'))
+RENDER_CACHE_TTL = int(os.getenv('RENDER_CACHE_TTL', 86400))
+# Byte budget of RENDER_CACHE_DIR (0 for no limit); least recently used renders ('lru', or
+# least frequently used with 'lfu') are moved to the second tier, or deleted
+# if there is none
+RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+RENDER_CACHE_EVICTION = os.getenv('RENDER_CACHE_EVICTION', 'lru')
+# Second, larger tier for evicted renders, e.g. a mounted bucket or network share
+RENDER_CACHE_TIER2_DIR = os.getenv('RENDER_CACHE_TIER2_DIR', '')
+RENDER_CACHE_TIER2_MAX_BYTES = int(os.getenv('RENDER_CACHE_TIER2_MAX_BYTES', 20 * 1024 ** 3))
+
+# Burn frame.png into a base video once and only overlay a small username
+# sprite per user. Faster, but the name box darkens the frame behind it
+# instead of cutting through it.
+RENDER_PRECOMPOSITE = os.getenv('RENDER_PRECOMPOSITE', 'False').lower() in ('1', 'true', 'yes')
+
+# 'ffmpeg' overlays with ffmpeg's filter graph; 'compositor' decodes frames
+# and blends the overlay with NumPy in process (also the fallback when the
+# ffmpeg command fails), RENDER_COMPOSITE_BATCH_FRAMES frames at a time.
+RENDER_BACKEND = os.getenv('RENDER_BACKEND', 'ffmpeg')
+RENDER_COMPOSITE_BATCH_FRAMES = 16
+
+# Split long videos at keyframes into RENDER_SEGMENTS pieces (default: one
+# per available CPU, none shorter than RENDER_SEGMENT_MIN_SECONDS), encode
+# them in parallel and join them without re-encoding (see arda_app.segments)
+RENDER_PARALLEL = os.getenv('RENDER_PARALLEL', 'False').lower() in ('1', 'true', 'yes')
+RENDER_SEGMENTS = None
+RENDER_SEGMENT_MIN_SECONDS = 10
+
+# Named encoder profiles (libx264). 'crf' takes precedence over 'bitrate';
+# threads 0 lets ffmpeg decide; max_height downscales taller sources.
+RENDER_ENCODER_PROFILES = {
+    'quality': {'preset': 'medium', 'bitrate': '2M', 'threads': 0, 'max_height': None},
+    'balanced': {'preset': 'veryfast', 'crf': 23, 'threads': 0, 'max_height': 1080},
+    'fast': {'preset': 'ultrafast', 'crf': 28, 'threads': 2, 'max_height': 720},
+    'preview': {'preset': 'ultrafast', 'crf': 32, 'threads': 1, 'max_height': 360},
+}
+RENDER_DEFAULT_PROFILE = os.getenv('RENDER_DEFAULT_PROFILE', 'quality')
+# Fall back to cheaper profiles as the render queue grows: [(queue depth, profile)]
+RENDER_LOAD_PROFILES = [(4, 'balanced'), (12, 'fast')]
+# Two-pass delivery: serve a quick preview first, then the full quality video
+RENDER_PREVIEW_PROFILE = 'preview'
+RENDER_PREVIEW_FIRST = os.getenv('RENDER_PREVIEW_FIRST', 'False').lower() in ('1', 'true', 'yes')
+
+# Rendition ladder: caps on the profile's height and bitrate, picked per
+# request by ?rendition= or the client hints (see arda_app/renditions.py).
+# {} is the profile's own output. Phones and 3G connections get at most
+# RENDER_MOBILE_RENDITION.
+RENDER_RENDITIONS = {
+    '480p': {'max_height': 480, 'bitrate': '1M'},
+    '720p': {'max_height': 720, 'bitrate': '1500k'},
+    'source': {},
+}
+RENDER_DEFAULT_RENDITION = 'source'
+RENDER_MOBILE_RENDITION = '720p'
+
+# Also offer finished videos as HLS (?format=hls redirects to the playlist),
+# cut into segments of about RENDER_HLS_SEGMENT_SECONDS
+RENDER_HLS = os.getenv('RENDER_HLS', 'False').lower() in ('1', 'true', 'yes')
+RENDER_HLS_SEGMENT_SECONDS = 4
+
+# Stream the video to the client while it is still encoding (fragmented MP4).
+# If no worker starts the encode within RENDER_STREAM_START_TIMEOUT seconds
+# the request falls back to the normal queue-and-poll flow.
+RENDER_STREAMING = os.getenv('RENDER_STREAMING', 'False').lower() in ('1', 'true', 'yes')
+RENDER_STREAM_START_TIMEOUT = 10
+
+# Hand finished videos to the front server instead of sending them from Python:
+# '' (off), 'x-sendfile' (Apache/lighttpd) or 'x-accel-redirect' (nginx, with an
+# internal location for RENDER_SENDFILE_URL aliased to RENDER_SENDFILE_ROOT)
+RENDER_SENDFILE = os.getenv('RENDER_SENDFILE', '')
+RENDER_SENDFILE_ROOT = RENDER_CACHE_DIR
+RENDER_SENDFILE_URL = '/internal-renders/'
+
+# Push progress to the loading page over Server-Sent Events (/progress/stream/).
+# Needs the ASGI application (arda_website.asgi), e.g.
+# gunicorn arda_website.asgi -k uvicorn.workers.UvicornWorker
+RENDER_PROGRESS_PUSH = os.getenv('RENDER_PROGRESS_PUSH', 'False').lower() in ('1', 'true', 'yes')
+RENDER_PROGRESS_KEEPALIVE = 15
+
+# Where render job state lives: 'memory' (this process only), 'sqlite' (a
+# file shared by all processes on this machine) or 'database' (the Django
+# database, shared by every instance)
+RENDER_JOB_STORE = os.getenv('RENDER_JOB_STORE', 'sqlite')
+RENDER_JOB_STORE_PATH = os.getenv('RENDER_JOB_STORE_PATH', os.path.join(tempfile.gettempdir(), 'arda_render_jobs.sqlite3'))
+RENDER_JOB_STALE_AFTER = 600
+
+# Seconds a download request waits on the render it joined (every request
+# for the same render shares one encode) before answering 202 and leaving
+# the page to poll /progress/
+RENDER_COALESCE_WAIT = 60
+
+# The janitor expires finished renders in batches at most this often (seconds)
+RENDER_JANITOR_INTERVAL = 30
+# Render temp dirs older than this are removed on startup even if their
+# process still seems to be alive (seconds)
+RENDER_TEMP_MAX_AGE = 6 * 3600
+
+# Start rendering a user's video as soon as /apis/v1/create-user creates them,
+# at low priority: skipped while RENDER_SPECULATIVE_MAX_QUEUE jobs are waiting
+# (default: RENDER_WORKERS) and dropped if still queued after
+# RENDER_SPECULATIVE_MAX_WAIT seconds
+RENDER_SPECULATIVE = os.getenv('RENDER_SPECULATIVE', 'False').lower() in ('1', 'true', 'yes')
+RENDER_SPECULATIVE_MAX_QUEUE = None
+RENDER_SPECULATIVE_MAX_WAIT = 60
+
+# Bulk user import (/apis/v1/create-users): most users per request, and rows
+# per INSERT
+USER_BULK_MAX = 50000
+USER_BULK_BATCH_SIZE = 500
+
+# Seconds a user's name stays in the cache used by the loading page and
+# renders (arda_app.models.username_for). Saving a user refreshes it; with
+# several processes configure a shared CACHES backend so they all see it.
+USERNAME_CACHE_TTL = 300
+
+# User admin on large tables (arda_app.admin): lists are counted exactly up
+# to ADMIN_EXACT_COUNT_LIMIT rows and estimated past that; the mood / genre
+# filter choices are looked up at most every ADMIN_FILTER_CACHE_TTL seconds
+ADMIN_EXACT_COUNT_LIMIT = 10000
+ADMIN_FILTER_CACHE_TTL = 3600
+ADMIN_FILTER_MAX_CHOICES = 100
+
+# Logging: the app's loggers write one structured line per event (see
+# arda_app.logformat), as logfmt or, with LOG_FORMAT=json, JSON.
+# LOG_LEVEL=DEBUG adds per-render details and sampled ffmpeg output.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'logfmt')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'arda_app.logformat.StructuredFormatter',
+            'output': LOG_FORMAT,
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'structured',
+        },
+    },
+    'loggers': {
+        'arda_app': {'handlers': ['console'], 'level': LOG_LEVEL, 'propagate': False},
+        'apis': {'handlers': ['console'], 'level': LOG_LEVEL, 'propagate': False},
+    },
+}
+
+# Prometheus metrics at /metrics (see arda_app.metrics). Scrapers send
+# "Authorization: Bearer <METRICS_TOKEN>"; without a token only staff users
+# can read /metrics and /cache-stats/, unless METRICS_PUBLIC opens them to
+# everyone (e.g. when only an internal network can reach the site).
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True').lower() in ('1', 'true', 'yes')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', 'False').lower() in ('1', 'true', 'yes')
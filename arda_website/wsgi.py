@@ -15,4 +15,12 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'arda_website.settings')
 
 application = get_wsgi_application()
 
+# Resolve and probe the render assets (and build the precomposited base
+# video) in the background, before the first render needs them; start the
+# janitor expiring finished renders, which cleans up after a previous run
+from arda_app import janitor, jobs  # noqa: E402
+
+jobs.start_warm_up()
+janitor.start()
+
 app = application